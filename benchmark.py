@@ -0,0 +1,761 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import sys
+import time
+import timeit
+import argparse
+import subprocess
+import tracemalloc
+import os
+import json
+import tempfile
+from datetime import datetime
+from struct import pack, unpack, unpack_from
+import codecs
+
+sys.path.append("zk")
+
+from zk import ZK, const
+from zk import columnar
+from zk.base import create_checksum
+from zk.user import User, UserDirectory
+from zk.attendance import Attendance
+from zk.simulator import ZKSimulator
+from zk.fleet import Fleet
+from zk.pool import ZKPool
+from zk.health import HealthTracker
+from zk.tuner import ChunkTuner
+from zk.policy import RetryPolicy
+from zk.exception import ZKErrorDeadline, ZKErrorResponse, ZKNetworkError
+from zk.finger import Finger
+from zk.backup import Backup, BackupWriter
+from zk import provision
+from zk import codec
+from zk.protocol import decode_template, decode_attendance, split_buffer
+
+parser = argparse.ArgumentParser(description='ZK Benchmarks (against the local device simulator)')
+parser.add_argument('benchmarks', nargs='*',
+                    help='benchmarks to run [all]')
+parser.add_argument('-U', '--users', type=int,
+                    help='number of users [5000]', default=5000)
+parser.add_argument('-F', '--templates', type=int,
+                    help='number of templates [5000]', default=5000)
+parser.add_argument('-R', '--records', type=int,
+                    help='number of attendance records [50000]', default=50000)
+parser.add_argument('-s', '--user-size', type=int, choices=[28, 72],
+                    help='user record size [72]', default=72)
+parser.add_argument('-r', '--record-size', type=int, choices=[8, 16, 40],
+                    help='attendance record size [40]', default=40)
+parser.add_argument('-L', '--latency', type=float,
+                    help='simulated round trip in seconds [0]', default=0)
+parser.add_argument('-f', '--force-udp', action="store_true",
+                    help='Force UDP communication')
+parser.add_argument('-v', '--verbose', action="store_true",
+                    help='Print debug information')
+
+
+def timed(label, function, *args, **kwargs):
+    inicio = time.time()
+    result = function(*args, **kwargs)
+    final = time.time()
+    print ('    {:<32} took {:.3f}[s]'.format(label, final - inicio))
+    return result
+
+
+def simulator(args, users=None, templates=None, records=None, **options):
+    sim = ZKSimulator(port=0, user_packet_size=args.user_size, record_size=args.record_size, latency=args.latency, **options)
+    sim.seed(
+        users=args.users if users is None else users,
+        templates=args.templates if templates is None else templates,
+        records=args.records if records is None else records
+    )
+    return sim.start()
+
+
+def external_simulator(args, users=0, templates=0, records=0):
+    """ simulator in its own process, so it doesn't count for tracemalloc """
+    probe = ZKSimulator(port=0).start()
+    port = probe.port
+    probe.stop()
+    process = subprocess.Popen([
+        sys.executable, '-m', 'zk.simulator', '-p', str(port),
+        '-s', str(args.user_size), '-r', str(args.record_size), '-L', str(args.latency),
+        '-U', str(users), '-F', str(templates), '-R', str(records)
+    ], stdout=subprocess.PIPE)
+    process.stdout.readline() # ready
+    process.port = port
+    return process
+
+
+def connect(args, sim, **kwargs):
+    zk = ZK('127.0.0.1', port=sim.port, timeout=10, ommit_ping=True, force_udp=args.force_udp, verbose=args.verbose, **kwargs)
+    return zk.connect()
+
+
+def bench_scale(args):
+    """ how bulk reads scale with the dataset size """
+    for fraction in [4, 2, 1]:
+        users, templates, records = args.users // fraction, args.templates // fraction, args.records // fraction
+        print ('--- users: {} templates: {} records: {} ---'.format(users, templates, records))
+        sim = simulator(args, users, templates, records)
+        conn = connect(args, sim)
+        try:
+            timed('get_users', conn.get_users)
+            timed('get_templates', conn.get_templates)
+            timed('get_attendance', conn.get_attendance)
+        finally:
+            conn.disconnect()
+            sim.stop()
+
+
+def legacy_checksum(p):
+    """ previous ZK.__create_checksum (reference) """
+    l = len(p)
+    checksum = 0
+    while l > 1:
+        checksum += unpack('H', pack('BB', p[0], p[1]))[0]
+        p = p[2:]
+        if checksum > const.USHRT_MAX:
+            checksum -= const.USHRT_MAX
+        l -= 2
+    if l:
+        checksum = checksum + p[-1]
+    while checksum > const.USHRT_MAX:
+        checksum -= const.USHRT_MAX
+    checksum = ~checksum
+    while checksum < 0:
+        checksum += const.USHRT_MAX
+    return pack('H', checksum)
+
+
+def legacy_header(command, command_string, session_id, reply_id):
+    """ previous ZK.__create_header + __create_tcp_top (reference) """
+    buf = pack('<4H', command, 0, session_id, reply_id) + command_string
+    buf = unpack('8B' + '%sB' % len(command_string), buf)
+    checksum = unpack('H', legacy_checksum(buf))[0]
+    buf = pack('<4H', command, checksum, session_id, reply_id + 1) + command_string
+    return pack('<HHI', const.MACHINE_PREPARE_DATA_1, const.MACHINE_PREPARE_DATA_2, len(buf)) + buf
+
+
+def bench_checksum(args):
+    """ packet checksum and header builder (legacy vs linear) """
+    zk = ZK('127.0.0.1')
+    create_packet = zk._ZK__create_packet
+    for label, size in [('8 B', 8), ('1 KB', 1024), ('64 KB', 64 * 1024)]:
+        payload = bytes(bytearray(i % 256 for i in range(size)))
+        number = max(1, 20000 // size)
+        legacy = min(timeit.repeat(lambda: legacy_header(const.CMD_DATA, payload, 1, 2), number=number, repeat=3)) / number
+        linear = min(timeit.repeat(lambda: create_packet(const.CMD_DATA, payload, 1, 2), number=number * 100, repeat=3)) / (number * 100)
+        checksum = min(timeit.repeat(lambda: create_checksum(payload), number=number * 100, repeat=3)) / (number * 100)
+        print ('    {:<6} legacy header {:>12.2f}[us] new header {:>9.2f}[us] (checksum {:.2f}[us]) x{:.0f}'.format(
+            label, legacy * 1e6, linear * 1e6, checksum * 1e6, legacy / linear))
+
+
+def bench_memory(args):
+    """ peak memory of a full attendance download (read_with_buffer) """
+    sim = external_simulator(args, users=args.users, records=args.records)
+    conn = connect(args, sim)
+    try:
+        tracemalloc.start()
+        data, size = timed('read_with_buffer', conn.read_with_buffer, const.CMD_ATTLOG_RRQ)
+        _current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print ('    payload {:.2f}[MB] peak {:.2f}[MB] ({:.2f}x)'.format(size / 1e6, peak / 1e6, float(peak) / size))
+    finally:
+        conn.disconnect()
+        sim.terminate()
+        sim.wait()
+
+
+def bench_columnar(args):
+    """ attendance decoding: objects vs columns (iter_unpack / numpy) """
+    sim = simulator(args, users=args.users, templates=0, records=args.records)
+    conn = connect(args, sim)
+    try:
+        timed('get_attendance', conn.get_attendance)
+        data, size = timed('read_with_buffer', conn.read_with_buffer, const.CMD_ATTLOG_RRQ)
+        view = memoryview(data)[4:]
+        timed('decode_attendance (iter_unpack)', columnar.decode_attendance, view, args.record_size, False)
+        if columnar.numpy is not None:
+            timed('decode_attendance (numpy)', columnar.decode_attendance, view, args.record_size, True)
+        timed('get_attendance_columns', conn.get_attendance_columns)
+    finally:
+        conn.disconnect()
+        sim.stop()
+
+
+def bench_join(args):
+    """ uid -> user join of attendance records: filter scan vs index """
+    records = 20000
+    for users_count in [500, 1000, 2000, 4000]:
+        users = [User(uid, 'User %i' % uid, 0, '', '', str(100000 + uid)) for uid in range(1, users_count + 1)]
+        uids = [i % users_count + 1 for i in range(records)]
+        def legacy():
+            for uid in uids:
+                tuser = list(filter(lambda x: x.uid == uid, users))
+                user_id = tuser[0].user_id if tuser else str(uid)
+        def indexed():
+            directory = UserDirectory(users)
+            for uid in uids:
+                tuser = directory.get_by_uid(uid)
+                user_id = tuser.user_id if tuser else str(uid)
+        print ('--- {} records x {} users ---'.format(records, users_count))
+        timed('filter join', legacy)
+        timed('UserDirectory join', indexed)
+
+
+def bench_since(args):
+    """ incremental attendance sync: full read vs cursor """
+    sim = simulator(args, users=args.users, templates=0, records=args.records)
+    conn = connect(args, sim)
+    try:
+        timed('get_attendance', conn.get_attendance)
+        _attendances, cursor = timed('get_attendance_since (full)', conn.get_attendance_since)
+        for i in range(10):
+            sim.add_attendance(i + 1, datetime(2020, 1, 1, 9, i))
+        attendances, cursor = timed('get_attendance_since (cursor)', conn.get_attendance_since, cursor)
+        print ('    {} new records'.format(len(attendances)))
+    finally:
+        conn.disconnect()
+        sim.stop()
+
+
+def bench_stream(args):
+    """ peak memory and first record latency: get_attendance vs iter_attendance """
+    sim = external_simulator(args, users=100, records=args.records)
+    conn = connect(args, sim)
+    try:
+        for label, read in [('get_attendance', lambda: conn.get_attendance()),
+                            ('iter_attendance', lambda: conn.iter_attendance())]:
+            tracemalloc.start()
+            inicio = time.time()
+            first = None
+            count = 0
+            for attendance in read():
+                if first is None:
+                    first = time.time() - inicio
+                count += 1
+            total = time.time() - inicio
+            _current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print ('    {:<16} {} records, first after {:.3f}[s] all {:.3f}[s] peak {:.2f}[MB]'.format(
+                label, count, first, total, peak / 1e6))
+    finally:
+        conn.disconnect()
+        sim.terminate()
+        sim.wait()
+
+
+def bench_fleet(args):
+    """ attendance sweep of many devices: one by one vs Fleet """
+    devices = 8
+    sims = [external_simulator(args, users=100, records=args.records // devices) for _i in range(devices)]
+    inventory = ['127.0.0.1:%i' % sim.port for sim in sims]
+    try:
+        def sequential():
+            for sim in sims:
+                conn = connect(args, sim)
+                conn.get_attendance()
+                conn.disconnect()
+        def concurrent():
+            with Fleet(inventory, workers=devices, timeout=10, ommit_ping=True, force_udp=args.force_udp) as fleet:
+                return list(fleet.get_attendance())
+        print ('--- {} devices x {} records ---'.format(devices, args.records // devices))
+        timed('one by one', sequential)
+        results = timed('Fleet', concurrent)
+        print ('    slowest device {:.3f}[s]'.format(max(result.elapsed for result in results)))
+    finally:
+        for sim in sims:
+            sim.terminate()
+            sim.wait()
+
+
+def bench_pool(args):
+    """ repeated polls: connect/disconnect every time vs ZKPool """
+    polls = 20
+    sim = simulator(args, users=10, templates=0, records=10)
+    try:
+        def reconnecting():
+            for _i in range(polls):
+                conn = connect(args, sim)
+                conn.read_sizes()
+                conn.disconnect()
+        def pooled():
+            with ZKPool(timeout=10, ommit_ping=True, force_udp=args.force_udp) as pool:
+                for _i in range(polls):
+                    pool.call('127.0.0.1', sim.port, 'read_sizes')
+                return pool.metrics
+        print ('--- {} polls (latency {}[s]) ---'.format(polls, args.latency))
+        timed('connect every poll', reconnecting)
+        metrics = timed('ZKPool', pooled)
+        print ('    {}'.format(metrics))
+    finally:
+        sim.stop()
+
+
+def bench_pipeline(args):
+    """ 1504 chunk reads: serial vs pipelined (use -L for a WAN round trip) """
+    sim = simulator(args, users=100, templates=0, records=args.records)
+    try:
+        print ('--- {} records, latency {}[s] ---'.format(args.records, args.latency))
+        for pipeline in [0, 2, 4, 8]:
+            conn = connect(args, sim, pipeline=pipeline)
+            data, size = timed('read_with_buffer pipeline={}'.format(pipeline), conn.read_with_buffer, const.CMD_ATTLOG_RRQ)
+            conn.disconnect()
+    finally:
+        sim.stop()
+
+
+def bench_adaptive(args):
+    """ 1504 chunk size: firmware maximum vs adaptive, clean and lossy links """
+    for error_rate in [0, 0.02]:
+        sim = simulator(args, users=100, templates=0, records=args.records, error_rate=error_rate, bandwidth=4 << 20)
+        try:
+            print ('--- {} records, 4MB/s, {} loss per KB ---'.format(args.records, error_rate))
+            for adaptive in [False, True]:
+                conn = connect(args, sim, adaptive=adaptive)
+                try:
+                    timed('read_with_buffer adaptive={}'.format(adaptive), conn.read_with_buffer, const.CMD_ATTLOG_RRQ)
+                except ZKErrorResponse as e:
+                    print ('    read_with_buffer adaptive={} failed: {}'.format(adaptive, e))
+                if conn.chunk_tuner is not None:
+                    print ('    {}'.format(conn.chunk_tuner))
+                conn.disconnect()
+        finally:
+            sim.stop()
+        ChunkTuner.devices.clear()
+
+
+def template_database(args):
+    """ command 110 upload buffer with every user and template of a seeded simulator """
+    sim = simulator(args, records=0)
+    try:
+        conn = connect(args, sim)
+        users, templates = conn.get_users(), conn.get_templates()
+        conn.disconnect()
+    finally:
+        sim.stop()
+    upack = b''.join(user.repack73() if args.user_size == 72 else user.repack29() for user in users)
+    table, fpack = b'', b''
+    for finger in templates:
+        tfp = finger.repack_only()
+        table += pack('<bHbI', 2, finger.uid, 0x10 + finger.fid, len(fpack))
+        fpack += tfp
+    return pack('III', len(upack), len(table), len(fpack)) + upack + table + fpack
+
+
+def bench_upload(args):
+    """ template database restore: 1024 bytes serial chunks vs bigger and windowed chunks """
+    packet = template_database(args)
+    print ('--- {} bytes, latency {}[s] ---'.format(len(packet), args.latency))
+    for label, upload_chunk, pipeline in [('1024 bytes chunks', 1024, 0), ('16KB chunks', 16 * 1024, 0), ('16KB chunks pipeline=4', 16 * 1024, 4)]:
+        sim = simulator(args, users=0, templates=0, records=0)
+        try:
+            conn = connect(args, sim, pipeline=pipeline, upload_chunk=upload_chunk)
+            timed(label, conn._send_with_buffer, packet)
+            conn.disconnect()
+        finally:
+            sim.stop()
+
+
+def bench_provision(args):
+    """ provisioning users: set_user one by one vs set_users """
+    users = [User(uid, 'User %i' % uid, const.USER_DEFAULT, '', '', str(uid), 0) for uid in range(1, args.users + 1)]
+    print ('--- {} users, latency {}[s] ---'.format(len(users), args.latency))
+    for label in ['set_user', 'set_users']:
+        sim = simulator(args, users=0, templates=0, records=0)
+        try:
+            conn = connect(args, sim)
+            if label == 'set_user':
+                def one_by_one():
+                    for user in users:
+                        conn.set_user(user.uid, user.name, user.privilege, user.password, user.group_id, user.user_id, user.card)
+                timed(label, one_by_one)
+            else:
+                timed(label, conn.set_users, users)
+            conn.disconnect()
+        finally:
+            sim.stop()
+
+
+def bench_restore(args):
+    """ template restore: save_user_template per user vs save_users_templates """
+    sim = simulator(args, records=0)
+    try:
+        conn = connect(args, sim)
+        users, templates = conn.get_users(), conn.get_templates()
+        conn.disconnect()
+    finally:
+        sim.stop()
+    print ('--- {} users, {} templates, latency {}[s] ---'.format(len(users), len(templates), args.latency))
+    for label in ['save_user_template', 'save_users_templates']:
+        sim = simulator(args, users=0, templates=0, records=0)
+        try:
+            conn = connect(args, sim)
+            if label == 'save_user_template':
+                def one_by_one():
+                    for user in users:
+                        conn.save_user_template(user, list(filter(lambda f: f.uid == user.uid, templates)))
+                timed(label, one_by_one)
+            else:
+                timed(label, conn.save_users_templates, users, templates)
+            conn.disconnect()
+        finally:
+            sim.stop()
+
+
+def bench_backup(args):
+    """ backup file: indented json (test_backup_restore.py) vs binary backup """
+    sim = simulator(args, records=0)
+    try:
+        conn = connect(args, sim)
+        users, templates = conn.get_users(), conn.get_templates()
+        conn.disconnect()
+    finally:
+        sim.stop()
+    folder = tempfile.mkdtemp()
+    json_file, binary_file = os.path.join(folder, 'backup.json.bak'), os.path.join(folder, 'backup.zkb')
+    def write_json():
+        with open(json_file, 'w') as output:
+            json.dump({'users': [u.json_pack() for u in users], 'templates': [t.json_pack() for t in templates]}, output, indent=1)
+    def write_binary():
+        with BackupWriter(open(binary_file, 'wb')) as writer:
+            for user in users:
+                writer.add_user(user)
+            for finger in templates:
+                writer.add_template(finger)
+    def read_json():
+        with open(json_file, 'r') as infile:
+            data = json.load(infile)
+        fingers = {}
+        for finger in (Finger.json_unpack(t) for t in data['templates']):
+            fingers.setdefault(finger.uid, []).append(finger)
+        return sum(len(fingers.get(user.uid, [])) for user in (User.json_unpack(u) for u in data['users']))
+    def read_binary():
+        with Backup(binary_file) as source:
+            return sum(len(fingers) for _user, fingers in source.iter_users_templates())
+    print ('--- {} users, {} templates ---'.format(len(users), len(templates)))
+    for label, write, read, filename in [('json', write_json, read_json, json_file), ('binary', write_binary, read_binary, binary_file)]:
+        timed('write {}'.format(label), write)
+        tracemalloc.start()
+        timed('read {} (users + templates)'.format(label), read)
+        _current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print ('    {} file {:.2f}[MB] read peak {:.2f}[MB]'.format(label, os.path.getsize(filename) / 1e6, peak / 1e6))
+        os.remove(filename)
+
+
+def bench_reconcile(args):
+    """ bring a device to a desired state (1% changed): erase and upload all vs provision plan + apply """
+    for label in ['clear_data + save_users_templates', 'provision plan + apply']:
+        sim = simulator(args, records=0)
+        try:
+            conn = connect(args, sim)
+            users, templates = conn.get_users(), conn.get_templates()
+            for user in users[::100]:
+                user.name += ' changed'
+            users = users[:-len(users) // 100]
+            if label.startswith('clear_data'):
+                def erase_all():
+                    conn.clear_data()
+                    conn.save_users_templates(users, templates)
+                timed(label, erase_all)
+            else:
+                changes = timed('provision plan', provision.plan, conn, users, templates)
+                print ('    {}'.format(changes))
+                timed('provision apply', changes.apply, conn)
+            conn.disconnect()
+        finally:
+            sim.stop()
+
+
+class LegacyFinger(object):
+    """ Finger before __slots__: eager size and mark, __dict__ """
+
+    def __init__(self, uid, fid, valid, template):
+        self.size = len(template)
+        self.uid = int(uid)
+        self.fid = int(fid)
+        self.valid = int(valid)
+        self.template = template
+        self.mark = codecs.encode(template[:8], 'hex') + b'...' + codecs.encode(template[-8:], 'hex')
+
+
+def bench_fingers(args):
+    """ decoding templates: eager Finger with copies vs slotted Finger with memoryview slices """
+    templates = max(args.templates, 20000)
+    sim = simulator(args, users=min(args.users, templates), templates=templates, records=0)
+    try:
+        conn = connect(args, sim)
+        data, size = conn.read_with_buffer(const.CMD_DB_RRQ, const.FCT_FINGERTMP)
+        conn.disconnect()
+    finally:
+        sim.stop()
+    def legacy():
+        return [LegacyFinger(uid, fid, valid, bytes(data[offset + 6:offset + size]))
+                for offset, size in split_buffer(data)
+                for _size, uid, fid, valid in [unpack_from('<HHbb', data, offset)]]
+    def slotted():
+        view = memoryview(data)
+        return [decode_template(view, offset) for offset, _size in split_buffer(view)]
+    print ('--- {} templates, buffer {:.2f}[MB] ---'.format(templates, len(data) / 1e6))
+    for label, function in [('eager Finger + copies', legacy), ('slotted Finger + memoryview', slotted)]:
+        tracemalloc.start()
+        fingers = timed(label, function)
+        current, _peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print ('    {} fingers, {:.2f}[MB] retained ({:.0f} bytes per finger, downloaded buffer not counted)'.format(
+            len(fingers), current / 1e6, float(current) / len(fingers)))
+        del fingers
+
+
+class LegacyUser(object):
+    """ User before __slots__: __dict__ and coercions on every record """
+
+    def __init__(self, uid, name, privilege, password='', group_id='', user_id='', card=0):
+        self.uid = uid
+        self.name = u'{0}'.format(name)
+        self.privilege = privilege
+        self.password = str(password)
+        self.group_id = str(group_id)
+        self.user_id = user_id
+        self.card = int(card)
+
+
+class LegacyAttendance(object):
+    """ Attendance before __slots__: __dict__ """
+
+    def __init__(self, user_id, timestamp, status, punch=0, uid=0):
+        self.uid = uid
+        self.user_id = user_id
+        self.timestamp = timestamp
+        self.status = status
+        self.punch = punch
+
+
+def bench_records(args):
+    """ per record footprint of users and attendances: __dict__ vs __slots__ """
+    records = max(args.records, 500000)
+    timestamp = datetime(2024, 1, 1, 8, 0, 0)
+    user_ids = [str(100000 + uid) for uid in range(1, args.users + 1)]
+    kinds = [
+        ('users', args.users, [
+            ('dict User', lambda: [LegacyUser(uid, 'User', 0, '', '', user_ids[uid - 1], 0) for uid in range(1, args.users + 1)]),
+            ('slotted User.fast', lambda: [User.fast(uid, 'User', 0, '', '', user_ids[uid - 1], 0) for uid in range(1, args.users + 1)]),
+        ]),
+        ('attendances', records, [
+            ('dict Attendance', lambda: [LegacyAttendance(user_ids[i % args.users], timestamp, 1, 0, i % args.users + 1) for i in range(records)]),
+            ('slotted Attendance.fast', lambda: [Attendance.fast(user_ids[i % args.users], timestamp, 1, 0, i % args.users + 1) for i in range(records)]),
+        ]),
+    ]
+    for kind, count, builders in kinds:
+        print ('--- {} {} ---'.format(count, kind))
+        for label, function in builders:
+            tracemalloc.start()
+            objects = timed(label, function)
+            current, _peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print ('    {:.2f}[MB] retained ({:.0f} bytes per record, shared fields not counted)'.format(
+                current / 1e6, float(current) / count))
+            del objects
+
+
+def bench_timestamps(args):
+    """ attendance decoding: eager datetimes vs raw device time (lazy datetimes) """
+    records = max(args.records, 200000)
+    sim = simulator(args, users=args.users, templates=0, records=records)
+    try:
+        conn = connect(args, sim)
+        users = UserDirectory(conn.get_users())
+        data, size = conn.read_with_buffer(const.CMD_ATTLOG_RRQ)
+        conn.disconnect()
+    finally:
+        sim.stop()
+    view = memoryview(data)
+    offsets = range(4, len(data) - args.record_size + 1, args.record_size)
+    print ('--- {} records of {} bytes ---'.format(len(offsets), args.record_size))
+    timed('decode_attendance', lambda: [decode_attendance(view, offset, args.record_size, users) for offset in offsets])
+    raw = timed('decode_attendance (raw_time)', lambda: [decode_attendance(view, offset, args.record_size, users, True) for offset in offsets])
+    timed('    + epoch', lambda: [attendance.epoch for attendance in raw])
+    times = [attendance.device_time for attendance in raw]
+    timed('decode_times (list)', columnar.decode_times, times, False)
+    if columnar.numpy is not None:
+        timed('decode_times (numpy)', columnar.decode_times, times, True)
+
+
+def bench_codec(args):
+    """ record layouts: per call format strings vs precompiled codec layouts """
+    count = 100000
+    layouts = [('attendance %i' % size, layout) for size, layout in sorted(codec.ATTENDANCE.items())]
+    layouts += [('user %i' % size, layout) for size, layout in sorted(codec.USER.items())]
+    layouts += [('template header', codec.TEMPLATE), ('upload table', codec.UPLOAD_TABLE)]
+    layouts += [('event %i' % size, layout) for size, layout in sorted(codec.EVENT.items())]
+    for label, layout in layouts:
+        data = bytes(bytearray(layout.size * count))
+        fmt = layout.format
+        offsets = range(0, len(data), layout.size)
+        def format_string():
+            return [unpack_from(fmt, data, offset) for offset in offsets]
+        def precompiled():
+            unpack = layout.unpack_from
+            return [unpack(data, offset) for offset in offsets]
+        def batch():
+            return list(layout.iter_unpack(data))
+        rows = batch()
+        def encode_format_string():
+            return b''.join([pack(fmt, *row) for row in rows])
+        def encode_bulk():
+            return layout.pack_all(rows)
+        times = [min(timeit.repeat(function, number=1, repeat=3))
+                 for function in [format_string, precompiled, batch, encode_format_string, encode_bulk]]
+        print ('    {:<16} {:<18} decode {:.3f}[s] / {:.3f}[s] / iter_unpack {:.3f}[s] ({:.1f}x), encode {:.3f}[s] / {:.3f}[s] ({:.1f}x)'.format(
+            label, fmt, times[0], times[1], times[2], times[0] / times[2], times[3], times[4], times[3] / times[4]))
+
+
+def bench_directory(args):
+    """ deleting 200 users by user_id: user table per call vs session user directory """
+    for label in ['get_users per call', 'user directory']:
+        sim = simulator(args, templates=0, records=0)
+        try:
+            conn = connect(args, sim)
+            user_ids = [str(100000 + uid) for uid in range(1, min(200, args.users) + 1)]
+            if label == 'get_users per call':
+                def legacy():
+                    for user_id in user_ids:
+                        uid = [user.uid for user in conn.get_users() if user.user_id == user_id][0]
+                        conn.delete_user(uid=uid)
+                timed(label, legacy)
+            else:
+                def cached():
+                    for user_id in user_ids:
+                        conn.delete_user(user_id=user_id)
+                timed(label, cached)
+            conn.disconnect()
+        finally:
+            sim.stop()
+
+
+def bench_resume(args):
+    """ template download on a link that drops every 60% of the buffer: full retries vs resume """
+    templates = max(args.templates, 20000)
+    size = 4 + templates * (6 + 1000)
+    sim = ZKSimulator(port=0, user_packet_size=args.user_size, latency=args.latency, drop_after=int(size * 0.6))
+    sim.seed(users=min(args.users, templates), templates=templates, template_size=1000)
+    sim.start()
+    print ('--- {} templates, {:.2f}[MB], link drops after {:.2f}[MB] ---'.format(templates, size / 1e6, size * 0.6 / 1e6))
+    try:
+        for label in ['full retries', 'resume']:
+            conn = connect(args, sim)
+            inicio = time.time()
+            for attempt in range(1, 6):
+                if label == 'full retries':
+                    conn.read_checkpoint = None
+                try:
+                    fingers = conn.get_templates()
+                    print ('    {:<32} took {:.3f}[s], {} attempts, {} templates'.format(label, time.time() - inicio, attempt, len(fingers)))
+                    break
+                except ZKNetworkError:
+                    conn.reconnect()
+            else:
+                print ('    {:<32} gave up after {:.3f}[s], {} attempts'.format(label, time.time() - inicio, attempt))
+            conn.disconnect()
+    finally:
+        sim.stop()
+
+
+def bench_policy(args):
+    """ stalled device (20KB/s link): time to give up without and with a deadline, retries reported on a lossy link """
+    records = 5000
+    sim = ZKSimulator(port=0, record_size=args.record_size, latency=args.latency, bandwidth=20 * 1024)
+    sim.seed(users=10, records=records)
+    sim.start()
+    print ('--- {} records, {:.2f}[MB] at 20[KB/s] ---'.format(records, records * args.record_size / 1e6))
+    try:
+        policies = [
+            ('default policy', RetryPolicy()),
+            ('deadline 1[s] + size at 1[MB/s]', RetryPolicy(deadline=1, rate=1024 * 1024)),
+        ]
+        for label, policy in policies:
+            conn = connect(args, sim, policy=policy)
+            inicio = time.time()
+            try:
+                result = '{} records'.format(len(conn.get_attendance()))
+            except ZKErrorDeadline as e:
+                result = str(e)
+            print ('    {:<32} took {:.3f}[s], {}'.format(label, time.time() - inicio, result))
+            conn.disconnect()
+    finally:
+        sim.stop()
+    events = []
+    sim = ZKSimulator(port=0, record_size=args.record_size, latency=args.latency, error_rate=0.005)
+    sim.seed(users=10, records=args.records)
+    sim.start()
+    try:
+        conn = connect(args, sim, policy=RetryPolicy(retries=20, backoff=0.01, metrics=events.append))
+        inicio = time.time()
+        conn.get_attendance()
+        waited = sum(event['delay'] for event in events if event['event'] == 'retry')
+        print ('    {:<32} took {:.3f}[s], {} retries reported, {:.3f}[s] of backoff'.format(
+            'lossy link (0.5%/KB)', time.time() - inicio, len(events), waited))
+        conn.disconnect()
+    finally:
+        sim.stop()
+
+
+def bench_health(args):
+    """ fleet sweeps with stalled devices (answers after the timeout): no circuit breaker vs HealthTracker """
+    live, stalled, sweeps = 8, 4, 4
+    sims = [simulator(args, users=100, templates=0, records=1000) for _i in range(live)]
+    sims += [ZKSimulator(port=0, latency=3).start() for _i in range(stalled)]
+    inventory = ['127.0.0.1:%i' % sim.port for sim in sims]
+    print ('--- {} devices ({} stalled), 4 workers, timeout 1[s], {} sweeps ---'.format(live + stalled, stalled, sweeps))
+    try:
+        for label, health in [('no circuit breaker', None), ('HealthTracker', HealthTracker(threshold=1, backoff=60))]:
+            with Fleet(inventory, workers=4, health=health, timeout=1, ommit_ping=True, force_udp=args.force_udp) as fleet:
+                times = []
+                for _sweep in range(sweeps):
+                    inicio = time.time()
+                    results = list(fleet.read_sizes())
+                    times.append(time.time() - inicio)
+            print ('    {:<32} sweeps {} [s], {} ok'.format(label, ' '.join('{:.3f}'.format(t) for t in times),
+                                                         len([result for result in results if result.ok])))
+    finally:
+        for sim in sims:
+            sim.stop()
+
+
+BENCHMARKS = [
+    ('scale', bench_scale),
+    ('checksum', bench_checksum),
+    ('memory', bench_memory),
+    ('columnar', bench_columnar),
+    ('join', bench_join),
+    ('since', bench_since),
+    ('stream', bench_stream),
+    ('fleet', bench_fleet),
+    ('pool', bench_pool),
+    ('pipeline', bench_pipeline),
+    ('adaptive', bench_adaptive),
+    ('upload', bench_upload),
+    ('provision', bench_provision),
+    ('restore', bench_restore),
+    ('backup', bench_backup),
+    ('reconcile', bench_reconcile),
+    ('fingers', bench_fingers),
+    ('records', bench_records),
+    ('timestamps', bench_timestamps),
+    ('codec', bench_codec),
+    ('directory', bench_directory),
+    ('resume', bench_resume),
+    ('policy', bench_policy),
+    ('health', bench_health),
+]
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    names = args.benchmarks or [name for name, _bench in BENCHMARKS]
+    for name, bench in BENCHMARKS:
+        if name in names:
+            print ('=== {}: {}'.format(name, bench.__doc__.strip()))
+            bench(args)
@@ -20,5 +20,8 @@ setup(
         'security'
     ],
     install_requires=['future'],
+    extras_require={
+        'numpy': ['numpy'],
+    },
     zip_safe=False
 )
\ No newline at end of file
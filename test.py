@@ -5,6 +5,13 @@ import sys
 import os
 import unittest
 import codecs
+import pickle
+import calendar
+import tempfile
+import time
+from datetime import datetime, timedelta
+from socket import error as socket_error
+from struct import pack, unpack
 
 if sys.version_info[0] < 3:
     from mock import patch, Mock, MagicMock
@@ -14,11 +21,22 @@ else:
 mock_socket = MagicMock(name='zk.socket')
 sys.modules['zk.socket'] = mock_socket
 from zk import ZK, const
-from zk.base import ZK_helper
-from zk.user import User
+from zk.base import ZK_helper, create_checksum
+from zk.protocol import encode_time, decode_device_time, decode_user
+from zk import codec
+from zk.user import User, UserDirectory
 from zk.finger import Finger
-from zk.attendance import Attendance
-from zk.exception import ZKErrorResponse, ZKNetworkError
+from zk.attendance import Attendance, AttendanceCursor
+from zk.exception import ZKError, ZKErrorCircuitOpen, ZKErrorDeadline, ZKErrorResponse, ZKNetworkError
+from zk.simulator import ZKSimulator
+from zk import columnar
+from zk.fleet import Fleet
+from zk.pool import ZKPool
+from zk.health import HealthTracker
+from zk.tuner import ChunkTuner
+from zk.policy import RetryPolicy
+from zk.backup import Backup, BackupWriter, backup, restore
+from zk import provision
 
 try:
     unittest.TestCase.assertRaisesRegex
@@ -48,6 +66,31 @@ def dump(obj, nested_level=0, output=sys.stdout):
         print >> output, '%s%s' % (nested_level * spacing, obj)
 
 
+def mock_recv(socket, packets):
+    """
+    serve canned packets to recv (one packet per call) and recv_into
+    (as a byte stream, up to the requested size)
+    """
+    pending = [bytearray(packet) for packet in packets]
+
+    def recv(size):
+        while pending and not pending[0]:
+            pending.pop(0)
+        data = bytes(pending.pop(0))
+        return data
+
+    def recv_into(view, size=0):
+        while pending and not pending[0]:
+            pending.pop(0)
+        size = min(size or len(view), len(pending[0]))
+        view[:size] = pending[0][:size]
+        del pending[0][:size]
+        return size
+
+    socket.return_value.recv.side_effect = recv
+    socket.return_value.recv_into.side_effect = recv_into
+
+
 class PYZKTest(unittest.TestCase):
     def setup(self):
 
@@ -56,6 +99,37 @@ class PYZKTest(unittest.TestCase):
     def tearDown(self):
         pass
 
+    def test_checksum(self):
+        """ linear checksum, odd and even sizes """
+        self.assertEqual(create_checksum(codecs.decode('e80300000000feff', 'hex')), 0xfc17)
+        self.assertEqual(create_checksum(b'\x01\x02\x03\x04\x05'), 63989)
+        self.assertEqual(create_checksum(memoryview(b'\xff' * 7)), 65279)
+        self.assertEqual(create_checksum(b''), 65534)
+
+    def test_user_directory(self):
+        """ uid and user_id index, first user wins """
+        users = UserDirectory([User(1, 'A', 0, user_id='10'), User(2, 'B', 0, user_id='20'), User(3, 'C', 0, user_id='10')])
+        self.assertEqual(len(users), 3)
+        self.assertEqual(users.get_by_uid(2).name, 'B')
+        self.assertEqual(users.get_by_user_id(10).name, 'A')
+        self.assertIsNone(users.get_by_uid(4))
+        self.assertIsNone(users.get_by_user_id('30'))
+
+    def test_codec_layouts(self):
+        """ record sizes, batch decode and bulk encode """
+        self.assertEqual([codec.ATTENDANCE[size].size for size in [8, 16, 40]], [8, 16, 40])
+        self.assertEqual([codec.USER[size].size for size in [28, 72]], [28, 72])
+        self.assertEqual([codec.USER_UPLOAD[size].size for size in [29, 73]], [29, 73])
+        self.assertEqual([codec.EVENT[size].size for size in [12, 32, 36, 52]], [12, 32, 36, 52])
+        rows = [(2, 1, 0x10, 0), (2, 1, 0x11, 600), (2, 7, 0x10, 1200)]
+        data = codec.UPLOAD_TABLE.pack_all(rows)
+        self.assertEqual(data, b''.join(pack('<bHbI', *row) for row in rows))
+        self.assertEqual(list(codec.UPLOAD_TABLE.iter_unpack(data + b'\x02\x01')), rows) # partial record ignored
+        self.assertEqual(list(codec.UPLOAD_TABLE.iter_unpack(data, codec.UPLOAD_TABLE.size)), rows[1:])
+        user = User(5, 'Name', 14, '123', '1', '4242', 77)
+        self.assertEqual(len(user.repack29()), 29)
+        self.assertEqual(decode_user(user.repack73(), 1, 72).json_pack(), dict(user.json_pack(), group_id='1'))
+
     @patch('zk.base.socket')
     @patch('zk.base.ZK_helper')
     def test_no_ping(self,helper, socket):
@@ -229,7 +303,7 @@ class PYZKTest(unittest.TestCase):
         """ test case for K20 """
         helper.return_value.test_ping.return_value = True # ping simulated
         helper.return_value.test_tcp.return_value = 0 # helper tcp ok
-        socket.return_value.recv.side_effect = [
+        mock_recv(socket, [
             codecs.decode('5050827d08000000d007d7d758200000','hex'), #ACK Ok
             codecs.decode('5050827d58000000d0074c49582013000000000000000000000000000000000002000000000000000000000000000000000000000000000007000000000000000000000000000000f4010000f401000050c30000f4010000f201000050c30000','hex'),#Sizes
             codecs.decode('5050827d9c000000dd053c87582015009000000001000000000000000000006366756c616e6f0000000000000000000000000000000000000000000000000000000000003130303030316c70000000000000000000000000000000000200000000000000000000726d656e67616e6f0000000000000000000000000000000000','hex'),#DATA112
@@ -238,7 +312,7 @@ class PYZKTest(unittest.TestCase):
             codecs.decode('5050827d08000000d00745b2cf451b00', 'hex'),  # CMD_ACK_OK for get_users TODO: generate proper sequenced response
             codecs.decode('5050827d08000000d00745b2cf451b00', 'hex'),  # CMD_ACK_OK for free_data TODO: generate proper sequenced response
             codecs.decode('5050827d08000000d00745b2cf451b00', 'hex'),  # CMD_ACK_OK for exit      TODO: generate proper sequenced response
-        ]
+        ])
         #begin
         zk = ZK('192.168.1.201') #, verbose=True)
         conn = zk.connect()
@@ -266,7 +340,7 @@ class PYZKTest(unittest.TestCase):
         """ tst case for https://github.com/fananimi/pyzk/pull/18#issuecomment-406250746 """
         helper.return_value.test_ping.return_value = True # ping simulated
         helper.return_value.test_tcp.return_value = 0 # helper tcp ok
-        socket.return_value.recv.side_effect = [
+        mock_recv(socket, [
             codecs.decode('5050827d09000000d007babb5c3c100009', 'hex'), # tcp CMD_ACK_OK
             codecs.decode('5050827d58000000d007292c5c3c13000000000000000000000000000000000046000000000000004600000000000000990c0000000000001a010000000000000600000006000000f4010000f401000050c30000ae010000ae010000b7b60000', 'hex'), #sizes
             codecs.decode('5050827d15000000d007a7625c3c150000b4130000b4130000cdef2300','hex'), #PREPARE_BUFFER -> OK 5044
@@ -309,7 +383,7 @@ class PYZKTest(unittest.TestCase):
             codecs.decode('5050827d08000000d00745b2cf451b00', 'hex'),  # CMD_ACK_OK for get_users TODO: generate proper sequenced response
             codecs.decode('5050827d08000000d00745b2cf451b00', 'hex'),  # CMD_ACK_OK for free_data TODO: generate proper sequenced response
             codecs.decode('5050827d08000000d00745b2cf451b00', 'hex'),  # CMD_ACK_OK for exit      TODO: generate proper sequenced response
-        ]
+        ])
         #begin
         zk = ZK('192.168.1.201') # , verbose=True)
         conn = zk.connect()
@@ -402,7 +476,7 @@ class PYZKTest(unittest.TestCase):
         """ cchekc correct template 1 fixed"""
         helper.return_value.test_ping.return_value = True # ping simulated
         helper.return_value.test_tcp.return_value = 0 # helper tcp ok
-        socket.return_value.recv.side_effect = [
+        mock_recv(socket, [
             codecs.decode('5050827d08000000d0075fb2cf450100', 'hex'), # tcp CMD_ACK_OK
             codecs.decode('5050827d10000000dc055558d0983200dc040000f0030000', 'hex'), # tcp PREPARE_DATA 1244
             codecs.decode('5050827df8030000dd0500f4000032004d9853533231000004dbda0408050709ced000001cda69010000008406316adb0c0012062900d000aad221001600390caf001cdbb106240031007e033bdb3b00e9067700850083d42b004300c503f40043dbd6037b005000460ea7db5900910f90009f0012d5e7005c00970a5f006ddb930fa1009a00560f86db9d00820e86006f007dd3f400ab00a60fcd01b7dbb00b4b00bd0079083adbc00045035d000600c1df7300cc0039049e00dddb380e8c00da00e30dd8dbdc00220e130027004dd9f500e3009d0a6a00e9db26090001ef00ea03c5dbf0002306', 'hex'), # DATA (tcp 1016, actual 112 +104
@@ -415,7 +489,7 @@ class PYZKTest(unittest.TestCase):
             codecs.decode('07283b590300fef3f5f800da10f5494b031000071819061035084365650b14900834c0c1c4c104c1c5a302100e1134c1c01045c83c8806110e2185c22edd11082424fec006ff02cb052834c3c073c910d4eb965b3833ff0bc582cce18d876a051106f337f826c00410013d2b05c200ca003f4cfeff03d56454ccc101', 'hex'),  # raw 124
             codecs.decode('5050827d08000000d007fcf701003200', 'hex'),  # tcp CMD_ACK_OK
             codecs.decode('5050827d08000000d00745b2cf451b00', 'hex'),  # tcp random CMD_ACK_OK TODO: generate proper sequenced response
-        ]
+        ])
         #begin
         zk = ZK('192.168.1.201') #, verbose=True)
         conn = zk.connect()
@@ -432,7 +506,7 @@ class PYZKTest(unittest.TestCase):
         """ cchekc correct template 2 fixed"""
         helper.return_value.test_ping.return_value = True # ping simulated
         helper.return_value.test_tcp.return_value = 0 # helper tcp ok
-        socket.return_value.recv.side_effect = [
+        mock_recv(socket, [
             codecs.decode('5050827d08000000d0075fb2cf450100', 'hex'), # tcp CMD_ACK_OK
             codecs.decode('5050827d10000000dc053b59d0983500f3030000f0030000', 'hex'), # tcp PREPARE_DATA 1011
             codecs.decode('5050827df8030000dd056855000035004ab153533231000003f2f10408050709ced000001bf36901000000831f256cf23e00740f4c008900f2f879005500fe0fe3005bf2d30a60005c00a00f32f26600580a2700ad00e3fd98007500800f000082f21a0f68008300300e5bf28d00570930004b00dafd4c009a00dd090900a8f2270f8600ad008a0b1ff2b000480f4400730040fc5400b800430f4400c6f2370ab100ca00f30ecbf2cb002f0f4a001300c7fdaa00e400b50c4300e6f2b706bf00ea00f90668f2f2002e0dad003000b7f7cf00f600350cbe0008f31f0dd0000c017101cbf20f019c01', 'hex'), # DATA (tcp 1016, actual 112 +104
@@ -445,7 +519,7 @@ class PYZKTest(unittest.TestCase):
 
             codecs.decode('5050827d08000000d007fcf701003200', 'hex'),  # tcp CMD_ACK_OK
             codecs.decode('5050827d08000000d00745b2cf451b00', 'hex'),  # tcp random CMD_ACK_OK TODO: generate proper sequenced response
-        ]
+        ])
         #begin
         zk = ZK('192.168.1.201')#, verbose=True)
         conn = zk.connect()
@@ -510,5 +584,715 @@ class PYZKTest(unittest.TestCase):
             self.assertEqual(att.user_id, "1140064", "incorrect user_id %s" % att.user_id)
         conn.disconnect()
 
+
+class SimulatorTest(unittest.TestCase):
+    """ real sockets against the local device simulator """
+
+    def connect(self, sim, **kwargs):
+        zk = ZK('127.0.0.1', port=sim.port, timeout=5, ommit_ping=True, **kwargs)
+        return zk.connect()
+
+    def test_tcp_bulk_read(self):
+        with ZKSimulator(port=0).seed(users=300, templates=200, records=3000) as sim:
+            conn = self.connect(sim)
+            users = conn.get_users()
+            self.assertEqual(len(users), 300)
+            self.assertEqual(users[4].user_id, "100005")
+            self.assertEqual(len(conn.get_templates()), 200)
+            attendances = conn.get_attendance()
+            self.assertEqual(len(attendances), 3000)
+            self.assertEqual(attendances[1].user_id, "100002")
+            conn.disconnect()
+
+    @unittest.skipIf(sys.version_info[0] < 3, "templates are bytes on python 2")
+    def test_templates_are_views(self):
+        with ZKSimulator(port=0).seed(users=30, templates=20, template_size=300) as sim:
+            conn = self.connect(sim)
+            templates = conn.get_templates()
+            self.assertEqual(len(templates), 20)
+            self.assertIsInstance(templates[0].template, memoryview)
+            self.assertIs(templates[0].template.obj, templates[-1].template.obj) # same buffer
+            self.assertEqual(templates[3].size, 300)
+            self.assertEqual(templates[3].mark, codecs.encode(bytes(templates[3].template[:8]), 'hex') + b'...' + codecs.encode(bytes(templates[3].template[-8:]), 'hex'))
+            self.assertEqual(templates, list(conn.iter_templates()))
+            self.assertEqual(Finger.json_unpack(templates[3].json_pack()), templates[3])
+            self.assertNotEqual(templates[3], templates[4])
+            self.assertFalse(hasattr(templates[3], '__dict__'))
+            conn.disconnect()
+
+    def test_pickle_templates(self):
+        with ZKSimulator(port=0).seed(users=30, templates=20, template_size=300) as sim:
+            conn = self.connect(sim)
+            templates = conn.get_templates()
+            for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+                copy = pickle.loads(pickle.dumps(templates[3], protocol))
+                self.assertIsInstance(copy.template, bytes) # detached from the download buffer
+                self.assertEqual(copy, templates[3])
+            conn.disconnect()
+
+    def test_slotted_records(self):
+        with ZKSimulator(port=0).seed(users=30, records=100) as sim:
+            conn = self.connect(sim)
+            users = conn.get_users()
+            attendances = conn.get_attendance()
+            self.assertFalse(hasattr(users[0], '__dict__'))
+            self.assertFalse(hasattr(attendances[0], '__dict__'))
+            user = users[4]
+            self.assertEqual(User(user.uid, user.name, user.privilege, user.password, user.group_id, user.user_id, user.card).json_pack(), user.json_pack())
+            self.assertEqual(User.json_unpack(user.json_pack()).repack73(), user.repack73())
+            self.assertEqual(attendances[1].user_id, users[1].user_id)
+            self.assertEqual(attendances[1].uid, users[1].uid)
+            conn.disconnect()
+
+    def test_user_directory_cache(self):
+        with ZKSimulator(port=0).seed(users=50, records=100) as sim:
+            downloads = []
+            pack_users = sim.pack_users
+            def counted():
+                downloads.append(1)
+                return pack_users()
+            sim.pack_users = counted
+            conn = self.connect(sim)
+            self.assertEqual(len(conn.get_attendance()), 100)
+            for user_id in ['100010', '100011', '100012', 'missing']:
+                conn.delete_user(user_id=user_id)
+            self.assertEqual(len(downloads), 1) # one download for the whole session
+            self.assertNotIn(10, sim.users)
+            self.assertIsNone(conn.get_user_directory().get_by_user_id('100011'))
+            conn.set_user(uid=70, name='New', user_id='7070')
+            conn.set_users([User(71, 'Bulk', 0, user_id='7171')])
+            self.assertEqual(conn.get_user_directory().get_by_uid(70).name, 'New')
+            self.assertEqual(conn.get_user_directory().get_by_user_id('7171').uid, 71)
+            self.assertFalse(conn.get_user_template(0, 0, '100010')) # deleted, found in the cache
+            self.assertEqual(len(downloads), 1)
+            sim.set_user(80, 'Elsewhere', user_id='8080') # changed by another client: counters differ
+            self.assertEqual(conn.get_user_directory().get_by_uid(80).name, 'Elsewhere')
+            self.assertEqual(len(downloads), 2)
+            directory = UserDirectory([User(1, 'Given', 0, user_id='100001')])
+            self.assertEqual(conn.get_attendance(directory=directory)[0].uid, 1)
+            self.assertEqual(len(downloads), 2)
+            conn.clear_data()
+            self.assertEqual(len(conn.get_user_directory()), 0)
+            self.assertEqual(len(downloads), 2)
+            conn.disconnect()
+
+    def test_udp_bulk_read_zk6(self):
+        with ZKSimulator(port=0, user_packet_size=28, record_size=8).seed(users=100, records=500) as sim:
+            conn = self.connect(sim, force_udp=True)
+            self.assertEqual(len(conn.get_users()), 100)
+            attendances = conn.get_attendance()
+            self.assertEqual(len(attendances), 500)
+            self.assertEqual(attendances[2].user_id, "100003")
+            self.assertEqual(attendances[2].uid, 3)
+            conn.disconnect()
+
+    def test_get_user_template(self):
+        with ZKSimulator(port=0).seed(users=10, templates=20, template_size=1500) as sim:
+            for force_udp in [False, True]:
+                conn = self.connect(sim, force_udp=force_udp)
+                template = conn.get_user_template(3, 1)
+                self.assertEqual(template.size, 1500)
+                self.assertEqual(template.template, sim.templates[(3, 1)][1])
+                self.assertIsNone(conn.get_user_template(3, 5))
+                conn.disconnect()
+
+    def test_attendance_columns(self):
+        for record_size in [8, 16, 40]:
+            with ZKSimulator(port=0, record_size=record_size).seed(users=30, records=100) as sim:
+                conn = self.connect(sim)
+                attendances = conn.get_attendance()
+                for use_numpy in [False, True] if columnar.numpy else [False]:
+                    columns = conn.get_attendance_columns(use_numpy=use_numpy)
+                    self.assertEqual(len(columns['timestamp']), 100)
+                    self.assertEqual(int(columns['timestamp'][99]), calendar.timegm(attendances[99].timestamp.timetuple()))
+                    self.assertEqual(int(columns['status'][5]), attendances[5].status)
+                    self.assertEqual(int(columns['punch'][5]), attendances[5].punch)
+                    if record_size == 8:
+                        self.assertEqual(int(columns['uid'][7]), attendances[7].uid)
+                    else:
+                        self.assertEqual(str(columns['user_id'][7]), attendances[7].user_id)
+                conn.disconnect()
+        with ZKSimulator(port=0).seed(users=30, records=100) as sim:
+            sim.records = 90 # count behind the buffer: 44 bytes per record, read as 40
+            conn = self.connect(sim)
+            attendances = conn.get_attendance()
+            self.assertEqual(len(attendances), 100)
+            for use_numpy in [False, True] if columnar.numpy else [False]:
+                columns = conn.get_attendance_columns(use_numpy=use_numpy)
+                self.assertEqual(len(columns['timestamp']), 100)
+                self.assertEqual(int(columns['timestamp'][99]), calendar.timegm(attendances[99].timestamp.timetuple()))
+            conn.disconnect()
+
+    def test_raw_time(self):
+        for record_size in [8, 16, 40]:
+            with ZKSimulator(port=0, record_size=record_size).seed(users=30, records=100) as sim:
+                conn = self.connect(sim)
+                attendances = conn.get_attendance()
+                raw = conn.get_attendance(raw_time=True)
+                self.assertIsNone(raw[42]._timestamp) # not built yet
+                self.assertEqual(raw[42].device_time, attendances[42].device_time)
+                self.assertEqual(raw[42].epoch, calendar.timegm(attendances[42].timestamp.timetuple()))
+                self.assertEqual([a.timestamp for a in raw], [a.timestamp for a in attendances])
+                self.assertEqual(raw[42]._timestamp, attendances[42].timestamp) # cached
+                since, _cursor = conn.get_attendance_since(raw_time=True)
+                self.assertEqual(since[99].timestamp, attendances[99].timestamp)
+                conn.disconnect()
+        timestamps = [datetime(2000, 1, 1), datetime(2024, 2, 29, 23, 59, 59), datetime(2099, 12, 31, 12, 30, 1)]
+        for use_numpy in [False, True] if columnar.numpy else [False]:
+            values = columnar.encode_times(timestamps, use_numpy)
+            self.assertEqual([int(value) for value in values], [encode_time(t) for t in timestamps])
+            self.assertEqual(list(columnar.decode_times(values, use_numpy)), [columnar.numpy.datetime64(t) for t in timestamps] if use_numpy else timestamps)
+        self.assertEqual(columnar.epoch_to_device(columnar.device_to_epoch(123456789)), 123456789)
+        february_31 = ((24 * 12 + 1) * 31 + 30) * 86400 # not a date: both paths raise
+        self.assertRaises(ValueError, decode_device_time, february_31)
+        self.assertRaises(ValueError, columnar.device_to_datetime, february_31)
+        self.assertRaises(ValueError, getattr, Attendance.fast('1', None, 1, 0, 1, february_31), 'timestamp')
+
+    def test_resumable_read(self):
+        with ZKSimulator(port=0, drop_after=70000).seed(users=100, templates=200, template_size=1000) as sim:
+            expected = [(uid, fid, template) for (uid, fid), (_valid, template) in sorted(sim.templates.items())]
+            conn = self.connect(sim)
+            calls = 0
+            while True: # every session reads one chunk before the link drops
+                calls += 1
+                try:
+                    templates = conn.get_templates()
+                    break
+                except ZKNetworkError:
+                    self.assertEqual(conn.read_checkpoint.offset, 65472 * calls)
+                    conn.reconnect()
+            self.assertEqual(calls, 4)
+            self.assertIsNone(conn.read_checkpoint)
+            self.assertEqual([(t.uid, t.fid, bytes(t.template)) for t in templates], expected)
+            conn.disconnect()
+            conn = self.connect(sim, resume=5) # reconnects by itself
+            self.assertEqual([(t.uid, t.fid, bytes(t.template)) for t in conn.get_templates()], expected)
+            self.assertEqual([(t.uid, t.fid, bytes(t.template)) for t in conn.iter_templates()], expected)
+            conn.disconnect()
+            conn = self.connect(sim)
+            self.assertRaises(ZKNetworkError, conn.get_templates)
+            sim.templates[(1, 9)] = [1, b'\x01' * 1000] # the device buffer changed: read again from 0
+            conn.reconnect()
+            self.assertRaises(ZKNetworkError, conn.get_templates)
+            self.assertEqual(conn.read_checkpoint.offset, 65472)
+            self.assertEqual(conn.read_checkpoint.size, 4 + 201 * 1006)
+
+    def test_retry_policy(self):
+        policy = RetryPolicy(backoff=0.1, max_backoff=0.3, jitter=0)
+        self.assertEqual([policy.delay(retry) for retry in [1, 2, 3, 4]], [0.1, 0.2, 0.3, 0.3])
+        events = []
+        policy = RetryPolicy(retries=50, backoff=0.001, metrics=events.append)
+        with ZKSimulator(port=0, error_rate=0.01).seed(users=10, records=20000) as sim: # 13 chunks of 64KB
+            conn = self.connect(sim, policy=policy)
+            self.assertEqual(len(conn.get_attendance()), 20000)
+            retries = [event for event in events if event['event'] == 'retry']
+            self.assertTrue(retries)
+            self.assertEqual(retries[0]['operation'], 'read chunk')
+            self.assertGreaterEqual(retries[0]['attempt'], 2)
+            self.assertLessEqual(retries[0]['delay'], 0.0015)
+            conn.disconnect()
+        del events[:]
+        with ZKSimulator(port=0, bandwidth=100 * 1024).seed(users=10, records=5000) as sim: # 200KB: 2[s]
+            conn = self.connect(sim, policy=RetryPolicy(deadline=0.3, rate=10 * 1024 * 1024, metrics=events.append))
+            inicio = time.time()
+            self.assertRaises(ZKErrorDeadline, conn.get_attendance)
+            self.assertLess(time.time() - inicio, 1.5)
+            self.assertEqual(events[-1]['event'], 'deadline')
+            self.assertEqual(events[-1]['operation'], 'get_attendance')
+            self.assertIsNone(conn.deadline)
+            conn.reconnect()
+            conn.policy = RetryPolicy(deadline=0.3, rate=50 * 1024) # scaled with the size: 0.3 + 4[s]
+            self.assertEqual(len(conn.get_attendance()), 5000)
+            conn.disconnect()
+
+    def test_iter_records(self):
+        with ZKSimulator(port=0).seed(users=500, templates=300, records=5000, template_size=777) as sim:
+            for force_udp in [False, True]:
+                conn = self.connect(sim, force_udp=force_udp)
+                users = list(conn.iter_users())
+                self.assertEqual(len(users), 500)
+                self.assertEqual(users[-1].user_id, "100500")
+                self.assertEqual(conn.next_uid, 501)
+                templates = list(conn.iter_templates())
+                self.assertEqual(len(templates), 300)
+                self.assertEqual(templates[-1].template, sim.templates[(templates[-1].uid, templates[-1].fid)][1])
+                attendances = conn.iter_attendance()
+                first = next(attendances)
+                self.assertEqual(first.user_id, "100001")
+                attendances.close() # stop early, buffer is freed
+                attendances = list(conn.iter_attendance())
+                self.assertEqual(len(attendances), 5000)
+                self.assertEqual(attendances[4321].timestamp, datetime(2018, 1, 1, 8, 0, 0) + timedelta(minutes=4321))
+                self.assertEqual(conn.get_attendance()[4321].user_id, attendances[4321].user_id)
+                conn.disconnect()
+
+    def test_pipelined_read(self):
+        with ZKSimulator(port=0).seed(users=10, records=20000) as sim:
+            for force_udp in [False, True]:
+                conn = self.connect(sim, force_udp=force_udp)
+                serial, size = conn.read_with_buffer(const.CMD_ATTLOG_RRQ)
+                conn.pipeline = 4
+                pipelined, size = conn.read_with_buffer(const.CMD_ATTLOG_RRQ)
+                self.assertEqual(pipelined, serial)
+                self.assertEqual(len(list(conn.iter_attendance())), 20000)
+                self.assertEqual(conn.pipeline, 4)
+                conn.disconnect()
+
+    def test_pipelined_read_rejected(self):
+        with ZKSimulator(port=0, pipeline=False).seed(users=10, records=20000) as sim:
+            for force_udp in [False, True]:
+                conn = self.connect(sim, force_udp=force_udp, pipeline=4)
+                attendances = conn.get_attendance()
+                self.assertEqual(len(attendances), 20000)
+                self.assertEqual(attendances[-1].timestamp, datetime(2018, 1, 1, 8, 0, 0) + timedelta(minutes=19999))
+                self.assertEqual(conn.pipeline, 0) # serial from now
+                self.assertEqual(len(conn.get_attendance()), 20000)
+                conn.disconnect()
+
+    def test_pipelined_read_delayed(self):
+        with ZKSimulator(port=0).seed(users=10, records=20000) as sim:
+            expected, size = self.connect(sim).read_with_buffer(const.CMD_ATTLOG_RRQ)
+        for force_udp in [False, True]: # late answer within one more timeout: used
+            with ZKSimulator(port=0, delays={2: 1.5}).seed(users=10, records=20000) as sim:
+                conn = ZK('127.0.0.1', port=sim.port, timeout=1, ommit_ping=True, force_udp=force_udp, pipeline=4).connect()
+                data, size = conn.read_with_buffer(const.CMD_ATTLOG_RRQ)
+                self.assertEqual(data, expected)
+                self.assertEqual(conn.pipeline, 4) # still pipelined
+                self.assertEqual(conn.read_with_buffer(const.CMD_ATTLOG_RRQ)[0], expected)
+                conn.disconnect()
+        for resume in [0, 1]: # answers lost for the drain too
+            with ZKSimulator(port=0, delays={2: 3, 3: 2.5}).seed(users=10, records=20000) as sim:
+                conn = ZK('127.0.0.1', port=sim.port, timeout=1, ommit_ping=True, pipeline=4, resume=resume).connect()
+                if not resume:
+                    self.assertRaises(ZKNetworkError, conn.read_with_buffer, const.CMD_ATTLOG_RRQ)
+                    conn.reconnect() # late answers die with the old link
+                self.assertEqual(conn.read_with_buffer(const.CMD_ATTLOG_RRQ)[0], expected)
+                conn.disconnect()
+
+    def test_adaptive_chunks(self):
+        with ZKSimulator(port=0, error_rate=0.02).seed(users=10, records=20000) as sim:
+            for force_udp in [False, True]:
+                conn = self.connect(sim, force_udp=force_udp, adaptive=True)
+                attendances = conn.get_attendance()
+                self.assertEqual(len(attendances), 20000)
+                self.assertEqual(attendances[-1].timestamp, datetime(2018, 1, 1, 8, 0, 0) + timedelta(minutes=19999))
+                self.assertTrue(any(size < conn.chunk_tuner.maximum for size in conn.chunk_tuner.stats)) # shrunk
+                self.assertTrue(any(stats[3] for stats in conn.chunk_tuner.stats.values()))
+                best = ChunkTuner.devices[('127.0.0.1', sim.port, not force_udp)]
+                self.assertEqual(best, conn.chunk_tuner.best)
+                conn.disconnect()
+                conn = self.connect(sim, force_udp=force_udp, adaptive=True)
+                self.assertEqual(conn.chunk_tuner.size, best) # remembered
+                conn.disconnect()
+
+    def test_chunk_tuner(self):
+        tuner = ChunkTuner(minimum=1024, maximum=8192, grow_after=2)
+        tuner.record(8192, 0.1, False)
+        self.assertEqual(tuner.size, 4096)
+        tuner.record(4096, 0.01, True)
+        tuner.record(1000, 0.01, True) # short chunk, not measured
+        tuner.record(4096, 0.01, True)
+        self.assertEqual(tuner.size, 8192) # 8192 measured less than grow_after times
+        self.assertNotIn(1000, tuner.stats)
+        tuner.record(8192, 0.1, False)
+        tuner.record(4096, 0.01, True)
+        tuner.record(4096, 0.01, True)
+        self.assertEqual(tuner.size, 4096) # 8192 measured slower
+        self.assertEqual(tuner.best, 4096)
+
+    def test_attendance_since(self):
+        for record_size, force_udp in [(40, False), (16, True), (8, False)]:
+            with ZKSimulator(port=0, record_size=record_size).seed(users=30, records=3000) as sim:
+                conn = self.connect(sim, force_udp=force_udp)
+                attendances, cursor = conn.get_attendance_since()
+                self.assertEqual(len(attendances), 3000)
+                self.assertEqual(cursor.records, 3000)
+                self.assertEqual(cursor.record_size, record_size)
+                attendances, cursor = conn.get_attendance_since(cursor)
+                self.assertEqual(attendances, [])
+                sim.add_attendance(5, datetime(2019, 2, 3, 10, 20, 30), status=1, punch=1)
+                sim.add_attendance(6, datetime(2019, 2, 3, 10, 21, 0))
+                attendances, cursor = conn.get_attendance_since(AttendanceCursor.json_unpack(cursor.json_pack()))
+                self.assertEqual(len(attendances), 2)
+                self.assertEqual(attendances[0].timestamp, datetime(2019, 2, 3, 10, 20, 30))
+                self.assertEqual(attendances[0].punch, 1)
+                self.assertEqual(attendances[1].uid if record_size == 8 else attendances[1].user_id,
+                                 6 if record_size == 8 else "100006")
+                self.assertEqual(cursor.records, 3002)
+                conn.clear_attendance()
+                sim.add_attendance(7, datetime(2019, 3, 1, 8, 0, 0))
+                attendances, cursor = conn.get_attendance_since(cursor)
+                self.assertEqual(len(attendances), 1) # cursor mismatch, full read
+                self.assertEqual(cursor.records, 1)
+                conn.disconnect()
+
+    def test_iter_frees_buffer(self):
+        with ZKSimulator(port=0, drop_after=20000).seed(users=10, records=3000) as sim:
+            conn = self.connect(sim)
+            conn.free_data = Mock(side_effect=ZKErrorResponse("can't free data"))
+            self.assertRaises(ZKNetworkError, list, conn.iter_attendance()) # the error of the read
+            self.assertEqual(conn.free_data.call_count, 1)
+        with ZKSimulator(port=0).seed(users=10, records=3000) as sim:
+            conn = self.connect(sim)
+            conn.free_data = Mock(wraps=conn.free_data)
+            for attendance in conn.iter_attendance():
+                break
+            self.assertEqual(conn.free_data.call_count, 1) # stopped early
+            self.assertEqual(len(list(conn.iter_attendance())), 3000)
+            self.assertEqual(conn.free_data.call_count, 2)
+            conn.free_data.side_effect = ZKErrorResponse("can't free data")
+            self.assertRaises(ZKErrorResponse, list, conn.iter_attendance()) # raised after a complete read
+            conn.disconnect()
+
+    def test_attendance_since_frees_buffer(self):
+        with ZKSimulator(port=0).seed(users=30, records=3000) as sim:
+            conn = self.connect(sim)
+            with patch.object(sim, 'handle', wraps=sim.handle) as handle:
+                commands = lambda: [call[0][1] for call in handle.call_args_list]
+                chunks = lambda: [unpack('<ii', bytes(call[0][3]))[1] for call in handle.call_args_list if call[0][1] == 1504]
+                attendances, cursor = conn.get_attendance_since() # full read
+                self.assertEqual(len(attendances), 3000)
+                self.assertEqual(commands()[-1], const.CMD_FREE_DATA)
+                handle.reset_mock()
+                sim.add_attendance(5, datetime(2019, 2, 3, 10, 20, 30))
+                attendances, cursor = conn.get_attendance_since(cursor) # tail
+                self.assertEqual(len(attendances), 1)
+                self.assertEqual(commands()[-1], const.CMD_FREE_DATA)
+                conn.clear_attendance()
+                for i in range(2000):
+                    sim.add_attendance(7, datetime(2019, 3, 1, 8, 0, 0) + timedelta(minutes=i))
+                handle.reset_mock()
+                attendances, cursor = conn.get_attendance_since(cursor) # mismatch: head read, tail kept
+                self.assertEqual(len(attendances), 2000)
+                self.assertEqual(attendances[-1].timestamp, datetime(2019, 3, 1, 8, 0, 0) + timedelta(minutes=1999))
+                self.assertEqual(commands()[-1], const.CMD_FREE_DATA)
+                self.assertEqual(sum(chunks()), 4 + 2000 * 40) # each byte downloaded once
+            conn.disconnect()
+
+    def test_auth(self):
+        with ZKSimulator(port=0, password=45) as sim:
+            self.assertRaisesRegex(ZKErrorResponse, "Unauthenticated", self.connect, sim, password=12)
+            conn = self.connect(sim, password=45)
+            self.assertTrue(conn.is_connect)
+            conn.disconnect()
+
+    def test_save_user_template(self):
+        with ZKSimulator(port=0) as sim:
+            conn = self.connect(sim)
+            user = User(7, 'Seven', const.USER_DEFAULT, '', '', '700', 0)
+            finger = Finger(7, 3, 1, b'\x01\x02' * 300)
+            conn.save_user_template(user, [finger])
+            self.assertEqual(sim.users[7][6], '700')
+            self.assertEqual(conn.get_templates(), [finger])
+            conn.disconnect()
+
+    def test_set_users(self):
+        for user_packet_size in [28, 72]:
+            with ZKSimulator(port=0, user_packet_size=user_packet_size) as sim:
+                conn = self.connect(sim, force_udp=user_packet_size == 28)
+                users = [User(uid, 'User %i' % uid, const.USER_DEFAULT, '', '', str(5000 + uid), 0) for uid in range(1, 301)]
+                users[9].privilege = const.USER_ADMIN
+                users[10].user_id = ''
+                duplicated = User(5, 'Again', const.USER_DEFAULT, '', '', '9999', 0)
+                broken = User(70000, 'Too big', const.USER_DEFAULT, '', '', '70000', 0)
+                failures = conn.set_users(users + [duplicated, broken])
+                self.assertEqual([user for user, _error in failures], [duplicated, broken])
+                self.assertEqual(failures[0][1], "duplicated uid")
+                saved = conn.get_users()
+                self.assertEqual(len(saved), 300)
+                self.assertEqual(saved[4].user_id, '5005')
+                self.assertEqual(saved[9].privilege, const.USER_ADMIN)
+                self.assertEqual(saved[10].user_id, '11')
+                self.assertEqual(saved[299].name, 'User 300')
+                conn.disconnect()
+
+    def test_set_users_rejected(self):
+        with ZKSimulator(port=0) as sim:
+            sim.users_cap = 250
+            conn = self.connect(sim)
+            users = [User(uid, 'User %i' % uid, const.USER_DEFAULT, '', '', str(5000 + uid), 0) for uid in range(1, 301)]
+            with patch.object(sim, 'handle', wraps=sim.handle) as handle:
+                commands = lambda: [call[0][1] for call in handle.call_args_list]
+                failures = conn.set_users(users)
+                self.assertEqual(len(sim.users), 250)
+                self.assertEqual(sorted(user.uid for user, _error in failures), [uid for uid in range(1, 301) if uid not in sim.users])
+                self.assertEqual(commands()[-1], const.CMD_REFRESHDATA)
+                handle.reset_mock()
+                full = User(301, 'Full', const.USER_DEFAULT, '', '', '5301', 0)
+                self.assertRaises(ZKErrorResponse, conn.save_users_templates, [full])
+                self.assertEqual(commands()[-1], const.CMD_REFRESHDATA)
+            conn.disconnect()
+
+    def test_save_users_templates(self):
+        users = [User(uid, 'User %i' % uid, const.USER_DEFAULT, '', '', str(uid), 0) for uid in range(1, 201)]
+        templates = [Finger(uid, fid, 1, bytes(bytearray([uid % 256, fid])) * 100) for fid in range(2) for uid in range(1, 201)]
+        for options, max_buffer, uploads in [({}, None, 1), ({'upload_size': 20000}, None, 9), ({}, 30000, 4)]:
+            with ZKSimulator(port=0, **options) as sim:
+                conn = self.connect(sim)
+                self.assertEqual(conn.save_users_templates(users, templates, max_buffer), uploads)
+                self.assertEqual(len(conn.get_users()), 200)
+                saved = conn.get_templates()
+                self.assertEqual(sorted(saved, key=lambda f: (f.uid, f.fid)), sorted(templates, key=lambda f: (f.uid, f.fid)))
+                conn.disconnect()
+        with ZKSimulator(port=0, upload_size=100) as sim:
+            conn = self.connect(sim)
+            self.assertRaises(ZKErrorResponse, conn.save_users_templates, users[:2], templates)
+            conn.disconnect()
+
+    def test_binary_backup(self):
+        filename = os.path.join(tempfile.mkdtemp(), 'device.zkb')
+        with ZKSimulator(port=0).seed(users=300, templates=200) as sim:
+            conn = self.connect(sim)
+            users, templates = conn.get_users(), conn.get_templates()
+            self.assertEqual(backup(conn, filename), (300, 200))
+            conn.disconnect()
+        self.assertTrue(Backup.is_backup(filename))
+        with Backup(filename) as source:
+            self.assertEqual((source.users, source.templates, source.serial), (300, 200, 'SIM0000000001'))
+            self.assertEqual([user.json_pack() for user in source.iter_users()], [user.json_pack() for user in users])
+            self.assertEqual(list(source.iter_templates()), sorted(templates, key=lambda f: (f.uid, f.fid)))
+            self.assertEqual(source.get_user(7).user_id, users[6].user_id)
+            self.assertIsNone(source.get_user(301))
+            self.assertEqual(source.get_templates(templates[5].uid), [f for f in templates if f.uid == templates[5].uid])
+            self.assertEqual(source.get_templates(301), [])
+            self.assertEqual([fingers for _user, fingers in source.iter_users_templates()][templates[5].uid - 1], source.get_templates(templates[5].uid))
+            self.assertEqual(sum(len(fingers) for _user, fingers in source.iter_users_templates()), 200)
+        with ZKSimulator(port=0) as sim:
+            conn = self.connect(sim)
+            self.assertEqual(restore(conn, filename, batch=100), 3)
+            self.assertEqual([user.json_pack() for user in conn.get_users()], [user.json_pack() for user in users])
+            self.assertEqual(sorted(conn.get_templates(), key=lambda f: (f.uid, f.fid)), sorted(templates, key=lambda f: (f.uid, f.fid)))
+            conn.disconnect()
+        with open(filename, 'r+b') as broken:
+            broken.write(b'JSON')
+        self.assertFalse(Backup.is_backup(filename))
+        self.assertRaises(ZKError, Backup, filename)
+        with ZKSimulator(port=0, drop_after=70000).seed(users=300, templates=200, template_size=1000) as sim:
+            conn = self.connect(sim)
+            self.assertRaises(ZKNetworkError, backup, conn, filename) # link drops during iter_templates
+        with open(filename, 'rb') as previous:
+            self.assertEqual(previous.read(4), b'JSON') # untouched
+        self.assertFalse(os.path.exists(filename + '.tmp'))
+        with BackupWriter(open(filename, 'wb'), 'SIM') as writer:
+            writer.add_user(users[0])
+        partial = os.path.join(os.path.dirname(filename), 'partial.zkb')
+        try:
+            with BackupWriter(open(partial, 'wb'), 'SIM') as writer:
+                writer.add_user(users[0])
+                raise ZKNetworkError("link down")
+        except ZKNetworkError:
+            pass
+        self.assertTrue(Backup.is_backup(filename))
+        self.assertFalse(Backup.is_backup(partial)) # no index nor trailer
+        self.assertRaises(ZKError, Backup, partial)
+        open(partial, 'wb').close()
+        self.assertFalse(Backup.is_backup(partial))
+        self.assertRaises(ZKError, Backup, partial) # empty
+
+    def test_provision(self):
+        with ZKSimulator(port=0).seed(users=50, templates=40) as sim:
+            conn = self.connect(sim)
+            users, templates = conn.get_users(), conn.get_templates()
+            users = users[5:] + [User(100 + i, 'New %i' % i, const.USER_DEFAULT, '', '', str(900 + i), 0) for i in range(4)]
+            for user in users[:3]:
+                user.name += ' changed'
+            kept = [finger for finger in templates if finger.uid > 5]
+            deleted, changed = kept[:2], kept[2:5]
+            templates = kept[5:] + [Finger(finger.uid, finger.fid, 1, b'\x07' * 300) for finger in changed]
+            templates.append(Finger(100, 0, 1, b'\x08' * 300))
+            changes = provision.plan(conn, users, templates)
+            self.assertEqual(str(changes), '<ProvisionPlan>: users -5 ~9 =40, templates -2 ~4 ={}'.format(len(kept) - 5))
+            self.assertEqual(sorted(user.uid for user in changes.delete_users), [1, 2, 3, 4, 5])
+            self.assertEqual(changes.delete_templates, deleted)
+            self.assertEqual(set(user.uid for user in changes.upsert_users),
+                             set([6, 7, 8, 100, 101, 102, 103]) | set(finger.uid for finger in changed))
+            self.assertEqual(sorted(changes.json_pack()['upsert_templates']), sorted([[f.uid, f.fid] for f in changed] + [[100, 0]]))
+            self.assertEqual(len(sim.users), 50) # nothing changed yet
+            self.assertEqual(changes.apply(conn), 1)
+            self.assertTrue(provision.plan(conn, users, templates).empty)
+            self.assertEqual(sorted(user.name for user in conn.get_users()), sorted(user.name for user in users))
+            self.assertEqual(sorted(conn.get_templates(), key=lambda f: (f.uid, f.fid)), sorted(templates, key=lambda f: (f.uid, f.fid)))
+            conn.disconnect()
+
+    def test_provision_rejected(self):
+        with ZKSimulator(port=0, user_packet_size=28).seed(users=10, templates=10) as sim:
+            conn = self.connect(sim)
+            users, templates = conn.get_users(), conn.get_templates()
+            users[0].user_id = 'A-1' # no room for it in a 28 bytes record
+            users.append(User(20, 'New', const.USER_DEFAULT, '', '', 'B-2', 0))
+            deleted = [finger for finger in templates if finger.uid != users[0].uid][:2]
+            changes = provision.plan(conn, users, [finger for finger in templates if finger not in deleted and finger.uid != users[0].uid])
+            self.assertEqual([user.uid for user, _error in changes.invalid_users], [users[0].uid, 20])
+            self.assertEqual(changes.delete_templates, deleted) # not the ones of the invalid user, left as they are
+            self.assertEqual(str(changes), '<ProvisionPlan>: users -0 ~0 =9, templates -2 ~0 =7, 2 invalid users')
+            del sim.templates[(deleted[1].uid, deleted[1].fid)] # gone before apply
+            self.assertRaises(ZKErrorResponse, changes.apply, conn)
+            self.assertEqual(len(sim.users), 10)
+            conn.disconnect()
+
+    def test_windowed_upload(self):
+        user = User(7, 'Seven', const.USER_DEFAULT, '', '', '700', 0)
+        fingers = [Finger(7, fid, 1, bytes(bytearray(range(fid, fid + 200))) * 30) for fid in range(10)]
+        for options in [{}, {'upload_chunk': 1024}, {'pipeline': False}]:
+            with ZKSimulator(port=0, **options) as sim:
+                for force_udp, pipeline in [(False, 0), (False, 4), (True, 4)]:
+                    sim.templates.clear()
+                    conn = self.connect(sim, force_udp=force_udp, pipeline=pipeline, upload_chunk=16 * 1024)
+                    conn.save_user_template(user, fingers)
+                    self.assertEqual(conn.get_templates(), fingers)
+                    conn.save_user_template(user, fingers[:2]) # after a fallback: serial
+                    self.assertEqual(conn.get_templates()[:2], fingers[:2])
+                    conn.disconnect()
+
+    def test_stalled_upload(self):
+        user = User(7, 'Seven', const.USER_DEFAULT, '', '', '700', 0)
+        fingers = [Finger(7, fid, 1, bytes(bytearray(range(fid, fid + 200))) * 30) for fid in range(10)]
+        with ZKSimulator(port=0, upload_chunk=1024, upload_stall=True) as sim:
+            conn = self.connect(sim) # 1024 bytes chunks by default
+            conn.save_user_template(user, fingers)
+            self.assertEqual(conn.get_templates(), fingers)
+            conn.disconnect()
+            for pipeline in [0, 4]:
+                sim.templates.clear()
+                conn = self.connect(sim, pipeline=pipeline, upload_chunk=16 * 1024, policy=RetryPolicy(timeouts={const.CMD_DATA: 1}))
+                conn.disable_device()
+                conn.save_user_template(user, fingers) # no answer: reconnect, serial
+                self.assertFalse(conn.is_enabled)
+                self.assertEqual(conn.get_templates(), fingers)
+                conn.enable_device()
+                conn.disconnect()
+
+
+class FleetTest(unittest.TestCase):
+    """ Fleet against local device simulators """
+
+    def test_sweep(self):
+        sims = [ZKSimulator(port=0).seed(users=10 * (i + 1), records=100 * (i + 1)).start() for i in range(3)]
+        dead = ZKSimulator(port=0).start()
+        dead.stop()
+        try:
+            inventory = ['127.0.0.1:%i' % sim.port for sim in sims] + [{'ip': '127.0.0.1', 'port': dead.port, 'name': 'dead'}]
+            with Fleet(inventory, workers=2, timeout=2, ommit_ping=True) as fleet:
+                results = dict((result.device, result) for result in fleet.read_sizes())
+                self.assertEqual(len(results), 4)
+                self.assertFalse(results['dead'].ok)
+                for i, sim in enumerate(sims):
+                    result = results['127.0.0.1:%i' % sim.port]
+                    self.assertTrue(result.ok)
+                    self.assertEqual(result.value['users'], 10 * (i + 1))
+                    self.assertEqual(result.value['records'], 100 * (i + 1))
+                sessions = [device.conn for device in fleet.devices[:3]]
+                results = dict((result.device, result) for result in fleet.get_attendance())
+                self.assertEqual(len(results['127.0.0.1:%i' % sims[2].port].value), 300)
+                self.assertEqual([device.conn for device in fleet.devices[:3]], sessions) # one session per device
+                results = list(fleet.set_time(datetime(2020, 1, 2, 3, 4, 5)))
+                self.assertEqual(len([result for result in results if result.ok]), 3)
+        finally:
+            for sim in sims:
+                sim.stop()
+
+    def test_network_failure_skips_exit(self):
+        with ZKSimulator(port=0).seed(users=5) as sim:
+            sessions = []
+            def failing(conn, error):
+                conn.disconnect = Mock(wraps=conn.disconnect)
+                sessions.append(conn)
+                raise error
+            with Fleet(['127.0.0.1:%i' % sim.port], timeout=2, ommit_ping=True) as fleet:
+                result, = list(fleet.run(failing, ZKNetworkError("timed out")))
+                self.assertFalse(result.ok)
+                self.assertFalse(sessions[0].disconnect.called) # no CMD_EXIT to a device that doesn't answer
+                self.assertFalse(sessions[0].is_connect)
+                result, = list(fleet.run(failing, ZKErrorResponse("rejected")))
+                self.assertTrue(sessions[1].disconnect.called) # the device answers: clean exit
+                self.assertIsNot(sessions[1], sessions[0])
+                result, = list(fleet.read_sizes())
+                self.assertEqual(result.value['users'], 5)
+
+    def test_circuit_breaker(self):
+        sim = ZKSimulator(port=0).seed(users=10).start()
+        dead = ZKSimulator(port=0).start()
+        port = dead.port
+        dead.stop() # powered off
+        events = []
+        health = HealthTracker(threshold=2, backoff=0.2, on_event=events.append)
+        try:
+            inventory = ['127.0.0.1:%i' % sim.port, {'ip': '127.0.0.1', 'port': port, 'name': 'dead'}]
+            with Fleet(inventory, health=health, timeout=2, ommit_ping=True) as fleet:
+                sweep = lambda: dict((result.device, result) for result in fleet.read_sizes())
+                for _sweep in range(2):
+                    self.assertIsInstance(sweep()['dead'].error, ZKNetworkError)
+                results = sweep()
+                self.assertIsInstance(results['dead'].error, ZKErrorCircuitOpen) # skipped
+                self.assertEqual(results['127.0.0.1:%i' % sim.port].value['users'], 10)
+                self.assertEqual(health.states(), {('127.0.0.1', sim.port): 'closed', ('127.0.0.1', port): 'open'})
+                time.sleep(0.25)
+                self.assertIsInstance(sweep()['dead'].error, ZKErrorCircuitOpen) # probe refused
+                self.assertEqual(health.get('127.0.0.1', port).opens, 2) # 0.4s window
+                dead = ZKSimulator(port=port).seed(users=5).start() # powered on
+                time.sleep(0.45)
+                self.assertEqual(sweep()['dead'].value['users'], 5)
+            self.assertEqual([(event['from'], event['to']) for event in events], [
+                ('closed', 'open'), ('open', 'half-open'), ('half-open', 'open'), ('open', 'half-open'), ('half-open', 'closed')])
+            self.assertEqual(events[0]['device'], ('127.0.0.1', port))
+            self.assertEqual(events[0]['failures'], 2)
+            with ZKPool(health=health, timeout=2, ommit_ping=True) as pool:
+                dead.stop()
+                health.failure('127.0.0.1', port)
+                health.failure('127.0.0.1', port)
+                self.assertRaises(ZKErrorCircuitOpen, pool.call, '127.0.0.1', port, 'get_users')
+        finally:
+            sim.stop()
+            dead.stop()
+
+class ZKPoolTest(unittest.TestCase):
+    """ ZKPool against the local device simulator """
+
+    def test_reuse_and_reconnect(self):
+        sim = ZKSimulator(port=0, password=45).seed(users=20, records=50).start()
+        port = sim.port
+        try:
+            with ZKPool(keepalive=60, timeout=2, password=45, ommit_ping=True) as pool:
+                with pool.acquire('127.0.0.1', port) as conn:
+                    self.assertEqual(len(conn.get_users()), 20)
+                with pool.acquire('127.0.0.1', port) as again:
+                    self.assertIs(again, conn)
+                self.assertEqual((pool.metrics.misses, pool.metrics.hits, pool.metrics.handshakes), (1, 1, 1))
+                sim.stop() # device restart, the session is gone
+                sim = ZKSimulator(port=port, password=45).seed(users=20, records=70).start()
+                self.assertEqual(len(pool.call('127.0.0.1', port, 'get_attendance')), 70)
+                self.assertEqual(pool.metrics.reconnects, 1)
+                sim.stop()
+                sim = ZKSimulator(port=port, password=45).seed(users=20, records=70).start()
+                self.assertRaises(ZKNetworkError, pool.call, '127.0.0.1', port, 'set_user', 21, 'New') # writes aren't repeated
+                self.assertNotIn(21, sim.users)
+                pool.call('127.0.0.1', port, 'set_user', 21, 'New') # fresh session
+                self.assertIn(21, sim.users)
+                self.assertEqual(pool.metrics.reconnects, 2)
+                pool.keepalive = 0 # idle sessions are checked before use
+                with pool.acquire('127.0.0.1', port) as conn:
+                    self.assertTrue(conn.read_sizes())
+                self.assertEqual(pool.metrics.keepalives, 1)
+                self.assertEqual(pool.metrics.keepalive_failures, 0)
+                self.assertGreater(pool.metrics.handshake_latency, 0)
+        finally:
+            sim.stop()
+
+    def test_read_timeout(self):
+        with ZKSimulator(port=0, delays={1: 1.5, 3: 1.5}).seed(users=20, records=70) as sim:
+            with ZKPool(keepalive=60, timeout=0.5, ommit_ping=True) as pool:
+                with self.assertRaises((ZKNetworkError, socket_error)):
+                    with pool.acquire('127.0.0.1', sim.port) as conn:
+                        conn.get_attendance() # 1st chunk late
+                with pool.acquire('127.0.0.1', sim.port) as again: # the late answer dies with the session
+                    self.assertLess(abs(again.get_time() - datetime.now()), timedelta(seconds=5))
+                    self.assertEqual(len(again.get_users()), 20)
+                self.assertEqual((pool.metrics.hits, pool.metrics.reconnects), (0, 1))
+                self.assertEqual(len(pool.call('127.0.0.1', sim.port, 'get_attendance')), 70) # 3rd chunk late: retried
+                self.assertEqual(pool.metrics.reconnects, 2)
+
+if sys.version_info >= (3, 7): # async def and asyncio.run
+    from test_aio import AsyncZKTest
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+AsyncZK tests (python 3.7+: async def and asyncio.run), loaded by test.py
+"""
+import asyncio
+import unittest
+from datetime import datetime
+
+from zk.aio import AsyncZK
+from zk.exception import ZKErrorResponse, ZKNetworkError
+from zk.policy import RetryPolicy
+from zk.protocol import encode_time
+from zk.simulator import ZKSimulator
+
+
+class AsyncZKTest(unittest.TestCase):
+    """ AsyncZK against the local device simulator """
+
+    def test_bulk_read(self):
+        async def sweep(sim, force_udp):
+            async with AsyncZK('127.0.0.1', port=sim.port, timeout=5, force_udp=force_udp) as conn:
+                await conn.read_sizes()
+                return conn.records, await conn.get_users(), await conn.get_templates(), await conn.get_attendance()
+        async def fleet(sim):
+            return await asyncio.gather(*[sweep(sim, force_udp) for force_udp in [False, True, False]])
+        with ZKSimulator(port=0).seed(users=200, templates=100, records=2000) as sim:
+            results = asyncio.run(fleet(sim))
+            for records, users, templates, attendances in results:
+                self.assertEqual(records, 2000)
+                self.assertEqual(len(users), 200)
+                self.assertEqual(users[4].user_id, "100005")
+                self.assertEqual(templates[-1].template, sim.templates[(templates[-1].uid, templates[-1].fid)][1])
+                self.assertEqual(len(attendances), 2000)
+                self.assertEqual(attendances[1].user_id, "100002")
+                self.assertEqual(attendances[1].timestamp, datetime(2018, 1, 1, 8, 1, 0))
+
+    def test_set_user_and_auth(self):
+        async def provision(sim):
+            conn = AsyncZK('127.0.0.1', port=sim.port, timeout=5, password=12)
+            with self.assertRaisesRegex(ZKErrorResponse, "Unauthenticated"):
+                await conn.connect()
+            conn = await AsyncZK('127.0.0.1', port=sim.port, timeout=5, password=45).connect()
+            await conn.get_users()
+            await conn.set_user(name='Async', user_id='4242')
+            await conn.set_time(datetime(2020, 5, 6, 7, 8, 9))
+            await conn.disconnect()
+        with ZKSimulator(port=0, password=45) as sim:
+            asyncio.run(provision(sim))
+            self.assertEqual(sim.users[1][3], 'Async')
+            self.assertEqual(sim.users[1][6], '4242')
+
+    def test_interrupted_read(self):
+        async def interrupted(sim):
+            conn = await AsyncZK('127.0.0.1', port=sim.port, timeout=5, policy=RetryPolicy(timeouts={1504: 0.5})).connect()
+            with self.assertRaises(ZKNetworkError):
+                await conn.get_users() # late chunk: timeout
+            self.assertFalse(conn.is_connect) # the late answer dies with the session
+            await conn.connect()
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(conn.get_users(), 0.2) # late chunk: cancelled
+            self.assertFalse(conn.is_connect)
+            await conn.connect()
+            users = await conn.get_users()
+            await conn.disconnect()
+            return users
+        with ZKSimulator(port=0, delays={1: 1, 2: 1}).seed(users=200) as sim:
+            self.assertEqual(len(asyncio.run(interrupted(sim))), 200)
+
+    def test_live_capture(self):
+        async def capture(sim):
+            conn = await AsyncZK('127.0.0.1', port=sim.port, timeout=5).connect()
+            events = []
+            async for attendance in conn.live_capture(new_timeout=0.2):
+                if attendance is None:
+                    await asyncio.get_running_loop().run_in_executor(None, sim.push_event, 3, 1, 1, datetime(2019, 1, 2, 3, 4, 5))
+                    continue
+                events.append(attendance)
+                conn.end_live_capture = True
+            await conn.disconnect()
+            return events
+        with ZKSimulator(port=0).seed(users=5) as sim:
+            events = asyncio.run(capture(sim))
+            self.assertEqual(len(events), 1)
+            self.assertEqual(events[0].user_id, "100003")
+            self.assertEqual(events[0].uid, 3)
+            self.assertEqual(events[0].timestamp, datetime(2019, 1, 2, 3, 4, 5))
+            self.assertEqual(events[0].device_time, encode_time(datetime(2019, 1, 2, 3, 4, 5)))
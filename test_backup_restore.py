@@ -17,6 +17,7 @@ from zk.user import User
 from zk.finger import Finger
 from zk.attendance import Attendance
 from zk.exception import ZKErrorResponse, ZKNetworkError
+from zk.backup import Backup, backup, restore
 
 class BasicException(Exception):
     pass
@@ -42,8 +43,10 @@ parser.add_argument('-r', '--restore', action="store_true",
                     help='Restore from backup')
 parser.add_argument('-c', '--clear-attendance', action="store_true",
                     help='On Restore, also clears the attendance [default keep attendance]')
+parser.add_argument('-j', '--json', action="store_true",
+                    help='write the backup as json (default compact binary)')
 parser.add_argument('filename', nargs='?',
-                    help='backup filename (default [serialnumber].bak)', default='')
+                    help='backup filename (default [serialnumber].zkb or [serialnumber].json.bak)', default='')
 
 args = parser.parse_args()
 
@@ -72,39 +75,64 @@ try:
     fp_version = conn.get_fp_version()
     print ('Serial Number    : {}'.format(serialnumber))
     print ('Finger Version   : {}'.format(fp_version))
-    filename = args.filename if args.filename else "{}.json.bak".format(serialnumber)
+    filename = args.filename if args.filename else "{}.{}".format(serialnumber, 'json.bak' if args.json else 'zkb')
     print ('')
     if not args.restore:
         print ('--- sizes & capacity ---')
         conn.read_sizes()
         print (conn)
-        print ('--- Get User ---')
-        inicio = time.time()
-        users = conn.get_users()
-        final = time.time()
-        print ('Read {} users took {:.3f}[s]'.format(len(users), final - inicio))
-        if len(users) == 0:
-            raise BasicException("Empty user list, aborting...")
-        print ("Read Templates...")
-        inicio = time.time()
-        templates = conn.get_templates()
-        final = time.time()
-        print ('Read {} templates took {:.3f}[s]'.format(len(templates), final - inicio))
-        #save to file!
-        print ('')
-        print ('Saving to file {} ...'.format(filename))
-        output = open(filename, 'w')
-        data = {
-            'version':'1.00jut',
-            'serial': serialnumber,
-            'fp_version': fp_version,
-            'users': [u.__dict__ for u in users],
-            'templates':[t.json_pack() for t in templates]
-            }
-        json.dump(data, output, indent=1)
-        output.close()
+        if not args.json:
+            print ('Saving to file {} ...'.format(filename))
+            inicio = time.time()
+            users, templates = backup(conn, filename)
+            final = time.time()
+            print ('Saved {} users and {} templates took {:.3f}[s]'.format(users, templates, final - inicio))
+            if users == 0:
+                raise BasicException("Empty user list...")
+        else:
+            print ('--- Get User ---')
+            inicio = time.time()
+            users = conn.get_users()
+            final = time.time()
+            print ('Read {} users took {:.3f}[s]'.format(len(users), final - inicio))
+            if len(users) == 0:
+                raise BasicException("Empty user list, aborting...")
+            print ("Read Templates...")
+            inicio = time.time()
+            templates = conn.get_templates()
+            final = time.time()
+            print ('Read {} templates took {:.3f}[s]'.format(len(templates), final - inicio))
+            #save to file!
+            print ('')
+            print ('Saving to file {} ...'.format(filename))
+            output = open(filename, 'w')
+            data = {
+                'version':'1.00jut',
+                'serial': serialnumber,
+                'fp_version': fp_version,
+                'users': [u.json_pack() for u in users],
+                'templates':[t.json_pack() for t in templates]
+                }
+            json.dump(data, output, indent=1)
+            output.close()
         if args.erase:
             erase_device(conn, serialnumber, args.clear_attendance)
+    elif Backup.is_backup(filename):
+        print ('Reading file {}'.format(filename))
+        with Backup(filename) as source:
+            print (source)
+            if source.fp_version != fp_version:
+                raise BasicException("fingerprint version mismmatch {} != {} ... aborting!".format(fp_version, source.fp_version))
+        erase_device(conn, serialnumber, args.clear_attendance)
+        print ('Restoring Data...')
+        inicio = time.time()
+        uploads = restore(conn, filename)
+        final = time.time()
+        print ('Restored in {} uploads, took {:.3f}[s]'.format(uploads, final - inicio))
+        conn.enable_device()
+        print ('--- final sizes & capacity ---')
+        conn.read_sizes()
+        print (conn)
     else:
         print ('Reading file {}'.format(filename))
         infile = open(filename, 'r')
@@ -124,11 +152,10 @@ try:
         print ("INFO: ready to write {} templates".format(len(templates)))
         erase_device(conn, serialnumber, args.clear_attendance)
         print ('Restoring Data...')
-        for u in users:
-            #look for Templates
-            temps = list(filter(lambda f: f.uid ==u.uid, templates))
-            #print ("user {} has {} fingers".format(u.uid, len(temps)))
-            conn.save_user_template(u,temps)
+        inicio = time.time()
+        uploads = conn.save_users_templates(users, templates)
+        final = time.time()
+        print ('Restored in {} uploads, took {:.3f}[s]'.format(uploads, final - inicio))
         conn.enable_device()
         print ('--- final sizes & capacity ---')
         conn.read_sizes()
@@ -0,0 +1,574 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio client, drives many devices from a single event loop
+
+it speaks the same protocol as zk.base.ZK (packets and record decoders
+come from zk.protocol) over asyncio streams (tcp) or a datagram endpoint
+(udp). Only one operation at a time per instance, as with ZK. A timeout
+or a cancellation (ie: asyncio.wait_for around a call) drops the session
+(is_connect is False): connect again to go on.
+"""
+import asyncio
+from struct import pack
+
+from . import const
+from .exception import ZKErrorConnection, ZKErrorResponse, ZKNetworkError
+from .user import User, UserDirectory
+from .policy import RetryPolicy
+from .codec import (
+    HEADER, TCP_HEADER, TIME, PREPARE_BUFFER, READ_CHUNK, TOTAL_SIZE, PREPARE_DATA
+)
+from .protocol import (
+    make_commkey, create_packet, decode_time, encode_time, unpack_sizes,
+    pack_user, decode_user, next_user_ids, decode_template,
+    attendance_record_size, decode_attendance, decode_events, RecordSplitter
+)
+
+
+class _DatagramQueue(asyncio.DatagramProtocol):
+    """ udp packets (or errors) queued for the reader """
+
+    def __init__(self):
+        self.packets = asyncio.Queue()
+
+    def datagram_received(self, data, addr):
+        self.packets.put_nowait(data)
+
+    def error_received(self, exc):
+        self.packets.put_nowait(exc)
+
+    def connection_lost(self, exc):
+        if exc is not None:
+            self.packets.put_nowait(exc)
+
+
+class AsyncZK(object):
+    """
+    ZK asyncio class
+    """
+    def __init__(self, ip, port=4370, timeout=60, password=0, force_udp=False, verbose=False, encoding='UTF-8', policy=None):
+        """
+        Construct a new 'AsyncZK' object.
+
+        :param ip: machine's IP address
+        :param port: machine's port
+        :param timeout: timeout number
+        :param password: passint
+        :param force_udp: use UDP connection
+        :param verbose: showing log while run the commands
+        :param encoding: user encoding
+        :param policy: RetryPolicy with the per-command timeouts and the
+            retries (backoff, metrics hook) of 1504 chunks. Its deadline
+            isn't used: wrap the call in asyncio.wait_for instead
+        """
+        User.encoding = encoding
+        self.__address = (ip, port)
+        self.__timeout = timeout
+        self.__password = password # passint
+        self.__session_id = 0
+        self.__reply_id = const.USHRT_MAX - 1
+        self.__data = b''
+        self.__send_buffer = bytearray(8 + 8 + 1024)
+        self.__reader = None
+        self.__writer = None
+        self.__transport = None
+        self.__packets = None
+        self.__partial = False # TCP header read, payload not yet
+
+        self.is_connect = False
+        self.is_enabled = True
+        self.force_udp = force_udp
+        self.verbose = verbose
+        self.encoding = encoding
+        self.tcp = not force_udp
+        self.policy = policy or RetryPolicy()
+        self.users = 0
+        self.fingers = 0
+        self.records = 0
+        self.dummy = 0
+        self.cards = 0
+        self.fingers_cap = 0
+        self.users_cap = 0
+        self.rec_cap = 0
+        self.faces = 0
+        self.faces_cap = 0
+        self.fingers_av = 0
+        self.users_av = 0
+        self.rec_av = 0
+        self.next_uid = 1
+        self.next_user_id='1'
+        self.user_packet_size = 28 # default zk6
+        self.end_live_capture = False
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if self.is_connect:
+            await self.disconnect()
+
+    async def __open(self):
+        self.__partial = False
+        try:
+            if self.tcp:
+                self.__reader, self.__writer = await asyncio.wait_for(
+                    asyncio.open_connection(*self.__address), self.__timeout)
+            else:
+                loop = asyncio.get_event_loop()
+                self.__transport, protocol = await loop.create_datagram_endpoint(
+                    _DatagramQueue, remote_addr=self.__address)
+                self.__packets = protocol.packets
+        except (OSError, asyncio.TimeoutError) as e:
+            raise ZKNetworkError(str(e) or "can't connect")
+
+    def __close(self):
+        if self.__writer is not None:
+            self.__writer.close()
+            self.__writer = None
+        if self.__transport is not None:
+            self.__transport.close()
+            self.__transport = None
+
+    def __broken(self, reason):
+        """
+        drop a session whose stream can't be trusted anymore (a packet read
+        in half, or a late answer that would be taken for the answer of the
+        next command), connect again to go on
+        """
+        if self.verbose: print ("session dropped: %s" % reason)
+        self.is_connect = False
+        self.__close()
+
+    def __send_packet(self, command, command_string=b'', reply_id=None):
+        """
+        send a command to the terminal, without reading the response
+        """
+        if command not in [const.CMD_CONNECT, const.CMD_AUTH] and not self.is_connect:
+            raise ZKErrorConnection("instance are not connected.")
+        if reply_id is None:
+            reply_id = self.__reply_id
+        self.__send_buffer, buf = create_packet(self.__send_buffer, command, command_string, self.__session_id, reply_id, self.tcp)
+        buf = bytes(buf) # the transport may keep it queued, the send buffer is reused
+        try:
+            if self.tcp:
+                self.__writer.write(buf)
+            else:
+                self.__transport.sendto(buf)
+        except Exception as e:
+            raise ZKNetworkError(str(e))
+
+    async def __read_packet(self):
+        if self.tcp:
+            top = await self.__reader.readexactly(16)
+            magic1, magic2, length, response, _checksum, session_id, reply_id = TCP_HEADER.unpack_from(top)
+            if magic1 != const.MACHINE_PREPARE_DATA_1 or magic2 != const.MACHINE_PREPARE_DATA_2 or length < 8:
+                raise ZKNetworkError("TCP packet invalid")
+            self.__partial = True
+            payload = await self.__reader.readexactly(length - 8)
+            self.__partial = False
+        else:
+            packet = await self.__packets.get()
+            if isinstance(packet, Exception):
+                raise packet
+            if len(packet) < 8:
+                raise ZKNetworkError("UDP packet invalid")
+            response, _checksum, session_id, reply_id = HEADER.unpack_from(packet)
+            payload = packet[8:]
+        return response, session_id, reply_id, payload
+
+    async def __recv_packet(self, timeout=None, idle=False):
+        """
+        read the next packet. A timeout or a cancellation drops the session
+        (see __broken), unless idle (no answer expected, ie: live_capture)
+        and no packet was read in half
+
+        :return: response code, session id, reply id, payload
+        """
+        try:
+            return await asyncio.wait_for(self.__read_packet(), timeout or self.__timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e: # TimeoutError is an OSError since 3.11
+            if not idle or self.__partial:
+                self.__broken(type(e).__name__)
+            raise
+        except ZKNetworkError:
+            raise
+        except (OSError, asyncio.IncompleteReadError) as e:
+            raise ZKNetworkError(str(e) or "connection closed")
+
+    async def __send_command(self, command, command_string=b''):
+        """
+        send command to the terminal
+        """
+        self.__send_packet(command, command_string)
+        try:
+            response, session_id, self.__reply_id, self.__data = await self.__recv_packet(
+                self.policy.timeout_for(command, self.__timeout))
+        except asyncio.TimeoutError:
+            raise ZKNetworkError("timed out")
+        self.__header = (response, session_id)
+        if response in [const.CMD_ACK_OK, const.CMD_PREPARE_DATA, const.CMD_DATA]:
+            return {
+                'status': True,
+                'code': response
+            }
+        return {
+            'status': False,
+            'code': response
+        }
+
+    async def connect(self):
+        """
+        connect to the device
+
+        :return: self
+        """
+        self.end_live_capture = False
+        if not self.force_udp:
+            self.user_packet_size = 72 # default zk8
+        await self.__open()
+        self.__session_id = 0
+        self.__reply_id = const.USHRT_MAX - 1
+        cmd_response = await self.__send_command(const.CMD_CONNECT)
+        self.__session_id = self.__header[1]
+        if cmd_response.get('code') == const.CMD_ACK_UNAUTH:
+            if self.verbose: print ("try auth")
+            command_string = make_commkey(self.__password, self.__session_id)
+            cmd_response = await self.__send_command(const.CMD_AUTH, command_string)
+        if cmd_response.get('status'):
+            self.is_connect = True
+            return self
+        self.__close()
+        if cmd_response["code"] == const.CMD_ACK_UNAUTH:
+            raise ZKErrorResponse("Unauthenticated")
+        if self.verbose: print ("connect err response {} ".format(cmd_response["code"]))
+        raise ZKErrorResponse("Invalid response: Can't connect")
+
+    async def disconnect(self):
+        """
+        diconnect from the connected device
+
+        :return: bool
+        """
+        cmd_response = await self.__send_command(const.CMD_EXIT)
+        if cmd_response.get('status'):
+            self.is_connect = False
+            self.__close()
+            return True
+        else:
+            raise ZKErrorResponse("can't disconnect")
+
+    async def enable_device(self):
+        """
+        re-enable the connected device and allow user activity in device again
+
+        :return: bool
+        """
+        cmd_response = await self.__send_command(const.CMD_ENABLEDEVICE)
+        if cmd_response.get('status'):
+            self.is_enabled = True
+            return True
+        else:
+            raise ZKErrorResponse("Can't enable device")
+
+    async def disable_device(self):
+        """
+        disable (lock) device, to ensure no user activity in device while some process run
+
+        :return: bool
+        """
+        cmd_response = await self.__send_command(const.CMD_DISABLEDEVICE)
+        if cmd_response.get('status'):
+            self.is_enabled = False
+            return True
+        else:
+            raise ZKErrorResponse("Can't disable device")
+
+    async def refresh_data(self):
+        """
+        shortcut to refresh data
+
+        :return: bool
+        """
+        cmd_response = await self.__send_command(const.CMD_REFRESHDATA)
+        if cmd_response.get('status'):
+            return True
+        else:
+            raise ZKErrorResponse("can't refresh data")
+
+    async def free_data(self):
+        """
+        clear buffer
+
+        :return: bool
+        """
+        cmd_response = await self.__send_command(const.CMD_FREE_DATA)
+        if cmd_response.get('status'):
+            return True
+        else:
+            raise ZKErrorResponse("can't free data")
+
+    async def read_sizes(self):
+        """
+        read the memory ussage
+        """
+        cmd_response = await self.__send_command(const.CMD_GET_FREE_SIZES)
+        if cmd_response.get('status'):
+            for name, value in unpack_sizes(self.__data).items():
+                setattr(self, name, value)
+            return True
+        else:
+            raise ZKErrorResponse("can't read sizes")
+
+    async def get_time(self):
+        """
+        :return: the machine's time
+        """
+        cmd_response = await self.__send_command(const.CMD_GET_TIME)
+        if cmd_response.get('status'):
+            return decode_time(self.__data[:4])
+        else:
+            raise ZKErrorResponse("can't get time")
+
+    async def set_time(self, timestamp):
+        """
+        set Device time (pass datetime object)
+
+        :param timestamp: python datetime object
+        """
+        command_string = TIME.pack(encode_time(timestamp))
+        cmd_response = await self.__send_command(const.CMD_SET_TIME, command_string)
+        if cmd_response.get('status'):
+            return True
+        else:
+            raise ZKErrorResponse("can't set time")
+
+    async def set_user(self, uid=None, name='', privilege=0, password='', group_id='', user_id='', card=0):
+        """
+        create or update user by uid (see ZK.set_user)
+        """
+        if uid is None:
+            uid = self.next_uid
+            if not user_id:
+                user_id = self.next_user_id
+        if not user_id:
+            user_id = str(uid) #ZK6 needs uid2 == uid
+        if privilege not in [const.USER_DEFAULT, const.USER_ADMIN]:
+            privilege = const.USER_DEFAULT
+        privilege = int(privilege)
+        command_string = pack_user(uid, name, privilege, password, group_id, user_id, card, self.user_packet_size, self.encoding)
+        cmd_response = await self.__send_command(const.CMD_USER_WRQ, command_string)
+        if not cmd_response.get('status'):
+            raise ZKErrorResponse("Can't set user")
+        await self.refresh_data()
+        if self.next_uid == uid:
+            self.next_uid += 1 # better recalculate again
+        if self.next_user_id == user_id:
+            self.next_user_id = str(self.next_uid)
+
+    async def __recieve_buffer(self, timeout=None):
+        """
+        receive the answer of a buffered command (PREPARE_DATA, DATA
+        packets and ACK_OK, or a direct DATA packet)
+
+        :return: data, None if the answer is broken
+        """
+        response, _session_id, self.__reply_id, payload = await self.__recv_packet(timeout)
+        if response == const.CMD_DATA:
+            return payload
+        if response != const.CMD_PREPARE_DATA or len(payload) < 4:
+            if self.verbose: print ("invalid response %s" % response)
+            return None
+        size = PREPARE_DATA.unpack_from(payload)[0]
+        data = bytearray()
+        while True:
+            response, _session_id, _reply_id, payload = await self.__recv_packet(timeout)
+            if response == const.CMD_DATA and len(data) + len(payload) <= size:
+                data += payload
+                continue
+            break
+        if response == const.CMD_ACK_OK and len(data) == size:
+            return data
+        if self.verbose: print ("broken buffer, response {} recieved {}/{}".format(response, len(data), size))
+        return None
+
+    async def __read_chunk(self, start, size):
+        """
+        read a chunk from buffer
+        """
+        timeout = self.policy.timeout_for(1504, self.__timeout)
+        for attempt in range(1, self.policy.retries + 1):
+            if attempt > 1:
+                delay = self.policy.retry('read chunk', attempt, start=start, size=size)
+                if delay:
+                    await asyncio.sleep(delay)
+            self.__send_packet(1504, READ_CHUNK.pack(start, size))
+            try:
+                data = await self.__recieve_buffer(timeout)
+            except asyncio.TimeoutError:
+                raise ZKNetworkError("timed out reading chunk %i:[%i]" % (start, size))
+            if data is not None and len(data) == size:
+                return data
+            if self.verbose: print ("retry read chunk %i:[%i]" % (start, size))
+        raise ZKErrorResponse("can't read chunk %i:[%i]" % (start, size))
+
+    async def read_with_buffer(self, command, fct=0 ,ext=0):
+        """
+        Test read info with buffered command (ZK6: 1503)
+        """
+        if self.tcp:
+            MAX_CHUNK = 0xFFc0
+        else:
+            MAX_CHUNK = 16 * 1024
+        command_string = PREPARE_BUFFER.pack(1, command, fct, ext)
+        cmd_response = await self.__send_command(1503, command_string)
+        if not cmd_response.get('status'):
+            raise ZKErrorResponse("RWB Not supported")
+        if cmd_response['code'] == const.CMD_DATA:
+            return self.__data, len(self.__data)
+        size = TOTAL_SIZE.unpack_from(self.__data, 1)[0]
+        if self.verbose: print ("size fill be %i" % size)
+        data = bytearray(size)
+        start = 0
+        while start < size:
+            chunk = min(MAX_CHUNK, size - start)
+            data[start:start + chunk] = await self.__read_chunk(start, chunk)
+            start += chunk
+        await self.free_data()
+        return data, size
+
+    async def __read_records(self, command, fct=0, record_size=None):
+        """
+        read a buffered command and split it in records (RecordSplitter)
+        """
+        data, size = await self.read_with_buffer(command, fct)
+        if size < 4:
+            if self.verbose: print ("WRN: no data")
+            return []
+        return RecordSplitter(record_size).feed(data)
+
+    async def get_users(self):
+        """
+        :return: list of User object
+        """
+        await self.read_sizes()
+        if self.users == 0:
+            self.next_uid = 1
+            self.next_user_id='1'
+            return []
+        def record_size(total_size):
+            self.user_packet_size = total_size / self.users
+            if not self.user_packet_size in [28, 72]:
+                if self.verbose: print("WRN packet size would be  %i" % self.user_packet_size)
+            return 28 if self.user_packet_size == 28 else 72
+        users = [decode_user(userdata, offset, size, self.encoding)
+                 for userdata, offset, size in await self.__read_records(const.CMD_USERTEMP_RRQ, const.FCT_USER, record_size)]
+        max_uid = max([user.uid for user in users] or [0])
+        self.next_uid, self.next_user_id = next_user_ids(max_uid, set(user.user_id for user in users))
+        return users
+
+    async def get_templates(self):
+        """
+        :return: list of Finger object
+        """
+        await self.read_sizes()
+        if self.fingers == 0:
+            return []
+        return [decode_template(templatedata, offset)
+                for templatedata, offset, size in await self.__read_records(const.CMD_DB_RRQ, const.FCT_FINGERTMP)]
+
+    async def get_attendance(self, raw_time=False, directory=None):
+        """
+        return attendance record
+
+        :param raw_time: keep the device time (Attendance.device_time) and
+            build the timestamp datetime lazily, on first access
+        :param directory: pre-fetched UserDirectory (or list of User) to
+            join the records, None: get_users
+        :return: List of Attendance object
+        """
+        await self.read_sizes()
+        if self.records == 0:
+            return []
+        users = await self.__user_directory(directory)
+        def record_size(total_size):
+            return attendance_record_size(total_size, self.records)
+        return [decode_attendance(attendance_data, offset, size, users, raw_time)
+                for attendance_data, offset, size in await self.__read_records(const.CMD_ATTLOG_RRQ, record_size=record_size)]
+
+    async def __user_directory(self, directory=None):
+        """ directory given by the caller, or a new one from get_users """
+        if directory is None:
+            return UserDirectory(await self.get_users())
+        if not isinstance(directory, UserDirectory):
+            directory = UserDirectory(directory)
+        return directory
+
+    async def cancel_capture(self):
+        """
+        cancel capturing finger
+
+        :return: bool
+        """
+        cmd_response = await self.__send_command(const.CMD_CANCELCAPTURE)
+        return bool(cmd_response.get('status'))
+
+    async def verify_user(self):
+        """
+        start verify finger mode (after capture)
+
+        :return: bool
+        """
+        cmd_response = await self.__send_command(const.CMD_STARTVERIFY)
+        if cmd_response.get('status'):
+            return True
+        else:
+            raise ZKErrorResponse("Cant Verify")
+
+    async def reg_event(self, flags):
+        """
+        reg events
+        """
+        cmd_response = await self.__send_command(const.CMD_REG_EVENT, pack("I", flags))
+        if not cmd_response.get('status'):
+            raise ZKErrorResponse("cant' reg events %i" % flags)
+
+    async def live_capture(self, new_timeout=10, raw_time=False, directory=None):
+        """
+        try live capture of events (async iterator), yields None every
+        new_timeout seconds without events, set end_live_capture to stop
+
+        :param raw_time: lazy timestamps (see get_attendance)
+        :param directory: pre-fetched users (see get_attendance)
+        """
+        was_enabled = self.is_enabled
+        users = await self.__user_directory(directory)
+        await self.cancel_capture()
+        await self.verify_user()
+        if not self.is_enabled:
+            await self.enable_device()
+        if self.verbose: print ("start live_capture")
+        await self.reg_event(const.EF_ATTLOG)
+        self.end_live_capture = False
+        try:
+            while not self.end_live_capture:
+                try:
+                    response, _session_id, _reply_id, data = await self.__recv_packet(new_timeout, idle=True)
+                except asyncio.TimeoutError:
+                    if self.verbose: print ("time out")
+                    yield None # return to keep watching
+                    continue
+                self.__send_packet(const.CMD_ACK_OK, b'', const.USHRT_MAX - 1)
+                if not response == const.CMD_REG_EVENT:
+                    if self.verbose: print("not event! %x" % response)
+                    continue
+                if not len(data):
+                    if self.verbose: print ("empty")
+                    continue
+                for attendance in decode_events(data, users, raw_time):
+                    yield attendance
+        finally:
+            if self.verbose: print ("exit gracefully")
+            if self.is_connect: # not dropped (see __broken)
+                await self.reg_event(0)
+                if not was_enabled:
+                    await self.disable_device()
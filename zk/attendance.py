@@ -1,14 +1,101 @@
 # -*- coding: utf-8 -*-
+from calendar import timegm
+from zlib import crc32
+
+from .columnar import device_to_datetime, device_to_epoch
+
+
 class Attendance(object):
-    def __init__(self, user_id, timestamp, status, punch=0, uid=0):
+    """
+    an attendance record, device_time is the device encoded time
+    (EncodeTime) when it comes from the device. Records decoded with
+    raw_time=True build the timestamp datetime lazily, on first access.
+    """
+    __slots__ = ('uid', 'user_id', '_timestamp', 'status', 'punch', 'device_time')
+
+    def __init__(self, user_id, timestamp, status, punch=0, uid=0, device_time=None):
         self.uid = uid # not really used any more
         self.user_id = user_id
-        self.timestamp = timestamp
+        self._timestamp = timestamp
         self.status = status
         self.punch = punch
+        self.device_time = device_time
+
+    @staticmethod
+    def fast(user_id, timestamp, status, punch, uid, device_time=None, new=object.__new__):
+        """ constructor for the bulk decoders (timestamp None: lazy) """
+        attendance = new(Attendance)
+        attendance.uid = uid
+        attendance.user_id = user_id
+        attendance._timestamp = timestamp
+        attendance.status = status
+        attendance.punch = punch
+        attendance.device_time = device_time
+        return attendance
+
+    @property
+    def timestamp(self):
+        if self._timestamp is None and self.device_time is not None:
+            self._timestamp = device_to_datetime(self.device_time)
+        return self._timestamp
+
+    @timestamp.setter
+    def timestamp(self, timestamp):
+        self._timestamp = timestamp
+        self.device_time = None
+
+    @property
+    def epoch(self):
+        """ POSIX seconds (the device time taken as UTC) """
+        if self.device_time is not None:
+            return device_to_epoch(self.device_time)
+        return timegm(self._timestamp.timetuple())
 
     def __str__(self):
         return '<Attendance>: {} : {} ({}, {})'.format(self.user_id, self.timestamp, self.status, self.punch)
 
     def __repr__(self):
         return '<Attendance>: {} : {} ({}, {})'.format(self.user_id, self.timestamp,self.status, self.punch)
+
+
+class AttendanceCursor(object):
+    """
+    position in the device attendance log (records read and checksum of
+    the last one), to read only the new records next time
+    """
+
+    def __init__(self, records=0, record_size=0, tail=0):
+        self.records = records
+        self.record_size = record_size
+        self.tail = tail
+
+    @staticmethod
+    def checksum(record):
+        return crc32(bytes(bytearray(record))) & 0xffffffff # python 2: bytes(view) is its repr
+
+    def match(self, record):
+        return len(record) == self.record_size and AttendanceCursor.checksum(record) == self.tail
+
+    @staticmethod
+    def json_unpack(json):
+        return AttendanceCursor(
+            records=json['records'],
+            record_size=json['record_size'],
+            tail=json['tail']
+        )
+
+    def json_pack(self): #packs for json
+        return {
+            "records": self.records,
+            "record_size": self.record_size,
+            "tail": self.tail
+        }
+
+    def __eq__(self, other):
+        return self.__dict__ == other.__dict__
+
+    def __str__(self):
+        return '<AttendanceCursor>: {} records of {} bytes (tail {:08x})'.format(self.records, self.record_size, self.tail)
+
+    def __repr__(self):
+        return '<AttendanceCursor>: {} records of {} bytes (tail {:08x})'.format(self.records, self.record_size, self.tail)
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+compact binary backup of users and templates
+
+    header   '<8sHH32s16s' magic, version, reserved, serial, fp_version
+    records  users (User.repack73, 73 bytes) and templates (Finger.repack),
+             in the order they were downloaded
+    index    users '<HQ' (uid, offset) then templates '<HbQ' (uid, fid,
+             offset), sorted by uid
+    trailer  '<QII8s' index offset, users, templates, magic
+
+it is written as a stream (the index is kept in memory until close) and
+read through mmap, so a restore only touches the records it needs.
+"""
+import mmap
+import os
+from struct import Struct
+
+from .exception import ZKError
+from .protocol import decode_user, decode_template
+
+MAGIC = b'PYZKBAK\x00'
+VERSION = 1
+HEADER = Struct('<8sHH32s16s')
+USER_INDEX = Struct('<HQ')
+TEMPLATE_INDEX = Struct('<HbQ')
+TRAILER = Struct('<QII8s')
+USER_SIZE = 73
+
+_replace = getattr(os, 'replace', os.rename) # python 2: rename (atomic replace on POSIX)
+
+
+class BackupWriter(object):
+    """
+    stream users and templates into a backup file
+
+        with BackupWriter(open('device.zkb', 'wb'), serial) as backup:
+            for user in conn.iter_users():
+                backup.add_user(user)
+    """
+
+    def __init__(self, fileobj, serial='', fp_version=''):
+        """
+        :param fileobj: binary file object (only write is used)
+        :param serial: device serial number
+        :param fp_version: device fingerprint version
+        """
+        self.fileobj = fileobj
+        self.offset = HEADER.size
+        self.users = [] # (uid, offset)
+        self.templates = [] # (uid, fid, offset)
+        fileobj.write(HEADER.pack(MAGIC, VERSION, 0, str(serial).encode(), str(fp_version).encode()))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def add_user(self, user):
+        record = user.repack73()
+        self.users.append((user.uid, self.offset))
+        self.fileobj.write(record)
+        self.offset += len(record)
+
+    def add_template(self, finger):
+        record = finger.repack()
+        self.templates.append((finger.uid, finger.fid, self.offset))
+        self.fileobj.write(record)
+        self.offset += len(record)
+
+    def close(self):
+        """ write the index and the trailer, then close the file """
+        if self.fileobj is None:
+            return
+        self.users.sort()
+        self.templates.sort()
+        for entry in self.users:
+            self.fileobj.write(USER_INDEX.pack(*entry))
+        for entry in self.templates:
+            self.fileobj.write(TEMPLATE_INDEX.pack(*entry))
+        self.fileobj.write(TRAILER.pack(self.offset, len(self.users), len(self.templates), MAGIC))
+        self.fileobj.close()
+        self.fileobj = None
+
+    def abort(self):
+        """ close the file without index nor trailer (not a valid backup) """
+        if self.fileobj is None:
+            return
+        self.fileobj.close()
+        self.fileobj = None
+
+
+class Backup(object):
+    """
+    memory mapped backup file, users and templates are decoded on demand
+    """
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as fileobj:
+            try:
+                self.data = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError: # empty file
+                raise ZKError("not a backup file")
+        if len(self.data) < HEADER.size + TRAILER.size:
+            self.close()
+            raise ZKError("not a backup file")
+        magic, self.version, _reserved, serial, fp_version = HEADER.unpack_from(self.data)
+        index, self.users, self.templates, trailer_magic = TRAILER.unpack_from(self.data, len(self.data) - TRAILER.size)
+        if magic != MAGIC or trailer_magic != MAGIC:
+            self.close()
+            raise ZKError("not a backup file")
+        if self.version != VERSION:
+            self.close()
+            raise ZKError("backup version {} not supported".format(self.version))
+        self.serial = serial.split(b'\x00')[0].decode(errors='ignore')
+        self.fp_version = fp_version.split(b'\x00')[0].decode(errors='ignore')
+        self.user_index = index
+        self.template_index = index + self.users * USER_INDEX.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.data.close()
+
+    @staticmethod
+    def is_backup(filename):
+        """ True when filename starts and ends (complete) like a binary backup """
+        with open(filename, 'rb') as fileobj:
+            if fileobj.read(len(MAGIC)) != MAGIC:
+                return False
+            fileobj.seek(0, os.SEEK_END)
+            if fileobj.tell() < HEADER.size + TRAILER.size:
+                return False
+            fileobj.seek(-len(MAGIC), os.SEEK_END)
+            return fileobj.read(len(MAGIC)) == MAGIC
+
+    def __user(self, position):
+        _uid, offset = USER_INDEX.unpack_from(self.data, self.user_index + position * USER_INDEX.size)
+        return decode_user(self.data, offset + 1, USER_SIZE - 1)
+
+    def __template(self, position):
+        _uid, _fid, offset = TEMPLATE_INDEX.unpack_from(self.data, self.template_index + position * TEMPLATE_INDEX.size)
+        return decode_template(self.data, offset)
+
+    def __first(self, start, count, entry, uid):
+        """ position of the first index entry with uid (bisect) """
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if entry.unpack_from(self.data, start + middle * entry.size)[0] < uid:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def iter_users(self):
+        """ :return: generator of User, sorted by uid """
+        for position in range(self.users):
+            yield self.__user(position)
+
+    def iter_templates(self):
+        """ :return: generator of Finger, sorted by uid and fid """
+        for position in range(self.templates):
+            yield self.__template(position)
+
+    def iter_users_templates(self):
+        """
+        walk both indexes at once (they are sorted by uid)
+
+        :return: generator of (User, list of Finger), sorted by uid
+        """
+        position = 0
+        for user in self.iter_users():
+            fingers = []
+            while position < self.templates:
+                uid = TEMPLATE_INDEX.unpack_from(self.data, self.template_index + position * TEMPLATE_INDEX.size)[0]
+                if uid > user.uid:
+                    break
+                if uid == user.uid:
+                    fingers.append(self.__template(position))
+                position += 1
+            yield user, fingers
+
+    def get_user(self, uid):
+        """ :return: User with uid, None if missing """
+        position = self.__first(self.user_index, self.users, USER_INDEX, uid)
+        if position < self.users and USER_INDEX.unpack_from(self.data, self.user_index + position * USER_INDEX.size)[0] == uid:
+            return self.__user(position)
+        return None
+
+    def get_templates(self, uid):
+        """ :return: list of Finger of the user with uid """
+        position = self.__first(self.template_index, self.templates, TEMPLATE_INDEX, uid)
+        fingers = []
+        while position < self.templates and TEMPLATE_INDEX.unpack_from(self.data, self.template_index + position * TEMPLATE_INDEX.size)[0] == uid:
+            fingers.append(self.__template(position))
+            position += 1
+        return fingers
+
+    def __str__(self):
+        return '<Backup>: [serial:{}, fp_version:{}, users:{}, templates:{}]'.format(
+            self.serial, self.fp_version, self.users, self.templates)
+
+    def __repr__(self):
+        return self.__str__()
+
+
+def backup(conn, filename):
+    """
+    download users and templates of a connected device straight into a
+    backup file (streamed, only the index is kept in memory). It's written
+    as filename.tmp and renamed once complete: a broken download leaves
+    filename untouched
+
+    :return: number of users, number of templates
+    """
+    partial = filename + '.tmp'
+    try:
+        with BackupWriter(open(partial, 'wb'), conn.get_serialnumber(), conn.get_fp_version()) as writer:
+            for user in conn.iter_users():
+                writer.add_user(user)
+            for finger in conn.iter_templates():
+                writer.add_template(finger)
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    _replace(partial, filename)
+    return len(writer.users), len(writer.templates)
+
+
+def restore(conn, filename, batch=2000):
+    """
+    restore the users and templates of a backup file (save_users_templates,
+    batch users at a time so memory stays bounded)
+
+    :return: number of uploads
+    """
+    uploads = 0
+    with Backup(filename) as source:
+        users, fingers = [], []
+        for user, user_fingers in source.iter_users_templates():
+            users.append(user)
+            fingers.extend(user_fingers)
+            if len(users) == batch:
+                uploads += conn.save_users_templates(users, fingers)
+                users, fingers = [], []
+        if users:
+            uploads += conn.save_users_templates(users, fingers)
+    return uploads
@@ -1,15 +1,30 @@
 # -*- coding: utf-8 -*-
-import sys
-from datetime import datetime
-from socket import AF_INET, SOCK_DGRAM, SOCK_STREAM, socket, timeout
+from __future__ import absolute_import
+from socket import AF_INET, SOCK_DGRAM, SOCK_STREAM, SOL_SOCKET, SO_RCVBUF, socket, timeout, error as socket_error
 from struct import pack, unpack
 import codecs
+from functools import wraps
+from inspect import isgeneratorfunction
+import time
 
 from . import const
-from .attendance import Attendance
-from .exception import ZKErrorConnection, ZKErrorResponse, ZKNetworkError
-from .user import User
+from .attendance import AttendanceCursor
+from . import columnar
+from .exception import ZKError, ZKErrorConnection, ZKErrorDeadline, ZKErrorResponse, ZKNetworkError
+from .user import User, UserDirectory
 from .finger import Finger
+from .tuner import ChunkTuner
+from .policy import RetryPolicy
+from .codec import (
+    HEADER, TCP_TOP, TCP_HEADER, TIME, PREPARE_BUFFER, READ_CHUNK, TOTAL_SIZE,
+    PREPARE_DATA, UPLOAD_HEAD, UPLOAD_TABLE, SAVE_UTEMP
+)
+from .protocol import (
+    make_commkey, create_checksum, create_packet, test_tcp_top, decode_time,
+    encode_time, unpack_sizes, pack_user, decode_user,
+    next_user_ids, decode_template, attendance_record_size, decode_attendance,
+    decode_attendances, decode_events, split_buffer, RecordSplitter, ReadCheckpoint
+)
 
 
 def safe_cast(val, to_type, default=None):
@@ -20,41 +35,67 @@ def safe_cast(val, to_type, default=None):
         return default
 
 
-def make_commkey(key, session_id, ticks=50):
+def release(view):
     """
-    take a password and session_id and scramble them to send to the machine.
-    copied from commpro.c - MakeKey
+    release the buffer of a memoryview now, so the bytearray under it can
+    be resized (python 2 has no memoryview.release: the buffer is released
+    with the last reference to the view)
     """
-    key = int(key)
-    session_id = int(session_id)
-    k = 0
-    for i in range(32):
-        if (key & (1 << i)):
-            k = (k << 1 | 1)
+    if hasattr(view, 'release'):
+        view.release()
+
+
+def with_deadline(name):
+    """
+    run a high-level call of ZK (method or generator) under the deadline
+    of its policy, only the outermost call starts one. A network error
+    raised once the deadline is over (ie: a socket timeout cut by it)
+    becomes ZKErrorDeadline.
+    """
+    def decorator(method):
+        def expired(self, e):
+            deadline = self.deadline
+            if deadline is None or isinstance(e, ZKErrorDeadline) or deadline.remaining() > 0:
+                return e
+            self.policy.report('deadline', operation=deadline.name, error=str(e))
+            return ZKErrorDeadline("%s: deadline exceeded (%s)" % (deadline.name, e))
+        if isgeneratorfunction(method):
+            @wraps(method)
+            def wrapper(self, *args, **kwargs):
+                started = self.deadline is None
+                if started:
+                    self.deadline = self.policy.start(name)
+                items = method(self, *args, **kwargs)
+                try:
+                    for item in items:
+                        yield item
+                except (ZKNetworkError, socket_error) as e:
+                    error = expired(self, e) if started else e
+                    if error is e:
+                        raise
+                    raise error
+                finally:
+                    items.close()
+                    if started:
+                        self.deadline = None
         else:
-            k = k << 1
-    k += session_id
-
-    k = pack(b'I', k)
-    k = unpack(b'BBBB', k)
-    k = pack(
-        b'BBBB',
-        k[0] ^ ord('Z'),
-        k[1] ^ ord('K'),
-        k[2] ^ ord('S'),
-        k[3] ^ ord('O'))
-    k = unpack(b'HH', k)
-    k = pack(b'HH', k[1], k[0])
-
-    B = 0xff & ticks
-    k = unpack(b'BBBB', k)
-    k = pack(
-        b'BBBB',
-        k[0] ^ B,
-        k[1] ^ B,
-        B,
-        k[3] ^ B)
-    return k
+            @wraps(method)
+            def wrapper(self, *args, **kwargs):
+                started = self.deadline is None
+                if started:
+                    self.deadline = self.policy.start(name)
+                try:
+                    return method(self, *args, **kwargs)
+                except (ZKNetworkError, socket_error) as e:
+                    error = expired(self, e) if started else e
+                    if error is e:
+                        raise
+                    raise error
+                finally:
+                    if started:
+                        self.deadline = None
+        return wrapper
+    return decorator
 
 
 class ZK_helper(object):
@@ -110,7 +151,7 @@ class ZK(object):
     """
     ZK main class
     """
-    def __init__(self, ip, port=4370, timeout=60, password=0, force_udp=False, ommit_ping=False, verbose=False, encoding='UTF-8'):
+    def __init__(self, ip, port=4370, timeout=60, password=0, force_udp=False, ommit_ping=False, verbose=False, encoding='UTF-8', pipeline=0, upload_chunk=1024, adaptive=False, resume=0, policy=None):
         """
         Construct a new 'ZK' object.
 
@@ -122,6 +163,20 @@ class ZK(object):
         :param omit_ping: check ip using ping before connect
         :param verbose: showing log while run the commands
         :param encoding: user encoding
+        :param pipeline: chunks kept in flight on bulk reads (1504) and
+            uploads (CMD_DATA), 0: serial. Falls back to serial when the
+            device rejects it (self.pipeline is set to 0, set it again to
+            retry), after a timeout only for the rest of that read
+        :param upload_chunk: CMD_DATA chunk size on TCP (UDP: 1024), up to
+            16KB on firmwares that take them. Back to 1024 bytes chunks
+            when the device rejects them or stops answering
+        :param adaptive: tune the 1504 chunk size from the measured
+            throughput and broken chunks (best size remembered per device)
+        :param resume: reconnects of a broken bulk read, each one
+            continuing from the first missing offset (see read_with_buffer)
+        :param policy: RetryPolicy with the per-command timeouts, the
+            retries (backoff, metrics hook) and the deadline of high-level
+            calls (default: 3 immediate retries, no deadline)
         """
         User.encoding = encoding
         self.__address = (ip, port)
@@ -133,6 +188,14 @@ class ZK(object):
         self.__reply_id = const.USHRT_MAX - 1
         self.__data_recv = None
         self.__data = None
+        self.__send_buffer = bytearray(8 + 8 + 1024)
+        self.__recv_header = bytearray(16)
+        self.__recv_scratch = bytearray(1024)
+        self.__recv_packet = bytearray(1024 + 8)
+        self.__upload_serial = False
+        self.__directory = None
+        self.__progress = None # ReadCheckpoint of the read in progress
+        self.__policy_timeout = False # socket timeout set by __apply_policy
 
         self.is_connect = False
         self.is_enabled = True
@@ -141,7 +204,16 @@ class ZK(object):
         self.ommit_ping = ommit_ping
         self.verbose = verbose
         self.encoding = encoding
+        self.pipeline = pipeline
+        self.upload_chunk = upload_chunk
+        self.resume = resume
+        self.read_checkpoint = None
+        self.policy = policy or RetryPolicy()
+        self.deadline = None # Deadline of the high-level call in progress
         self.tcp = not force_udp
+        self.chunk_tuner = None
+        if adaptive:
+            self.chunk_tuner = ChunkTuner(maximum=self.__max_chunk(), device=(ip, port, self.tcp))
         self.users = 0
         self.fingers = 0
         self.records = 0
@@ -174,88 +246,73 @@ class ZK(object):
         else:
             self.__sock = socket(AF_INET, SOCK_DGRAM)
             self.__sock.settimeout(self.__timeout)
+            if self.pipeline > 1: # room for the datagrams of the chunks in flight
+                self.__sock.setsockopt(SOL_SOCKET, SO_RCVBUF, 1 << 20)
 
-    def __create_tcp_top(self, packet):
+    def __create_packet(self, command, command_string, session_id, reply_id):
         """
-        witch the complete packet set top header
-        """
-        length = len(packet)
-        top = pack('<HHI', const.MACHINE_PREPARE_DATA_1, const.MACHINE_PREPARE_DATA_2, length)
-        return top + packet
+        Puts a the parts that make up a packet together into the reusable
+        send buffer
 
-    def __create_header(self, command, command_string, session_id, reply_id):
-        """
-        Puts a the parts that make up a packet together and packs them into a byte string
+        :return: memoryview of the packet to send
         """
-        buf = pack('<4H', command, 0, session_id, reply_id) + command_string
-        buf = unpack('8B' + '%sB' % len(command_string), buf)
-        checksum = unpack('H', self.__create_checksum(buf))[0]
-        reply_id += 1
-        if reply_id >= const.USHRT_MAX:
-            reply_id -= const.USHRT_MAX
+        self.__send_buffer, view = create_packet(self.__send_buffer, command, command_string, session_id, reply_id, self.tcp)
+        return view
 
-        buf = pack('<4H', command, checksum, session_id, reply_id)
-        return buf + command_string
-
-    def __create_checksum(self, p):
+    def __send_packet(self, command, command_string=b''):
         """
-        Calculates the checksum of the packet to be sent to the time clock
-        Copied from zkemsdk.c
+        send a command to the terminal, without reading the response
         """
-        l = len(p)
-        checksum = 0
-        while l > 1:
-            checksum += unpack('H', pack('BB', p[0], p[1]))[0]
-            p = p[2:]
-            if checksum > const.USHRT_MAX:
-                checksum -= const.USHRT_MAX
-            l -= 2
-        if l:
-            checksum = checksum + p[-1]
-
-        while checksum > const.USHRT_MAX:
-            checksum -= const.USHRT_MAX
-
-        checksum = ~checksum
-
-        while checksum < 0:
-            checksum += const.USHRT_MAX
-
-        return pack('H', checksum)
+        if command not in [const.CMD_CONNECT, const.CMD_AUTH] and not self.is_connect:
+            raise ZKErrorConnection("instance are not connected.")
+        self.__apply_policy(command)
+        buf = self.__create_packet(command, command_string, self.__session_id, self.__reply_id)
+        try:
+            if self.tcp:
+                self.__sock.send(buf)
+            else:
+                self.__sock.sendto(buf, self.__address)
+        except Exception as e:
+            raise ZKNetworkError(str(e))
 
-    def __test_tcp_top(self, packet):
-        """
-        return size!
-        """
-        if len(packet)<=8:
-            return 0
-        tcp_header = unpack('<HHI', packet[:8])
-        if tcp_header[0] == const.MACHINE_PREPARE_DATA_1 and tcp_header[1] == const.MACHINE_PREPARE_DATA_2:
-            return tcp_header[2]
-        return 0
+    def __apply_policy(self, command):
+        """
+        socket timeout for the answer of command: the one of the policy,
+        cut to the time left by the deadline (raises ZKErrorDeadline when
+        it's over). Untouched without per-command timeouts nor deadline.
+        """
+        policy = self.policy
+        if self.deadline is None and not policy.timeouts and policy.timeout is None:
+            if self.__policy_timeout:
+                self.__sock.settimeout(self.__timeout)
+                self.__policy_timeout = False
+            return
+        wait = policy.timeout_for(command, self.__timeout)
+        if self.deadline is not None:
+            left = self.deadline.remaining()
+            if left <= 0:
+                policy.report('deadline', operation=self.deadline.name, command=command)
+                raise ZKErrorDeadline("%s: deadline exceeded" % self.deadline.name)
+            wait = min(wait, left)
+        self.__sock.settimeout(wait)
+        self.__policy_timeout = True
 
     def __send_command(self, command, command_string=b'', response_size=8):
         """
         send command to the terminal
         """
-        if command not in [const.CMD_CONNECT, const.CMD_AUTH] and not self.is_connect:
-            raise ZKErrorConnection("instance are not connected.")
-
-        buf = self.__create_header(command, command_string, self.__session_id, self.__reply_id)
+        self.__send_packet(command, command_string)
         try:
             if self.tcp:
-                top = self.__create_tcp_top(buf)
-                self.__sock.send(top)
                 self.__tcp_data_recv = self.__sock.recv(response_size + 8)
-                self.__tcp_length = self.__test_tcp_top(self.__tcp_data_recv)
+                self.__tcp_length = test_tcp_top(self.__tcp_data_recv)
                 if self.__tcp_length == 0:
                     raise ZKNetworkError("TCP packet invalid")
-                self.__header = unpack('<4H', self.__tcp_data_recv[8:16])
+                self.__header = HEADER.unpack(self.__tcp_data_recv[8:16])
                 self.__data_recv = self.__tcp_data_recv[8:]
             else:
-                self.__sock.sendto(buf, self.__address)
                 self.__data_recv = self.__sock.recv(response_size)
-                self.__header = unpack('<4H', self.__data_recv[:8])
+                self.__header = HEADER.unpack(self.__data_recv[:8])
         except Exception as e:
             raise ZKNetworkError(str(e))
 
@@ -276,86 +333,21 @@ class ZK(object):
         """
         event ack ok
         """
-        buf = self.__create_header(const.CMD_ACK_OK, b'', self.__session_id, const.USHRT_MAX - 1)
+        buf = self.__create_packet(const.CMD_ACK_OK, b'', self.__session_id, const.USHRT_MAX - 1)
         try:
             if self.tcp:
-                top = self.__create_tcp_top(buf)
-                self.__sock.send(top)
+                self.__sock.send(buf)
             else:
                 self.__sock.sendto(buf, self.__address)
         except Exception as e:
             raise ZKNetworkError(str(e))
 
-    def __get_data_size(self):
-        """
-        Checks a returned packet to see if it returned CMD_PREPARE_DATA,
-        indicating that data packets are to be sent
-
-        Returns the amount of bytes that are going to be sent
-        """
-        response = self.__response
-        if response == const.CMD_PREPARE_DATA:
-            size = unpack('I', self.__data[:4])[0]
-            return size
-        else:
-            return 0
-
     def __reverse_hex(self, hex):
         data = ''
         for i in reversed(range(len(hex) / 2)):
             data += hex[i * 2:(i * 2) + 2]
         return data
 
-    def __decode_time(self, t):
-        """
-        Decode a timestamp retrieved from the timeclock
-
-        copied from zkemsdk.c - DecodeTime
-        """
-
-        t = unpack("<I", t)[0]
-        second = t % 60
-        t = t // 60
-
-        minute = t % 60
-        t = t // 60
-
-        hour = t % 24
-        t = t // 24
-
-        day = t % 31 + 1
-        t = t // 31
-
-        month = t % 12 + 1
-        t = t // 12
-
-        year = t + 2000
-
-        d = datetime(year, month, day, hour, minute, second)
-
-        return d
-
-    def __decode_timehex(self, timehex):
-        """
-        timehex string of six bytes
-        """
-        year, month, day, hour, minute, second = unpack("6B", timehex)
-        year += 2000
-        d = datetime(year, month, day, hour, minute, second)
-        return d
-
-    def __encode_time(self, t):
-        """
-        Encode a timestamp so that it can be read on the timeclock
-        """
-        # formula taken from zkemsdk.c - EncodeTime
-        # can also be found in the technical manual
-        d = (
-            ((t.year % 100) * 12 * 31 + ((t.month - 1) * 31) + t.day - 1) *
-            (24 * 60 * 60) + (t.hour * 60 + t.minute) * 60 + t.second
-        )
-        return d
-
     def connect(self):
         """
         connect to the device
@@ -367,6 +359,24 @@ class ZK(object):
             raise ZKNetworkError("can't reach device (ping %s)" % self.__address[0])
         if not self.force_udp and self.helper.test_tcp() == 0:
             self.user_packet_size = 72 # default zk8
+        return self.__handshake()
+
+    def reconnect(self):
+        """
+        open a new session on the same device (ie: after a dead socket),
+        skipping the ping and tcp probes of connect. session_id and
+        reply_id are renewed
+
+        :return: self
+        """
+        self.close()
+        self.end_live_capture = False
+        return self.__handshake()
+
+    def __handshake(self):
+        """
+        new socket, CMD_CONNECT and CMD_AUTH when the device asks for it
+        """
         self.__create_socket()
         self.__session_id = 0
         self.__reply_id = const.USHRT_MAX - 1
@@ -400,6 +410,17 @@ class ZK(object):
         else:
             raise ZKErrorResponse("can't disconnect")
 
+    def close(self):
+        """
+        drop the session without CMD_EXIT, only the socket is closed (ie:
+        after a network error, the device may not answer anymore)
+        """
+        self.is_connect = False
+        try:
+            self.__sock.close()
+        except Exception:
+            pass
+
     def enable_device(self):
         """
         re-enable the connected device and allow user activity in device again
@@ -658,25 +679,11 @@ class ZK(object):
         cmd_response = self.__send_command(command,b'', response_size)
         if cmd_response.get('status'):
             if self.verbose: print(codecs.encode(self.__data,'hex'))
-            size = len(self.__data)
-            if len(self.__data) >= 80:
-                fields = unpack('20i', self.__data[:80])
-                self.users = fields[4]
-                self.fingers = fields[6]
-                self.records = fields[8]
-                self.dummy = fields[10] #???
-                self.cards = fields[12]
-                self.fingers_cap = fields[14]
-                self.users_cap = fields[15]
-                self.rec_cap = fields[16]
-                self.fingers_av = fields[17]
-                self.users_av = fields[18]
-                self.rec_av = fields[19]
-                self.__data = self.__data[80:]
-            if len(self.__data) >= 12: #face info
-                fields = unpack('3i', self.__data[:12]) #dirty hack! we need more information
-                self.faces = fields[0]
-                self.faces_cap = fields[2]
+            for name, value in unpack_sizes(self.__data).items():
+                setattr(self, name, value)
+            if self.__directory is not None and len(self.__directory) != self.users:
+                if self.verbose: print ("user directory is stale")
+                self.__directory = None
             return True
         else:
             raise ZKErrorResponse("can't read sizes")
@@ -732,7 +739,7 @@ class ZK(object):
         response_size = 1032
         cmd_response = self.__send_command(command, b'', response_size)
         if cmd_response.get('status'):
-            return self.__decode_time(self.__data[:4])
+            return decode_time(self.__data[:4])
         else:
             raise ZKErrorResponse("can't get time")
 
@@ -743,7 +750,7 @@ class ZK(object):
         :param timestamp: python datetime object
         """
         command = const.CMD_SET_TIME
-        command_string = pack(b'I', self.__encode_time(timestamp))
+        command_string = TIME.pack(encode_time(timestamp))
         cmd_response = self.__send_command(command, command_string)
         if cmd_response.get('status'):
             return True
@@ -867,30 +874,66 @@ class ZK(object):
         if privilege not in [const.USER_DEFAULT, const.USER_ADMIN]:
             privilege = const.USER_DEFAULT
         privilege = int(privilege)
-        if self.user_packet_size == 28: #self.firmware == 6:
-            if not group_id:
-                group_id = 0
-            try:
-                command_string = pack('HB5s8sIxBHI', uid, privilege, password.encode(self.encoding, errors='ignore'), name.encode(self.encoding, errors='ignore'), card, int(group_id), 0, int(user_id))
-            except Exception as e:
-                if self.verbose: print("s_h Error pack: %s" % e)
-                if self.verbose: print("Error pack: %s" % sys.exc_info()[0])
-                raise ZKErrorResponse("Can't pack user")
-        else:
-            name_pad = name.encode(self.encoding, errors='ignore').ljust(24, b'\x00')[:24]
-            card_str = pack('<I', int(card))[:4]
-            command_string = pack('HB8s24s4sx7sx24s', uid, privilege, password.encode(self.encoding, errors='ignore'), name_pad, card_str, group_id.encode(), user_id.encode())
+        command_string = pack_user(uid, name, privilege, password, group_id, user_id, card, self.user_packet_size, self.encoding)
         response_size = 1024 #TODO check response?
         cmd_response = self.__send_command(command, command_string, response_size)
         if self.verbose: print("Response: %s" % cmd_response)
         if not cmd_response.get('status'):
             raise ZKErrorResponse("Can't set user")
+        if self.__directory is not None:
+            self.__directory.put(decode_user(command_string, 0, self.user_packet_size, self.encoding))
         self.refresh_data()
         if self.next_uid == uid:
             self.next_uid += 1 # better recalculate again
         if self.next_user_id == user_id:
             self.next_user_id = str(self.next_uid)
 
+    @with_deadline('set_users')
+    def set_users(self, users, max_buffer=None):
+        """
+        create or update many users by uid, with buffered uploads (command
+        110, as few as the device takes) and one refresh_data at the end
+        (also when an upload fails). Rejected uploads are split down to
+        one user, so every user the device refuses gets its own failure
+
+        :param users: list of User (empty user_id: str(uid), like set_user)
+        :param max_buffer: biggest upload in bytes (None: as big as the device takes)
+        :return: list of (user, error message) of the users not saved
+        """
+        failures = []
+        packed = []
+        uids = set()
+        sent = []
+        for user in users:
+            if user.uid in uids:
+                failures.append((user, "duplicated uid"))
+                continue
+            privilege = int(user.privilege) if user.privilege in [const.USER_DEFAULT, const.USER_ADMIN] else const.USER_DEFAULT
+            tuser = User(user.uid, user.name, privilege, user.password, user.group_id, user.user_id or str(user.uid), user.card)
+            try:
+                packed.append(self.__pack_user_fingers(tuser))
+            except Exception as e:
+                failures.append((user, "can't pack user: {}".format(e)))
+                continue
+            uids.add(user.uid)
+            sent.append((user, tuser))
+        if sent:
+            rejected = []
+            try:
+                self.__upload_users_fingers(packed, max_buffer, rejected)
+            except BaseException:
+                self.__refresh_after_failure()
+                raise
+            self.refresh_data()
+            for index, error in rejected:
+                failures.append((sent[index][0], str(error)))
+                uids.discard(sent[index][0].uid)
+            sent = [tuser for _user, tuser in sent]
+            if self.next_uid in uids or self.next_user_id in [tuser.user_id for tuser in sent]:
+                self.next_uid, self.next_user_id = next_user_ids(max(uids | set([self.next_uid])), set(tuser.user_id for tuser in sent))
+        if self.verbose: print ("set_users: {} sent, {} failed".format(len(sent), len(failures)))
+        return failures
+
     def save_user_template(self, user, fingers=[]):
         """
         save user and template
@@ -899,58 +942,245 @@ class ZK(object):
         :param fingers: list of finger. (The maximum index 0-9)
         """
         if not isinstance(user, User):
-            users = self.get_users()
-            tusers = list(filter(lambda x: x.uid==user, users))
-            if len(tusers) == 1:
-                user = tusers[0]
-            else:
-                tusers = list(filter(lambda x: x.user_id==str(user), users))
-                if len(tusers) == 1:
-                    user = tusers[0]
-                else:
-                    raise ZKErrorResponse("Can't find user")
+            users = self.get_user_directory()
+            tuser = users.get_by_uid(user) or users.get_by_user_id(user)
+            if tuser is None:
+                raise ZKErrorResponse("Can't find user")
+            user = tuser
         if isinstance(fingers, Finger):
             fingers = [fingers]
-        fpack = b""
-        table = b""
-        fnum = 0x10
-        tstart = 0
-        for finger in fingers:
-            tfp = finger.repack_only()
-            table += pack("<bHbI", 2, user.uid, fnum + finger.fid, tstart)
-            tstart += len(tfp)
-            fpack += tfp
+        self.__save_users_fingers([self.__pack_user_fingers(user, fingers)])
+        self.refresh_data()
+
+    @with_deadline('save_users_templates')
+    def save_users_templates(self, users, templates=[], max_buffer=None):
+        """
+        save many users and their templates: templates are grouped by uid
+        once and many users are packed in every upload (command 110, as few
+        as the device takes), with one refresh_data at the end
+
+        :param users: list of User
+        :param templates: list of Finger (The maximum index 0-9 per user)
+        :param max_buffer: biggest upload in bytes (None: as big as the device takes)
+        :return: number of uploads
+        """
+        fingers = {}
+        for finger in templates:
+            fingers.setdefault(finger.uid, []).append(finger)
+        packed = [self.__pack_user_fingers(user, fingers.get(user.uid, [])) for user in users]
+        try:
+            uploads = self.__upload_users_fingers(packed, max_buffer)
+        except BaseException:
+            self.__refresh_after_failure()
+            raise
+        self.refresh_data()
+        return uploads
+
+    def __pack_user_fingers(self, user, fingers=[]):
+        """
+        :return: user record (29 or 73 bytes), list of table entry (uid,
+            fnum) and template (repack_only) of its fingers
+        """
         if self.user_packet_size == 28:
             upack = user.repack29()
         else:
             upack = user.repack73()
-        head = pack("III", len(upack), len(table), len(fpack))
+        return upack, [((user.uid, 0x10 + finger.fid), finger.repack_only()) for finger in fingers]
+
+    def __save_users_fingers(self, packed):
+        """
+        upload users and templates (head + upack + table + fpack) and save
+        them (command 110)
+
+        :param packed: list of __pack_user_fingers
+        """
+        upack = []
+        table = []
+        fpack = []
+        tstart = 0
+        for user_record, user_fingers in packed:
+            upack.append(user_record)
+            for (uid, fnum), tfp in user_fingers:
+                table.append((2, uid, fnum, tstart))
+                tstart += len(tfp)
+                fpack.append(tfp)
+        upack, table, fpack = b''.join(upack), UPLOAD_TABLE.pack_all(table), b''.join(fpack)
+        head = UPLOAD_HEAD.pack(len(upack), len(table), len(fpack))
         packet = head + upack + table + fpack
         self._send_with_buffer(packet)
         command = 110
-        command_string = pack('<IHH', 12,0,8)
+        command_string = SAVE_UTEMP.pack(12,0,8)
         cmd_response = self.__send_command(command, command_string)
         if not cmd_response.get('status'):
             raise ZKErrorResponse("Can't save utemp")
-        self.refresh_data()
-
+        if self.__directory is not None:
+            for user_record, _user_fingers in packed:
+                self.__directory.put(decode_user(user_record, 1, len(user_record) - 1, self.encoding))
+
+    def __upload_users_fingers(self, packed, max_buffer=None, rejected=None):
+        """
+        save packed users and templates in as few uploads as possible, up
+        to max_buffer bytes each. When the device rejects an upload of more
+        than one user the uploads are halved from then on.
+
+        :param packed: list of __pack_user_fingers
+        :param rejected: list to collect (index in packed, error) of the
+            users rejected on their own (None: raise ZKErrorResponse)
+        :return: number of uploads
+        """
+        uploads = 0
+        index = 0
+        while index < len(packed):
+            end = index
+            size = 12
+            while end < len(packed):
+                user_record, user_fingers = packed[end]
+                record_size = len(user_record) + sum(8 + len(tfp) for _entry, tfp in user_fingers)
+                if end > index and max_buffer is not None and size + record_size > max_buffer:
+                    break
+                size += record_size
+                end += 1
+            try:
+                self.__save_users_fingers(packed[index:end])
+            except ZKErrorResponse as e:
+                if end - index == 1:
+                    if rejected is None:
+                        raise
+                    if self.verbose: print ("upload of user {} rejected: {}".format(index, e))
+                    rejected.append((index, e))
+                    index = end
+                    continue
+                max_buffer = size // 2
+                if self.verbose: print ("upload of {} users rejected, max buffer {}".format(end - index, max_buffer))
+                continue
+            uploads += 1
+            index = end
+        return uploads
+
+    @with_deadline('send_with_buffer')
     def _send_with_buffer(self, buffer):
-        MAX_CHUNK = 1024
+        """
+        upload buffer (CMD_PREPARE_DATA + CMD_DATA chunks): chunks of
+        self.upload_chunk on TCP, with up to self.pipeline of them in
+        flight. When the device rejects a chunk the upload goes on in
+        serial 1024 bytes chunks (from then on), from the last acknowledged
+        offset, or from the start when a chunk after the rejected one was
+        stored. When it stops answering them the session is renewed
+        (reconnect) and the upload starts again in serial 1024 bytes chunks
+        """
         size = len(buffer)
+        buffer = memoryview(buffer)
+        offset = None
+        for _attempt in self.policy.attempts('upload', self.deadline, size=size):
+            if self.__upload_serial:
+                chunk, window = 1024, 1
+            else:
+                chunk, window = self.__max_upload_chunk(), max(1, self.pipeline)
+            if offset is None:
+                self.__prepare_upload(size)
+                offset = 0
+            try:
+                if window > 1:
+                    offset = self.__send_chunks_pipelined(buffer, offset, chunk, window)
+                else:
+                    offset = self.__send_chunks(buffer, offset, chunk)
+            except ZKNetworkError as e:
+                if chunk <= 1024 and window == 1:
+                    raise
+                if self.verbose: print ("upload stalled ({}), reconnect".format(e))
+                self.__reconnect_upload()
+                offset = None
+            if offset == size:
+                return
+            if self.verbose: print ("upload rejected, serial 1024 bytes chunks from {}".format(offset or 0))
+            self.__upload_serial = True
+        raise ZKErrorResponse("Can't send chunk")
+
+    def __max_upload_chunk(self):
+        """ CMD_DATA upload chunk size for the current transport """
+        if self.tcp:
+            return max(1024, min(self.upload_chunk, 16 * 1024))
+        return 1024
+
+    def __reconnect_upload(self):
+        """
+        new session after a stalled upload (late answers would be taken
+        for the answers of the next commands), disabled again if it was
+        """
+        was_enabled = self.is_enabled
+        self.reconnect()
+        if not was_enabled:
+            self.disable_device()
+
+    def __prepare_upload(self, size):
         self.free_data()
         command = const.CMD_PREPARE_DATA
-        command_string = pack('I', size)
+        command_string = PREPARE_DATA.pack(size)
+        if self.deadline is not None:
+            self.deadline.extend(size)
         cmd_response = self.__send_command(command, command_string)
         if not cmd_response.get('status'):
             raise ZKErrorResponse("Can't prepare data")
-        remain = size % MAX_CHUNK
-        packets = (size - remain) // MAX_CHUNK
-        start = 0
-        for _wlk in range(packets):
-            self.__send_chunk(buffer[start:start+MAX_CHUNK])
-            start += MAX_CHUNK
-        if remain:
-            self.__send_chunk(buffer[start:start+remain])
+
+    def __send_chunks(self, buffer, offset, chunk):
+        """
+        serial CMD_DATA chunks, each one acknowledged before the next
+
+        :return: offset acknowledged (the device stored everything before it)
+        """
+        while offset < len(buffer):
+            end = min(offset + chunk, len(buffer))
+            if not self.__send_chunk(buffer[offset:end]):
+                break
+            offset = end
+        return offset
+
+    def __send_chunks_pipelined(self, buffer, offset, chunk, window):
+        """
+        CMD_DATA chunks with up to window of them in flight, the answers
+        are matched to their chunk by reply_id. After a rejected chunk no
+        new chunk is sent and the ones in flight are drained, a timeout
+        raises ZKNetworkError.
+
+        :return: offset acknowledged, None when the device state is unknown
+            (a chunk after a rejected one was stored)
+        """
+        size = len(buffer)
+        sent = offset
+        chunks = [] # [reply_id, end, status] in send order
+        inflight = {}
+        broken = False
+        while (sent < size and not broken) or inflight:
+            while not broken and sent < size and len(inflight) < window:
+                end = min(sent + chunk, size)
+                self.__send_packet(const.CMD_DATA, buffer[sent:end])
+                self.__reply_id += 1
+                if self.__reply_id >= const.USHRT_MAX:
+                    self.__reply_id -= const.USHRT_MAX
+                inflight[self.__reply_id] = state = [self.__reply_id, end, None]
+                chunks.append(state)
+                sent = end
+            try:
+                if self.tcp:
+                    response, reply_id, length = self.__recieve_tcp_header()
+                    self.__recieve_tcp_payload(length)
+                else:
+                    response, reply_id, _payload = self.__recieve_udp_packet()
+            except timeout:
+                raise ZKNetworkError("upload timeout, {} chunks in flight".format(len(inflight)))
+            state = inflight.pop(reply_id, None)
+            if state is None:
+                if self.verbose: print ("upload: unexpected reply_id {}".format(reply_id))
+                continue
+            state[2] = response == const.CMD_ACK_OK
+            broken = broken or not state[2]
+        for index, state in enumerate(chunks):
+            if not state[2]:
+                if any(later[2] for later in chunks[index + 1:]):
+                    return None # stored after a gap
+                break
+            offset = state[1]
+        return offset
 
     def __send_chunk(self, command_string):
         command = const.CMD_DATA
@@ -958,7 +1188,7 @@ class ZK(object):
         if cmd_response.get('status'):
             return True
         else:
-            raise ZKErrorResponse("Can't send chunk")
+            return False
 
     def delete_user_template(self, uid=0, temp_id=0, user_id=''):
         """
@@ -977,11 +1207,10 @@ class ZK(object):
             else:
                 return False # probably empty!
         if not uid:
-            users = self.get_users()
-            users = list(filter(lambda x: x.user_id==str(user_id), users))
-            if not users:
+            user = self.get_user_directory().get_by_user_id(user_id)
+            if user is None:
                 return False
-            uid = users[0].uid
+            uid = user.uid
         command = const.CMD_DELETE_USERTEMP
         command_string = pack('hb', uid, temp_id)
         cmd_response = self.__send_command(command, command_string)
@@ -999,20 +1228,22 @@ class ZK(object):
         :return: bool
         """
         if not uid:
-            users = self.get_users()
-            users = list(filter(lambda x: x.user_id==str(user_id), users))
-            if not users:
+            user = self.get_user_directory().get_by_user_id(user_id)
+            if user is None:
                 return False
-            uid = users[0].uid
+            uid = user.uid
         command = const.CMD_DELETE_USER
         command_string = pack('h', uid)
         cmd_response = self.__send_command(command, command_string)
         if not cmd_response.get('status'):
             raise ZKErrorResponse("Can't delete user")
+        if self.__directory is not None:
+            self.__directory.remove(uid)
         self.refresh_data()
         if uid == (self.next_uid - 1):
             self.next_uid = uid
 
+    @with_deadline('get_user_template')
     def get_user_template(self, uid, temp_id=0, user_id=''):
         """
         :param uid: user ID that are generated from device
@@ -1020,19 +1251,17 @@ class ZK(object):
         :return: list Finger object of the selected user
         """
         if not uid:
-            users = self.get_users()
-            users = list(filter(lambda x: x.user_id==str(user_id), users))
-            if not users:
+            user = self.get_user_directory().get_by_user_id(user_id)
+            if user is None:
                 return False
-            uid = users[0].uid
-        for _retries in range(3):
+            uid = user.uid
+        for _attempt in self.policy.attempts('get_user_template', self.deadline, uid=uid, temp_id=temp_id):
             command = 88 # command secret!!! GET_USER_TEMPLATE
             command_string = pack('hb', uid, temp_id)
-            response_size = 1024 + 8
-            cmd_response = self.__send_command(command, command_string, response_size)
-            data = self.__recieve_chunk()
+            self.__send_packet(command, command_string)
+            data = self.__recieve_buffer()
             if data is not None:
-                resp = data[:-1]
+                resp = data[:-1].tobytes()
                 if resp[-6:] == b'\x00\x00\x00\x00\x00\x00': # padding? bug?
                     resp = resp[:-6]
                 return Finger(uid, temp_id, 1, resp)
@@ -1041,90 +1270,116 @@ class ZK(object):
             if self.verbose: print ("Can't read/find finger")
             return None
 
+    @with_deadline('get_templates')
     def get_templates(self):
         """
+        the whole buffer is downloaded at once and every template is a
+        memoryview slice of it (no copies)
+
         :return: list of Finger object
         """
         self.read_sizes()
         if self.fingers == 0:
             return []
-        templates = []
         templatedata, size = self.read_with_buffer(const.CMD_DB_RRQ, const.FCT_FINGERTMP)
         if size < 4:
             if self.verbose: print("WRN: no user data")
             return []
-        total_size = unpack('i', templatedata[0:4])[0]
-        if self.verbose: print ("get template total size {}, size {} len {}".format(total_size, size, len(templatedata)))
-        templatedata = templatedata[4:]
-        while total_size:
-            size, uid, fid, valid = unpack('HHbb',templatedata[:6])
-            template = unpack("%is" % (size-6), templatedata[6:size])[0]
-            finger = Finger(uid, fid, valid, template)
+        templatedata = memoryview(templatedata)
+        templates = []
+        for offset, _size in split_buffer(templatedata):
+            finger = decode_template(templatedata, offset)
             if self.verbose: print(finger)
             templates.append(finger)
-            templatedata = templatedata[size:]
-            total_size -= size
         return templates
 
+    @with_deadline('iter_templates')
+    def iter_templates(self):
+        """
+        like get_templates, but each Finger is decoded and yielded as soon
+        as its 1504 chunk arrives (memory stays bounded by the chunk size).
+        Consume (or close) it before sending other commands.
+
+        :return: generator of Finger object
+        """
+        self.read_sizes()
+        if self.fingers == 0:
+            return
+        for templatedata, offset, size in self.__iter_records(const.CMD_DB_RRQ, const.FCT_FINGERTMP):
+            finger = decode_template(templatedata, offset)
+            if self.verbose: print(finger)
+            yield finger
+
+    @with_deadline('get_users')
     def get_users(self):
         """
+        the users are also kept as the user directory of the session (see
+        get_user_directory)
+
         :return: list of User object
         """
+        users = list(self.iter_users())
+        self.__directory = UserDirectory(users)
+        return users
+
+    def get_user_directory(self, refresh=False):
+        """
+        users indexed by uid and user_id, cached for the session. It is
+        downloaded (get_users) only when missing, when refresh is set or
+        when the users counter of read_sizes doesn't match it any more;
+        set_user, set_users, save_users_templates and delete_user update
+        it, clear_data empties it.
+
+        :return: UserDirectory
+        """
+        if refresh:
+            self.__directory = None
+        else:
+            self.read_sizes() # drops a stale directory
+        return self.__user_directory()
+
+    def __user_directory(self, directory=None):
+        """
+        directory given by the caller (UserDirectory or list of User), or
+        the cached one (read_sizes must be fresh)
+        """
+        if directory is not None:
+            if not isinstance(directory, UserDirectory):
+                directory = UserDirectory(directory)
+            return directory
+        if self.__directory is None:
+            self.get_users()
+        return self.__directory
+
+    @with_deadline('iter_users')
+    def iter_users(self):
+        """
+        like get_users, but each User is decoded and yielded as soon as its
+        1504 chunk arrives (memory stays bounded by the chunk size).
+        next_uid and next_user_id are updated once the generator is exhausted.
+        Consume (or close) it before sending other commands.
+
+        :return: generator of User object
+        """
         self.read_sizes()
         if self.users == 0:
             self.next_uid = 1
             self.next_user_id='1'
-            return []
-        users = []
+            return
+        def record_size(total_size):
+            self.user_packet_size = total_size / self.users
+            if not self.user_packet_size in [28, 72]:
+                if self.verbose: print("WRN packet size would be  %i" % self.user_packet_size)
+            return 28 if self.user_packet_size == 28 else 72
         max_uid = 0
-        userdata, size = self.read_with_buffer(const.CMD_USERTEMP_RRQ, const.FCT_USER)
-        if self.verbose: print("user size {} (= {})".format(size, len(userdata)))
-        if size <= 4:
-            print("WRN: missing user data")
-            return []
-        total_size = unpack("I",userdata[:4])[0]
-        self.user_packet_size = total_size / self.users
-        if not self.user_packet_size in [28, 72]:
-            if self.verbose: print("WRN packet size would be  %i" % self.user_packet_size)
-        userdata = userdata[4:]
-        if self.user_packet_size == 28:
-            while len(userdata) >= 28:
-                uid, privilege, password, name, card, group_id, timezone, user_id = unpack('<HB5s8sIxBhI',userdata.ljust(28, b'\x00')[:28])
-                if uid > max_uid: max_uid = uid
-                password = (password.split(b'\x00')[0]).decode(self.encoding, errors='ignore')
-                name = (name.split(b'\x00')[0]).decode(self.encoding, errors='ignore').strip()
-                group_id = str(group_id)
-                user_id = str(user_id)
-                #TODO: check card value and find in ver8
-                if not name:
-                    name = "NN-%s" % user_id
-                user = User(uid, name, privilege, password, group_id, user_id, card)
-                users.append(user)
-                if self.verbose: print("[6]user:",uid, privilege, password, name, card, group_id, timezone, user_id)
-                userdata = userdata[28:]
-        else:
-            while len(userdata) >= 72:
-                uid, privilege, password, name, card, group_id, user_id = unpack('<HB8s24sIx7sx24s', userdata.ljust(72, b'\x00')[:72])
-                password = (password.split(b'\x00')[0]).decode(self.encoding, errors='ignore')
-                name = (name.split(b'\x00')[0]).decode(self.encoding, errors='ignore').strip()
-                group_id = (group_id.split(b'\x00')[0]).decode(self.encoding, errors='ignore').strip()
-                user_id = (user_id.split(b'\x00')[0]).decode(self.encoding, errors='ignore')
-                if uid > max_uid: max_uid = uid
-                if not name:
-                    name = "NN-%s" % user_id
-                user = User(uid, name, privilege, password, group_id, user_id, card)
-                users.append(user)
-                userdata = userdata[72:]
-        max_uid += 1
-        self.next_uid = max_uid
-        self.next_user_id = str(max_uid)
-        while True:
-            if any(u for u in users if u.user_id == self.next_user_id):
-                max_uid += 1
-                self.next_user_id = str(max_uid)
-            else:
-                break
-        return users
+        user_ids = set()
+        for userdata, offset, size in self.__iter_records(const.CMD_USERTEMP_RRQ, const.FCT_USER, record_size):
+            user = decode_user(userdata, offset, size, self.encoding)
+            if self.verbose: print("user:", user)
+            if user.uid > max_uid: max_uid = user.uid
+            user_ids.add(user.user_id)
+            yield user
+        self.next_uid, self.next_user_id = next_user_ids(max_uid, user_ids)
 
     def cancel_capture(self):
         """
@@ -1179,12 +1434,10 @@ class ZK(object):
         command = const.CMD_STARTENROLL
         done = False
         if  not user_id:
-            users = self.get_users()
-            users = list(filter(lambda x: x.uid==uid, users))
-            if len(users) >= 1:
-                user_id = users[0].user_id
-            else:
+            user = self.get_user_directory().get_by_uid(uid)
+            if user is None:
                 return False
+            user_id = user.user_id
         if self.tcp:
             command_string = pack('<24sbb',str(user_id).encode(), temp_id, 1)
         else:
@@ -1262,12 +1515,20 @@ class ZK(object):
         self.verify_user()
         return done
 
-    def live_capture(self, new_timeout=10):
+    def live_capture(self, new_timeout=10, raw_time=False, directory=None):
         """
         try live capture of events
+
+        :param raw_time: keep the device time (Attendance.device_time) and
+            build the timestamp datetime lazily, on first access
+        :param directory: pre-fetched UserDirectory (or list of User) to
+            join the events, None: the cached one (get_user_directory)
         """
         was_enabled = self.is_enabled
-        users = self.get_users()
+        if directory is None:
+            users = self.get_user_directory()
+        else:
+            users = self.__user_directory(directory)
         self.cancel_capture()
         self.verify_user()
         if not self.is_enabled:
@@ -1282,12 +1543,12 @@ class ZK(object):
                 data_recv = self.__sock.recv(1032)
                 self.__ack_ok()
                 if self.tcp:
-                    size = unpack('<HHI', data_recv[:8])[2]
-                    header = unpack('HHHH', data_recv[8:16])
+                    size = TCP_TOP.unpack_from(data_recv)[2]
+                    header = HEADER.unpack_from(data_recv, 8)
                     data = data_recv[16:]
                 else:
                     size = len(data_recv)
-                    header = unpack('<4H', data_recv[:8])
+                    header = HEADER.unpack_from(data_recv)
                     data = data_recv[8:]
                 if not header[0] == const.CMD_REG_EVENT:
                     if self.verbose: print("not event! %x" % header[0])
@@ -1295,30 +1556,8 @@ class ZK(object):
                 if not len(data):
                     if self.verbose: print ("empty")
                     continue
-                while len(data) >= 12:
-                    if len(data) == 12:
-                        user_id, status, punch, timehex = unpack('<IBB6s', data)
-                        data = data[12:]
-                    elif len(data) == 32:
-                        user_id,  status, punch, timehex = unpack('<24sBB6s', data[:32])
-                        data = data[32:]
-                    elif len(data) == 36:
-                        user_id,  status, punch, timehex, _other = unpack('<24sBB6s4s', data[:36])
-                        data = data[36:]
-                    elif len(data) >= 52:
-                        user_id,  status, punch, timehex, _other = unpack('<24sBB6s20s', data[:52])
-                        data = data[52:]
-                    if isinstance(user_id, int):
-                        user_id = str(user_id)
-                    else:
-                        user_id = (user_id.split(b'\x00')[0]).decode(errors='ignore')
-                    timestamp = self.__decode_timehex(timehex)
-                    tuser = list(filter(lambda x: x.user_id == user_id, users))
-                    if not tuser:
-                        uid = int(user_id)
-                    else:
-                        uid = tuser[0].uid
-                    yield Attendance(user_id, timestamp, status, punch, uid)
+                for attendance in decode_events(data, users, raw_time):
+                    yield attendance
             except timeout:
                 if self.verbose: print ("time out")
                 yield None # return to keep watching
@@ -1342,267 +1581,536 @@ class ZK(object):
         cmd_response = self.__send_command(command, command_string)
         if cmd_response.get('status'):
             self.next_uid = 1
+            self.__directory = UserDirectory()
             return True
         else:
             raise ZKErrorResponse("can't clear data")
 
-    def __recieve_tcp_data(self, data_recv, size):
-        """ data_recv, raw tcp packet
-         must analyze tcp_length
-
-         must return data, broken
-         """
-        data = []
-        tcp_length = self.__test_tcp_top(data_recv)
-        if self.verbose: print ("tcp_length {}, size {}".format(tcp_length, size))
-        if tcp_length <= 0:
-            if self.verbose: print ("Incorrect tcp packet")
-            return None, b""
-        if (tcp_length - 8) < size:
-            if self.verbose: print ("tcp length too small... retrying")
-            resp, bh = self.__recieve_tcp_data(data_recv, tcp_length - 8)
-            data.append(resp)
-            size -= len(resp)
-            if self.verbose: print ("new tcp DATA packet to fill misssing {}".format(size))
-            data_recv = bh + self.__sock.recv(size + 16 )
-            if self.verbose: print ("new tcp DATA starting with {} bytes".format(len(data_recv)))
-            resp, bh = self.__recieve_tcp_data(data_recv, size)
-            data.append(resp)
-            if self.verbose: print ("for misssing {} recieved {} with extra {}".format(size, len(resp), len(bh)))
-            return b''.join(data), bh
-        recieved = len(data_recv)
-        if self.verbose: print ("recieved {}, size {}".format(recieved, size))
-        response = unpack('HHHH', data_recv[8:16])[0]
-        if recieved >= (size + 32):
+    def __recv_into(self, view):
+        """
+        fill the whole memoryview from the socket, without copies
+        """
+        received = 0
+        size = len(view)
+        while received < size:
+            count = self.__sock.recv_into(view[received:], size - received)
+            if not count:
+                raise ZKNetworkError("connection closed")
+            received += count
+        return received
+
+    def __recieve_tcp_header(self):
+        """
+        read the tcp top and the header of the next tcp packet
+
+        :return: response code, reply id, payload size
+        """
+        self.__recv_into(memoryview(self.__recv_header))
+        magic1, magic2, length, response, _checksum, _session_id, reply_id = TCP_HEADER.unpack_from(self.__recv_header)
+        if magic1 != const.MACHINE_PREPARE_DATA_1 or magic2 != const.MACHINE_PREPARE_DATA_2 or length < 8:
+            raise ZKNetworkError("TCP packet invalid")
+        return response, reply_id, length - 8
+
+    def __recieve_tcp_payload(self, size):
+        """
+        read a (small) tcp payload into the reusable scratch buffer
+        """
+        if len(self.__recv_scratch) < size:
+            self.__recv_scratch = bytearray(size)
+        view = memoryview(self.__recv_scratch)[:size]
+        self.__recv_into(view)
+        return view
+
+    def __recieve_udp_packet(self):
+        """
+        read the next udp packet into the reusable packet buffer
+
+        :return: response code, reply id, payload memoryview
+        """
+        count = self.__sock.recv_into(self.__recv_packet)
+        if count < 8:
+            raise ZKNetworkError("UDP packet invalid")
+        response, _checksum, _session_id, reply_id = HEADER.unpack_from(self.__recv_packet)
+        return response, reply_id, memoryview(self.__recv_packet)[8:count]
+
+    def __recieve_buffer(self, view=None):
+        """
+        receive the answer of a buffered command (PREPARE_DATA, DATA
+        packets and ACK_OK, or a direct DATA packet) straight into view
+
+        :param view: writable memoryview with the expected size, or None
+            to allocate it with the size announced by PREPARE_DATA
+        :return: the filled memoryview, None if the answer is broken
+        """
+        if self.tcp:
+            response, self.__reply_id, length = self.__recieve_tcp_header()
             if response == const.CMD_DATA:
-                resp = data_recv[16 : size + 16]
-                if self.verbose: print ("resp complete len {}".format(len(resp)))
-                return resp, data_recv[size + 16:]
-            else:
-                if self.verbose: print("incorrect response!!! {}".format(response))
-                return None, b""
-        else:
-            if self.verbose: print ("try DATA incomplete (actual valid {})".format(recieved-16))
-            data.append(data_recv[16 : size + 16 ])
-            size -= recieved - 16
-            broken_header = b""
-            if size < 0:
-                broken_header = data_recv[size:]
-                if self.verbose: print ("broken", (broken_header).encode('hex'))
-            if size > 0:
-                data_recv = self.__recieve_raw_data(size)
-                data.append(data_recv)
-            return b''.join(data), broken_header
-
-    def __recieve_raw_data(self, size):
-        """ partial data ? """
-        data = []
-        if self.verbose: print ("expecting {} bytes raw data".format(size))
-        while size > 0:
-            data_recv = self.__sock.recv(size)
-            recieved = len(data_recv)
-            if self.verbose: print ("partial recv {}".format(recieved))
-            if recieved < 100 and self.verbose: print ("   recv {}".format(codecs.encode(data_recv, 'hex')))
-            data.append(data_recv)
-            size -= recieved
-            if self.verbose: print ("still need {}".format(size))
-        return b''.join(data)
-
-    def __recieve_chunk(self):
-        """ recieve a chunk """
-        if self.__response == const.CMD_DATA:
-            if self.tcp:
-                if self.verbose: print ("_rc_DATA! is {} bytes, tcp length is {}".format(len(self.__data), self.__tcp_length))
-                if len(self.__data) < (self.__tcp_length - 8):
-                    need = (self.__tcp_length - 8) - len(self.__data)
-                    if self.verbose: print ("need more data: {}".format(need))
-                    more_data = self.__recieve_raw_data(need)
-                    return b''.join([self.__data, more_data])
-                else:
-                    if self.verbose: print ("Enough data")
-                    return self.__data
-            else:
-                if self.verbose: print ("_rc len is {}".format(len(self.__data)))
-                return self.__data
-        elif self.__response == const.CMD_PREPARE_DATA:
-            data = []
-            size = self.__get_data_size()
-            if self.verbose: print ("recieve chunk: prepare data size is {}".format(size))
-            if self.tcp:
-                if len(self.__data) >= (8 + size):
-                    data_recv = self.__data[8:]
-                else:
-                    data_recv = self.__data[8:] + self.__sock.recv(size + 32)
-                resp, broken_header = self.__recieve_tcp_data(data_recv, size)
-                data.append(resp)
-                # get CMD_ACK_OK
-                if len(broken_header) < 16:
-                    data_recv = broken_header + self.__sock.recv(16)
-                else:
-                    data_recv = broken_header
-                if len(data_recv) < 16:
-                    print ("trying to complete broken ACK %s /16" % len(data_recv))
-                    if self.verbose: print (data_recv.encode('hex'))
-                    data_recv += self.__sock.recv(16 - len(data_recv)) #TODO: CHECK HERE_!
-                if not self.__test_tcp_top(data_recv):
-                    if self.verbose: print ("invalid chunk tcp ACK OK")
+                if view is None:
+                    view = memoryview(bytearray(length))
+                if length != len(view):
+                    self.__recieve_tcp_payload(length)
                     return None
-                response = unpack('HHHH', data_recv[8:16])[0]
-                if response == const.CMD_ACK_OK:
-                    if self.verbose: print ("chunk tcp ACK OK!")
-                    return b''.join(data)
-                if self.verbose: print("bad response %s" % data_recv)
-                if self.verbose: print (codecs.encode(data,'hex'))
-                return None
-
-                return resp
-            while True:
-                data_recv = self.__sock.recv(1024+8)
-                response = unpack('<4H', data_recv[:8])[0]
-                if self.verbose: print ("# packet response is: {}".format(response))
-                if response == const.CMD_DATA:
-                    data.append(data_recv[8:])
-                    size -= 1024
-                elif response == const.CMD_ACK_OK:
-                    break
-                else:
-                    if self.verbose: print ("broken!")
-                    break
-                if self.verbose: print ("still needs %s" % size)
-            return b''.join(data)
+                self.__recv_into(view)
+                return view
+            payload = self.__recieve_tcp_payload(length)
         else:
-            if self.verbose: print ("invalid response %s" % self.__response)
+            response, self.__reply_id, payload = self.__recieve_udp_packet()
+            if response == const.CMD_DATA:
+                if view is None:
+                    view = memoryview(bytearray(len(payload)))
+                if len(payload) != len(view):
+                    return None
+                view[:] = payload
+                return view
+        if response != const.CMD_PREPARE_DATA or len(payload) < 4:
+            if self.verbose: print ("invalid response %s" % response)
             return None
-
-    def __read_chunk(self, start, size):
-        """
-        read a chunk from buffer
-        """
-        for _retries in range(3):
-            command = 1504
-            command_string = pack('<ii', start, size)
+        size = PREPARE_DATA.unpack_from(payload)[0]
+        if self.verbose: print ("recieve buffer: prepare data size is {}".format(size))
+        if view is None:
+            view = memoryview(bytearray(size))
+        if size != len(view):
+            if self.verbose: print ("unexpected size {} (want {})".format(size, len(view)))
+            return None
+        received = 0
+        while True:
             if self.tcp:
-                response_size = size + 32
+                response, _reply_id, length = self.__recieve_tcp_header()
+                if response == const.CMD_DATA and received + length <= size:
+                    self.__recv_into(view[received:received + length])
+                    received += length
+                    continue
+                self.__recieve_tcp_payload(length)
             else:
-                response_size = 1024 + 8
-            cmd_response = self.__send_command(command, command_string, response_size)
-            data = self.__recieve_chunk()
-            if data is not None:
-                return data
+                response, _reply_id, payload = self.__recieve_udp_packet()
+                length = len(payload)
+                if response == const.CMD_DATA and received + length <= size:
+                    view[received:received + length] = payload
+                    received += length
+                    continue
+            break
+        if response == const.CMD_ACK_OK and received == size:
+            return view
+        if self.verbose: print ("broken buffer, response {} recieved {}/{}".format(response, received, size))
+        return None
+
+    def __read_chunk_into(self, view, start):
+        """
+        read a chunk from buffer straight into view
+        """
+        size = len(view)
+        for _attempt in self.policy.attempts('read chunk', self.deadline, start=start, size=size):
+            self.__send_packet(1504, READ_CHUNK.pack(start, size))
+            if self.__recieve_buffer(view) is not None:
+                self.__chunk_done(start, size)
+                return size
+            if self.verbose: print ("retry read chunk %i:[%i]" % (start, size))
         else:
             raise ZKErrorResponse("can't read chunk %i:[%i]" % (start, size))
 
-    def read_with_buffer(self, command, fct=0 ,ext=0):
+    def __prepare_buffer(self, command, fct=0, ext=0):
         """
-        Test read info with buffered command (ZK6: 1503)
+        ask the device to prepare a buffered read (ZK6: 1503)
+
+        :return: size of the prepared buffer, and its data when the device
+            sent it directly (None otherwise)
         """
-        if self.tcp:
-            MAX_CHUNK = 0xFFc0
-        else:
-            MAX_CHUNK = 16 * 1024
-        command_string = pack('<bhii', 1, command, fct, ext)
+        command_string = PREPARE_BUFFER.pack(1, command, fct, ext)
         if self.verbose: print ("rwb cs", command_string)
         response_size = 1024
-        data = []
-        start = 0
         cmd_response = self.__send_command(1503, command_string, response_size)
         if not cmd_response.get('status'):
             raise ZKErrorResponse("RWB Not supported")
         if cmd_response['code'] == const.CMD_DATA:
-            if self.tcp:
+            if self.tcp and len(self.__data) < (self.__tcp_length - 8):
                 if self.verbose: print ("DATA! is {} bytes, tcp length is {}".format(len(self.__data), self.__tcp_length))
-                if len(self.__data) < (self.__tcp_length - 8):
-                    need = (self.__tcp_length - 8) - len(self.__data)
-                    if self.verbose: print ("need more data: {}".format(need))
-                    more_data = self.__recieve_raw_data(need)
-                    return b''.join([self.__data, more_data]), len(self.__data) + len(more_data)
+                data = bytearray(self.__tcp_length - 8)
+                data[:len(self.__data)] = self.__data
+                self.__recv_into(memoryview(data)[len(self.__data):])
+                return len(data), data
+            return len(self.__data), self.__data
+        size = TOTAL_SIZE.unpack_from(self.__data, 1)[0]
+        if self.verbose: print ("size fill be %i" % size)
+        if self.deadline is not None:
+            self.deadline.extend(size)
+        return size, None
+
+    def __max_chunk(self):
+        """ 1504 chunk size for the current transport """
+        if self.tcp:
+            return 0xFFc0
+        return 16 * 1024
+
+    def __read_region_into(self, view, start):
+        """
+        read the prepared buffer from start into view, in 1504 chunks
+        (pipelined when enabled)
+        """
+        if self.chunk_tuner is not None and self.pipeline <= 1:
+            return self.__read_adaptive_into(view, start)
+        MAX_CHUNK = self.__max_chunk()
+        if self.chunk_tuner is not None:
+            MAX_CHUNK = self.chunk_tuner.size
+        chunks = [(offset, min(MAX_CHUNK, len(view) - offset)) for offset in range(0, len(view), MAX_CHUNK)]
+        if self.pipeline > 1 and len(chunks) > 1:
+            chunks = self.__read_pipelined_into(view, start, chunks)
+        for offset, size in chunks:
+            self.__read_chunk_into(view[offset:offset + size], start + offset)
+
+    def __read_adaptive_into(self, view, start):
+        """
+        serial 1504 reads with the chunk size of self.chunk_tuner, measured
+        per chunk: a broken chunk is read again with the (smaller) size
+        the tuner picks, up to 3 times at its minimum size
+        """
+        tuner = self.chunk_tuner
+        offset = 0
+        failures = 0
+        while offset < len(view):
+            size = min(tuner.size, len(view) - offset)
+            inicio = time.time()
+            self.__send_packet(1504, READ_CHUNK.pack(start + offset, size))
+            ok = self.__recieve_buffer(view[offset:offset + size]) is not None
+            tuner.record(size, time.time() - inicio, ok)
+            if ok:
+                self.__chunk_done(start + offset, size)
+                offset += size
+                failures = 0
+                continue
+            if self.verbose: print ("retry read chunk %i:[%i] as [%i]" % (start + offset, size, tuner.size))
+            self.policy.report('retry', operation='read chunk', start=start + offset, size=size, next_size=tuner.size)
+            if size <= tuner.minimum:
+                failures += 1
+                if failures >= 3:
+                    raise ZKErrorResponse("can't read chunk %i:[%i]" % (start + offset, size))
+
+    def __read_pipelined_into(self, view, start, chunks):
+        """
+        1504 requests with up to self.pipeline of them in flight, the
+        answers are matched to their chunk by reply_id. A broken answer
+        leaves its chunk for a serial read. When the device rejects a
+        request no new request is sent, the ones in flight are drained and
+        pipelining is disabled (self.pipeline = 0, set it again to retry).
+        After a timeout no new request is sent either and the answers in
+        flight get one more timeout to arrive: late answers left on the
+        link would be taken for the answers of the next commands, so if
+        they don't the session is dropped and the read fails
+        (ZKNetworkError, reconnect, see resume).
+
+        :return: list of (offset, size) chunks still missing
+        """
+        pending = list(chunks)
+        missing = []
+        inflight = {} # reply_id: [offset, size, received, prepared]
+        window = self.pipeline
+        if not self.tcp: # datagrams beyond the socket buffer are dropped
+            window = min(window, max(2, self.__sock.getsockopt(SOL_SOCKET, SO_RCVBUF) // (4 * chunks[0][1])))
+        draining = False
+        while inflight or (pending and not draining):
+            while pending and not draining and len(inflight) < window:
+                offset, size = pending.pop(0)
+                self.__send_packet(1504, READ_CHUNK.pack(start + offset, size))
+                self.__reply_id += 1
+                if self.__reply_id >= const.USHRT_MAX:
+                    self.__reply_id -= const.USHRT_MAX
+                inflight[self.__reply_id] = [offset, size, 0, False]
+            try:
+                if self.tcp:
+                    response, reply_id, length = self.__recieve_tcp_header()
                 else:
-                    if self.verbose: print ("Enough data")
-                    size = len(self.__data)
-                    return self.__data, size
+                    response, reply_id, payload = self.__recieve_udp_packet()
+                    length = len(payload)
+            except timeout:
+                if draining:
+                    self.is_connect = False
+                    self.__sock.close()
+                    raise ZKNetworkError("pipelined read: %i answers lost, reconnect" % len(inflight))
+                if self.verbose: print ("pipeline timeout, draining {} chunks in flight".format(len(inflight)))
+                draining = True
+                continue
+            state = inflight.get(reply_id)
+            if state is not None and response == const.CMD_DATA and state[2] + length <= state[1]:
+                target = view[state[0] + state[2]:state[0] + state[2] + length]
+                if self.tcp:
+                    self.__recv_into(target)
+                else:
+                    target[:] = payload
+                state[2] += length
+                if not state[3] and state[2] == state[1]:
+                    del inflight[reply_id] # direct DATA answer, no ACK_OK
+                    self.__chunk_done(start + state[0], state[1])
+                continue
+            if self.tcp:
+                self.__recieve_tcp_payload(length)
+            if state is None:
+                if self.verbose: print ("pipeline: unexpected reply_id {}".format(reply_id))
+            elif response == const.CMD_PREPARE_DATA:
+                state[3] = True
+            elif response == const.CMD_ACK_OK and state[2] == state[1]:
+                del inflight[reply_id]
+                self.__chunk_done(start + state[0], state[1])
+            elif response == const.CMD_ACK_OK:
+                if self.verbose: print ("pipeline: broken chunk %i:[%i]" % (start + state[0], state[1]))
+                del inflight[reply_id]
+                missing.append((state[0], state[1]))
             else:
-                size = len(self.__data)
-                return self.__data, size
-        size = unpack('I', self.__data[1:5])[0]
-        if self.verbose: print ("size fill be %i" % size)
-        remain = size % MAX_CHUNK
-        packets = (size-remain) // MAX_CHUNK # should be size /16k
-        if self.verbose: print ("rwb: #{} packets of max {} bytes, and extra {} bytes remain".format(packets, MAX_CHUNK, remain))
-        for _wlk in range(packets):
-            data.append(self.__read_chunk(start,MAX_CHUNK))
-            start += MAX_CHUNK
-        if remain:
-            data.append(self.__read_chunk(start, remain))
-            start += remain
+                if self.verbose: print ("pipeline rejected (response {}), serial reads from now".format(response))
+                del inflight[reply_id]
+                missing.append((state[0], state[1]))
+                missing.extend(pending)
+                pending = []
+                self.pipeline = 0
+        missing.extend(pending)
+        return sorted(missing)
+
+    def __read_buffer(self, size, start=0):
+        """
+        read the prepared buffer from start to size (1504 chunks) into a
+        single preallocated bytearray
+        """
+        data = bytearray(size - start)
+        view = memoryview(data)
+        self.__read_region_into(view, start)
+        release(view)
+        if self.verbose: print ("_read w/chunk %i bytes" % (size - start))
+        return data
+
+    @with_deadline('read_with_buffer')
+    def read_with_buffer(self, command, fct=0 ,ext=0):
+        """
+        Test read info with buffered command (ZK6: 1503)
+
+        the whole transfer is received into a single preallocated bytearray.
+        When it breaks, what was received is kept in self.read_checkpoint:
+        the next read of the same buffer (ie: after reconnect) prepares it
+        again and, if the device buffer has the same size, only reads from
+        the first missing offset. With self.resume it reconnects and
+        continues by itself (set read_checkpoint to None to drop it).
+        """
+        attempts = 0
+        while True:
+            size, data = self.__prepare_buffer(command, fct, ext)
+            if data is not None:
+                self.read_checkpoint = None
+                return data, size
+            checkpoint = self.read_checkpoint
+            if checkpoint is None or not checkpoint.matches(command, fct, ext, size):
+                checkpoint = self.read_checkpoint = ReadCheckpoint(command, fct, ext, size, bytearray(size))
+            elif self.verbose: print ("resuming read at %i/%i" % (checkpoint.offset, size))
+            offset = checkpoint.offset
+            view = memoryview(checkpoint.data)
+            self.__progress = checkpoint
+            try:
+                self.__read_region_into(view[offset:], offset)
+            except (ZKErrorResponse, ZKNetworkError, socket_error) as e:
+                if attempts >= self.resume or isinstance(e, ZKErrorDeadline):
+                    raise
+                attempts += 1
+                if self.verbose: print ("broken read at %i/%i (%s), reconnecting" % (checkpoint.offset, size, e))
+                self.policy.wait('resume', attempts + 1, self.deadline, offset=checkpoint.offset, size=size)
+                self.reconnect()
+                continue
+            finally:
+                self.__progress = None
+                release(view)
+            self.read_checkpoint = None
+            self.free_data()
+            return checkpoint.data, size
+
+    def __refresh_after_failure(self):
+        """
+        refresh_data after a failed upload (the users saved before it are
+        applied), a failure is only logged so it doesn't replace the error
+        of the upload
+        """
+        try:
+            self.refresh_data()
+        except (ZKError, socket_error) as e:
+            if self.verbose: print ("can't refresh data: %s" % e)
+
+    def __free_buffer(self):
+        """
+        free_data after a 1504 read, a failure (ie: the link is gone) is
+        only logged so it doesn't replace the error of the read
+        """
+        try:
+            self.free_data()
+        except (ZKError, socket_error) as e:
+            if self.verbose: print ("can't free data: %s" % e)
+
+    def __chunk_done(self, start, size):
+        if self.__progress is not None:
+            self.__progress.done(start, size)
+
+    def __iter_buffer(self, command, fct=0, ext=0):
+        """
+        buffered command (ZK6: 1503) read chunk by chunk (a window of
+        self.pipeline chunks when pipelined), each chunk is yielded as soon
+        as it arrives. The buffer is reused, so a chunk is only valid until
+        the next iteration.
+        """
+        size, data = self.__prepare_buffer(command, fct, ext)
+        if data is not None:
+            yield memoryview(data)
+            return
+        MAX_CHUNK = self.__max_chunk()
+        window = MAX_CHUNK * max(1, self.pipeline) # chunks read at once
+        view = memoryview(bytearray(min(window, size)))
+        offset = 0
+        attempts = 0
+        try:
+            while offset < size:
+                region = min(window, size - offset)
+                try:
+                    self.__read_region_into(view[:region], offset)
+                except (ZKErrorResponse, ZKNetworkError, socket_error) as e:
+                    if attempts >= self.resume or isinstance(e, ZKErrorDeadline):
+                        raise
+                    attempts += 1
+                    if self.verbose: print ("broken read at %i/%i (%s), reconnecting" % (offset, size, e))
+                    self.policy.wait('resume', attempts + 1, self.deadline, offset=offset, size=size)
+                    self.reconnect()
+                    if self.__prepare_buffer(command, fct, ext) != (size, None):
+                        raise ZKErrorResponse("device buffer changed, can't resume the read")
+                    continue
+                for chunk in range(0, region, MAX_CHUNK):
+                    yield view[chunk:min(chunk + MAX_CHUNK, region)]
+                offset += region
+        except BaseException: # a broken read or GeneratorExit (the consumer stopped)
+            if self.verbose: print ("_iter w/chunk stopped at %i/%i bytes" % (offset, size))
+            self.__free_buffer() # doesn't replace the error
+            raise
+        if self.verbose: print ("_iter w/chunk %i/%i bytes" % (offset, size))
         self.free_data()
-        if self.verbose: print ("_read w/chunk %i bytes" % start)
-        return b''.join(data), start
 
-    def get_attendance(self):
+    def __iter_records(self, command, fct=0, record_size=None):
+        """
+        split a buffered command into records as its chunks arrive, only
+        the chunk and the incomplete record at its end are kept in memory
+
+        :param record_size: function(total_size) returning the fixed size
+            of the records, None when every record starts with its size (H)
+        :return: generator of (buffer, offset, size), decode the record
+            before the next iteration (the buffer is reused)
+        """
+        splitter = RecordSplitter(record_size)
+        for chunk in self.__iter_buffer(command, fct):
+            for record in splitter.feed(chunk):
+                yield record
+        if splitter.total_size is None:
+            if self.verbose: print ("WRN: no data")
+
+    @with_deadline('get_attendance')
+    def get_attendance(self, raw_time=False, directory=None):
         """
         return attendance record
 
+        :param raw_time: keep the device time (Attendance.device_time, or
+            Attendance.epoch for POSIX seconds) and build the timestamp
+            datetime lazily, on first access
+        :param directory: pre-fetched UserDirectory (or list of User) to
+            join the records, None: the cached one (get_user_directory)
         :return: List of Attendance object
         """
+        return list(self.iter_attendance(raw_time, directory))
+
+    @with_deadline('iter_attendance')
+    def iter_attendance(self, raw_time=False, directory=None):
+        """
+        like get_attendance, but each Attendance is decoded and yielded as
+        soon as its 1504 chunk arrives (memory stays bounded by the chunk
+        size). Consume (or close) it before sending other commands.
+
+        :param raw_time: lazy timestamps (see get_attendance)
+        :param directory: pre-fetched users (see get_attendance)
+        :return: generator of Attendance object
+        """
         self.read_sizes()
         if self.records == 0:
-            return []
-        users = self.get_users()
-        if self.verbose: print (users)
-        attendances = []
-        attendance_data, size = self.read_with_buffer(const.CMD_ATTLOG_RRQ)
+            return
+        users = self.__user_directory(directory)
+        if self.verbose: print (users.users)
+        def record_size(total_size):
+            if self.verbose: print ("record_size is ", total_size/self.records)
+            return attendance_record_size(total_size, self.records)
+        for attendance_data, offset, size in self.__iter_records(const.CMD_ATTLOG_RRQ, record_size=record_size):
+            if self.verbose: print (codecs.encode(bytes(attendance_data[offset:offset + size]), 'hex'))
+            yield decode_attendance(attendance_data, offset, size, users, raw_time)
+
+    @with_deadline('get_attendance_since')
+    def get_attendance_since(self, cursor=None, raw_time=False, directory=None):
+        """
+        return only the attendance records added after cursor, reading
+        just the tail of the device log. Falls back to a full read when
+        the cursor doesn't match the log (ie: after clear_attendance)
+
+        :param cursor: AttendanceCursor returned by the previous call (None: full read)
+        :param raw_time: lazy timestamps (see get_attendance)
+        :param directory: pre-fetched users (see get_attendance)
+        :return: List of Attendance object, new AttendanceCursor
+        """
+        self.read_sizes()
+        if self.records == 0:
+            return [], AttendanceCursor()
+        users = self.__user_directory(directory)
+        size, attendance_data = self.__prepare_buffer(const.CMD_ATTLOG_RRQ)
         if size < 4:
             if self.verbose: print ("WRN: no attendance data")
-            return []
-        total_size = unpack("I", attendance_data[:4])[0]
-        record_size = total_size/self.records
-        if self.verbose: print ("record_size is ", record_size)
-        attendance_data = attendance_data[4:]
-        if record_size == 8:
-            while len(attendance_data) >= 8:
-                uid, status, timestamp, punch = unpack('HB4sB', attendance_data.ljust(8, b'\x00')[:8])
-                if self.verbose: print (codecs.encode(attendance_data[:8], 'hex'))
-                attendance_data = attendance_data[8:]
-                tuser = list(filter(lambda x: x.uid == uid, users))
-                if not tuser:
-                    user_id = str(uid)
+            return [], AttendanceCursor()
+        record_size = {8: 8, 16: 16}.get((size - 4) // self.records, 40)
+        records = (size - 4) // record_size
+        prepared = attendance_data is None # read with 1504, freed at the end
+        data = None
+        try:
+            if cursor and cursor.records and cursor.record_size == record_size and cursor.records <= records:
+                start = 4 + (cursor.records - 1) * record_size
+                if prepared:
+                    tail_data = self.__read_buffer(size, start)
+                    tail = memoryview(tail_data)
                 else:
-                    user_id = tuser[0].user_id
-                timestamp = self.__decode_time(timestamp)
-                attendance = Attendance(user_id, timestamp, status, punch, uid)
-                attendances.append(attendance)
-        elif record_size == 16:
-            while len(attendance_data) >= 16:
-                user_id, timestamp, status, punch, reserved, workcode = unpack('<I4sBB2sI', attendance_data.ljust(16, b'\x00')[:16])
-                user_id = str(user_id)
-                if self.verbose: print(codecs.encode(attendance_data[:16], 'hex'))
-                attendance_data = attendance_data[16:]
-                tuser = list(filter(lambda x: x.user_id == user_id, users))
-                if not tuser:
-                    if self.verbose: print("no uid {}", user_id)
-                    uid = str(user_id)
-                    tuser = list(filter(lambda x: x.uid == user_id, users))
-                    if not tuser:
-                        uid = str(user_id)
-                    else:
-                        uid = tuser[0].uid
-                        user_id = tuser[0].user_id
+                    tail = memoryview(attendance_data)[start:]
+                if cursor.match(tail[:record_size]):
+                    if self.verbose: print ("cursor ok, reading from record %i" % cursor.records)
+                    data = tail[record_size:]
+                    last = tail[len(tail) - record_size:]
                 else:
-                    uid = tuser[0].uid
-                timestamp = self.__decode_time(timestamp)
-                attendance = Attendance(user_id, timestamp, status, punch, uid)
-                attendances.append(attendance)
-        else:
-            while len(attendance_data) >= 40:
-                uid, user_id, status, timestamp, punch, space = unpack('<H24sB4sB8s', attendance_data.ljust(40, b'\x00')[:40])
-                if self.verbose: print (codecs.encode(attendance_data[:40], 'hex'))
-                user_id = (user_id.split(b'\x00')[0]).decode(errors='ignore')
-                timestamp = self.__decode_time(timestamp)
-
-                attendance = Attendance(user_id, timestamp, status, punch, uid)
-                attendances.append(attendance)
-                attendance_data = attendance_data[40:]
-        return attendances
+                    if self.verbose: print ("cursor mismatch, full read")
+                    if prepared: # the tail is kept, only the head is read
+                        release(tail)
+                        attendance_data = self.__read_buffer(start)
+                        attendance_data += tail_data
+            if data is None:
+                if attendance_data is None:
+                    attendance_data = self.__read_buffer(size)
+                data = memoryview(attendance_data)[4:]
+                last = data[len(data) - record_size:]
+        finally:
+            if prepared:
+                self.__free_buffer()
+        attendances = decode_attendances(data, record_size, users, raw_time)
+        return attendances, AttendanceCursor(records, record_size, AttendanceCursor.checksum(last))
+
+    @with_deadline('get_attendance_columns')
+    def get_attendance_columns(self, use_numpy=None):
+        """
+        return attendance records decoded at once, as columns (NumPy
+        arrays when available, tuples otherwise)
+
+        :param use_numpy: force (True) or disable (False) NumPy, None: auto
+        :return: dict of columns: uid, user_id, status, punch, workcode,
+            timestamp (POSIX seconds, device time as UTC)
+        """
+        self.read_sizes()
+        if self.records == 0:
+            return columnar.decode_attendance(b'', 40, use_numpy)
+        attendance_data, size = self.read_with_buffer(const.CMD_ATTLOG_RRQ)
+        if size < 4:
+            if self.verbose: print ("WRN: no attendance data")
+            return columnar.decode_attendance(b'', 40, use_numpy)
+        total_size = TOTAL_SIZE.unpack_from(attendance_data)[0]
+        record_size = attendance_record_size(total_size, self.records)
+        if self.verbose: print ("record_size is ", record_size)
+        return columnar.decode_attendance(memoryview(attendance_data)[4:4 + total_size], record_size, use_numpy)
 
     def clear_attendance(self):
         """
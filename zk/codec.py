@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+record layouts of the ZK protocol, compiled once
+
+every fixed size record (packet headers, users, templates, attendances,
+live events, buffered read and upload commands) is declared here as a
+Layout: a precompiled struct.Struct plus the field names. Decoders use
+``LAYOUT.unpack_from(data, offset)`` (no format parsing per call) or
+``LAYOUT.iter_unpack(data)`` for a whole buffer, and uploads build their
+buffers with ``LAYOUT.pack_all(rows)``.
+"""
+from itertools import starmap
+from struct import Struct
+
+
+class Layout(object):
+    """
+    a fixed size record: struct format and field names (None: padding)
+    """
+
+    def __init__(self, fmt, fields=()):
+        self.struct = Struct(fmt)
+        self.format = fmt
+        self.fields = tuple(fields)
+        self.size = self.struct.size
+        self.pack = self.struct.pack
+        self.pack_into = self.struct.pack_into
+        self.unpack = self.struct.unpack
+        self.unpack_from = self.struct.unpack_from
+
+    def iter_unpack(self, data, offset=0):
+        """
+        batch decode of every complete record of data from offset (a
+        trailing partial record is ignored)
+
+        :return: iterator of tuples
+        """
+        view = memoryview(data)[offset:]
+        end = len(view) - len(view) % self.size
+        if hasattr(self.struct, 'iter_unpack'):
+            return self.struct.iter_unpack(view[:end])
+        unpack_from = self.unpack_from # python 2
+        return (unpack_from(view, start) for start in range(0, end, self.size))
+
+    def pack_all(self, rows):
+        """
+        bulk encode
+
+        :param rows: iterable of tuples, in field order
+        :return: bytes
+        """
+        return b''.join(starmap(self.struct.pack, rows))
+
+    def __str__(self):
+        return '<Layout>: {} ({} bytes)'.format(self.format, self.size)
+
+    def __repr__(self):
+        return self.__str__()
+
+
+# packets
+HEADER = Layout('<4H', ('command', 'checksum', 'session_id', 'reply_id'))
+TCP_TOP = Layout('<HHI', ('magic1', 'magic2', 'length'))
+TCP_HEADER = Layout('<HHI4H', ('magic1', 'magic2', 'length', 'command', 'checksum', 'session_id', 'reply_id'))
+
+# device time: EncodeTime (attendance, set_time) and 6 bytes timehex (events)
+TIME = Layout('<I', ('time',))
+TIMEHEX = Layout('6B', ('year', 'month', 'day', 'hour', 'minute', 'second'))
+
+# buffered reads (1503 / 1504) and uploads (PREPARE_DATA + DATA, 110)
+PREPARE_BUFFER = Layout('<bhii', ('one', 'command', 'fct', 'ext'))
+READ_CHUNK = Layout('<ii', ('start', 'size'))
+TOTAL_SIZE = Layout('<I', ('size',))
+RECORD_SIZE = Layout('<H', ('size',))
+PREPARE_DATA = Layout('<I', ('size',))
+UPLOAD_HEAD = Layout('<III', ('users', 'table', 'templates'))
+UPLOAD_TABLE = Layout('<bHbI', ('two', 'uid', 'fnum', 'offset'))
+SAVE_UTEMP = Layout('<IHH', ('head', 'reserved', 'table'))
+
+# users, as read (without the leading byte of the records)
+USER = {
+    28: Layout('<HB5s8sIxBhI', ('uid', 'privilege', 'password', 'name', 'card', 'group_id', 'timezone', 'user_id')),
+    72: Layout('<HB8s24sIx7sx24s', ('uid', 'privilege', 'password', 'name', 'card', 'group_id', 'user_id')),
+}
+# users, as sent by set_user (CMD_USER_WRQ)
+USER_WRITE = {
+    28: Layout('<HB5s8sIxBHI', ('uid', 'privilege', 'password', 'name', 'card', 'group_id', 'timezone', 'user_id')),
+    72: Layout('<HB8s24s4sx7sx24s', ('uid', 'privilege', 'password', 'name', 'card', 'group_id', 'user_id')),
+}
+# users, as uploaded (with the leading 2)
+USER_UPLOAD = {
+    29: Layout('<BHB5s8sIxBhI', ('two', 'uid', 'privilege', 'password', 'name', 'card', 'group_id', 'timezone', 'user_id')),
+    73: Layout('<BHB8s24sIB7sx24s', ('two', 'uid', 'privilege', 'password', 'name', 'card', 'one', 'group_id', 'user_id')),
+}
+
+# templates (the template bytes follow the header)
+TEMPLATE = Layout('<HHbb', ('size', 'uid', 'fid', 'valid'))
+TEMPLATE_ONLY = Layout('<H', ('size',))
+
+# attendance records, by record size
+ATTENDANCE = {
+    8: Layout('<HBIB', ('uid', 'status', 'timestamp', 'punch')),
+    16: Layout('<IIBB2sI', ('user_id', 'timestamp', 'status', 'punch', None, 'workcode')),
+    40: Layout('<H24sBIB8s', ('uid', 'user_id', 'status', 'timestamp', 'punch', None)),
+}
+
+# live capture events (CMD_REG_EVENT), by event size
+EVENT = {
+    12: Layout('<IBB6s', ('user_id', 'status', 'punch', 'timehex')),
+    32: Layout('<24sBB6s', ('user_id', 'status', 'punch', 'timehex')),
+    36: Layout('<24sBB6s4s', ('user_id', 'status', 'punch', 'timehex', None)),
+    52: Layout('<24sBB6s20s', ('user_id', 'status', 'punch', 'timehex', None)),
+}
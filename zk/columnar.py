@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+columnar decoders for bulk device buffers
+
+the whole attendance buffer is decoded at once into columns, with NumPy
+(structured dtypes, zero-copy) when available or struct.iter_unpack as
+fallback.
+"""
+from calendar import timegm
+from datetime import datetime
+
+from .codec import ATTENDANCE
+
+try:
+    import numpy
+except ImportError: # optional
+    numpy = None
+
+ATTENDANCE_COLUMNS = ('uid', 'user_id', 'status', 'punch', 'workcode', 'timestamp')
+
+# record size: (struct format, columns in format order) ; None = padding
+ATTENDANCE_FORMATS = dict((size, (layout.format, layout.fields)) for size, layout in ATTENDANCE.items())
+
+if numpy is not None:
+    ATTENDANCE_DTYPES = {
+        8: numpy.dtype([('uid', '<u2'), ('status', 'u1'), ('timestamp', '<u4'), ('punch', 'u1')]),
+        16: numpy.dtype([('user_id', '<u4'), ('timestamp', '<u4'), ('status', 'u1'), ('punch', 'u1'),
+                         ('reserved', 'V2'), ('workcode', '<u4')]),
+        40: numpy.dtype([('uid', '<u2'), ('user_id', 'S24'), ('status', 'u1'), ('timestamp', '<u4'),
+                         ('punch', 'u1'), ('space', 'V8')]),
+    }
+
+
+def device_to_epoch(t):
+    """
+    DecodeTime (zkemsdk.c) straight to POSIX seconds, the device time is
+    taken as UTC. Only integer arithmetic, so ``t`` can be an int or a
+    whole NumPy array.
+    """
+    second = t % 60
+    t = t // 60
+    minute = t % 60
+    t = t // 60
+    hour = t % 24
+    t = t // 24
+    day = t % 31 + 1
+    t = t // 31
+    month = t % 12 + 1
+    year = t // 12 + 2000
+    # days from civil (proleptic gregorian), march based year
+    year = year - (month <= 2)
+    era = year // 400
+    yoe = year - era * 400
+    doy = (153 * ((month + 9) % 12) + 2) // 5 + day - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    days = era * 146097 + doe - 719468
+    return days * 86400 + hour * 3600 + minute * 60 + second
+
+
+def epoch_to_device(seconds):
+    """
+    POSIX seconds to EncodeTime (zkemsdk.c), the inverse of
+    device_to_epoch. Only integer arithmetic, so ``seconds`` can be an int
+    or a whole NumPy array.
+    """
+    days = seconds // 86400
+    seconds = seconds % 86400
+    # civil from days (proleptic gregorian), march based year
+    days = days + 719468
+    era = days // 146097
+    doe = days - era * 146097
+    yoe = (doe - doe // 1460 + doe // 36524 - doe // 146096) // 365
+    doy = doe - (365 * yoe + yoe // 4 - yoe // 100)
+    mp = (5 * doy + 2) // 153
+    day = doy - (153 * mp + 2) // 5 + 1
+    month = (mp + 2) % 12 + 1
+    year = yoe + era * 400 + (month <= 2)
+    return ((year % 100) * 12 * 31 + (month - 1) * 31 + day - 1) * 86400 + seconds
+
+
+def device_to_datetime(t):
+    """
+    EncodeTime value to a naive datetime (the device local time). Invalid
+    dates (ie: February 31) raise ValueError, like decode_device_time.
+    """
+    t, second = divmod(int(t), 60)
+    t, minute = divmod(t, 60)
+    t, hour = divmod(t, 24)
+    t, day = divmod(t, 31)
+    year, month = divmod(t, 12)
+    return datetime(year + 2000, month + 1, day + 1, hour, minute, second)
+
+
+def _has_numpy(use_numpy):
+    if use_numpy is None:
+        return numpy is not None
+    if use_numpy and numpy is None:
+        raise ImportError("numpy is not installed")
+    return use_numpy
+
+
+def decode_attendance(data, record_size, use_numpy=None):
+    """
+    decode a whole attendance buffer (without the 4 bytes total size)
+
+    :param data: bytes-like buffer, only complete records are decoded
+    :param record_size: 8, 16 or 40
+    :param use_numpy: force (True) or disable (False) NumPy, None: auto
+    :return: dict of columns: uid, user_id, status, punch, workcode and
+        timestamp (POSIX seconds). NumPy arrays, or tuples on fallback.
+        user_id is a str for 40 bytes records, an int for 16 bytes records
+        and 0 for 8 bytes records (only uid), uid is 0 for 16 bytes records.
+    """
+    if record_size not in ATTENDANCE_FORMATS:
+        raise ValueError("unknown attendance record size %s" % record_size)
+    view = memoryview(data)
+    count = len(view) // record_size
+    view = view[:count * record_size]
+    if _has_numpy(use_numpy):
+        records = numpy.frombuffer(view, ATTENDANCE_DTYPES[record_size], count)
+        fields = records.dtype.names
+        columns = {}
+        for name in ATTENDANCE_COLUMNS:
+            if name in fields:
+                columns[name] = records[name]
+            else:
+                columns[name] = numpy.zeros(count, numpy.uint32)
+        columns['timestamp'] = device_to_epoch(columns['timestamp'].astype(numpy.int64))
+        if record_size == 40:
+            columns['user_id'] = numpy.char.decode(columns['user_id'], 'utf-8', 'ignore')
+        return columns
+    names = ATTENDANCE[record_size].fields
+    values = list(zip(*ATTENDANCE[record_size].iter_unpack(view))) or [()] * len(names)
+    columns = dict((name, value) for name, value in zip(names, values) if name)
+    for name in ATTENDANCE_COLUMNS:
+        if name not in columns:
+            columns[name] = (0,) * count
+    columns['timestamp'] = tuple(device_to_epoch(t) for t in columns['timestamp'])
+    if record_size == 40:
+        columns['user_id'] = tuple(u.split(b'\x00')[0].decode(errors='ignore') for u in columns['user_id'])
+    return columns
+
+
+def decode_times(values, use_numpy=None):
+    """
+    decode a whole array of EncodeTime values
+
+    :param values: sequence (or NumPy array) of device encoded times
+    :param use_numpy: force (True) or disable (False) NumPy, None: auto
+    :return: NumPy datetime64[s] array, or list of datetime on fallback
+    """
+    if _has_numpy(use_numpy):
+        return device_to_epoch(numpy.asarray(values, numpy.int64)).astype('datetime64[s]')
+    return [device_to_datetime(t) for t in values]
+
+
+def encode_times(timestamps, use_numpy=None):
+    """
+    encode a whole array of timestamps as EncodeTime values
+
+    :param timestamps: sequence of datetime, or NumPy datetime64 array
+    :param use_numpy: force (True) or disable (False) NumPy, None: auto
+    :return: NumPy int64 array, or list of int on fallback
+    """
+    if _has_numpy(use_numpy):
+        return epoch_to_device(numpy.asarray(timestamps, 'datetime64[s]').astype(numpy.int64))
+    return [epoch_to_device(timegm(t.timetuple())) for t in timestamps]
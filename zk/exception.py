@@ -13,3 +13,11 @@ class ZKErrorResponse(ZKError):
 
 class ZKNetworkError(ZKError):
     pass
+
+
+class ZKErrorDeadline(ZKNetworkError):
+    pass
+
+
+class ZKErrorCircuitOpen(ZKNetworkError):
+    pass
@@ -1,24 +1,43 @@
 # -*- coding: utf-8 -*-
-from struct import pack #, unpack
 import codecs
 
+from .codec import TEMPLATE, TEMPLATE_ONLY
+
 
 class Finger(object):
+    """
+    a fingerprint template, template is bytes or a memoryview slice of the
+    downloaded buffer (get_templates), bytes(finger.template) detaches it.
+    While one such Finger survives, the whole download buffer stays alive.
+    Pickling always stores the template as bytes.
+    """
+    __slots__ = ('uid', 'fid', 'valid', 'template')
 
     def __init__(self, uid, fid, valid, template):
-        self.size = len(template) # template only
         self.uid = int(uid)
         self.fid = int(fid)
         self.valid = int(valid)
         self.template = template
-        #self.mark = str().encode("hex")
-        self.mark = codecs.encode(template[:8], 'hex') + b'...' + codecs.encode(template[-8:], 'hex')
+
+    def __reduce__(self):
+        template = self.template
+        if isinstance(template, memoryview):
+            template = template.tobytes()
+        return (Finger, (self.uid, self.fid, self.valid, template))
+
+    @property
+    def size(self): # template only
+        return len(self.template)
+
+    @property
+    def mark(self):
+        return codecs.encode(self.template[:8], 'hex') + b'...' + codecs.encode(self.template[-8:], 'hex')
 
     def repack(self): #full
-        return pack("HHbb%is" % (self.size), self.size+6, self.uid, self.fid, self.valid, self.template)
+        return TEMPLATE.pack(self.size+6, self.uid, self.fid, self.valid) + self.template
 
     def repack_only(self): #only template
-        return pack("H%is" % (self.size), self.size, self.template)
+        return TEMPLATE_ONLY.pack(self.size) + self.template
 
     @staticmethod
     def json_unpack(json):
@@ -39,7 +58,14 @@ class Finger(object):
         }
 
     def __eq__(self, other):
-        return self.__dict__ == other.__dict__
+        if not isinstance(other, Finger):
+            return NotImplemented
+        return (self.uid == other.uid and self.fid == other.fid and self.valid == other.valid
+                and self.template == other.template)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
 
     def __str__(self):
         return "<Finger> [uid:{:>3}, fid:{}, size:{:>4} v:{} t:{}]".format(self.uid, self.fid, self.size, self.valid, self.mark)
@@ -49,4 +75,3 @@ class Finger(object):
 
     def dump(self):
         return "<Finger> [uid:{:>3}, fid:{}, size:{:>4} v:{} t:{}]".format(self.uid, self.fid, self.size, self.valid, codecs.encode(self.template, 'hex'))
-
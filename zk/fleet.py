@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+concurrent polling of many devices with a bounded worker pool
+
+every device keeps its own session (one ZK instance, used by one worker at
+a time), failures are isolated per device and results are returned as
+they complete, so a sweep takes as long as the slowest device.
+"""
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from .base import ZK
+from .exception import ZKErrorCircuitOpen
+from .health import FAILURES
+
+SIZES = ['users', 'fingers', 'records', 'cards', 'faces', 'users_cap', 'fingers_cap',
+         'rec_cap', 'faces_cap', 'users_av', 'fingers_av', 'rec_av']
+
+
+class FleetResult(object):
+    """
+    outcome of an operation on a device: value or error
+    """
+
+    def __init__(self, device, value=None, error=None, elapsed=0):
+        self.device = device
+        self.value = value
+        self.error = error
+        self.elapsed = elapsed
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __str__(self):
+        if self.error is not None:
+            return '<FleetResult>: {} failed: {} ({:.3f}s)'.format(self.device, self.error, self.elapsed)
+        return '<FleetResult>: {} ok ({:.3f}s)'.format(self.device, self.elapsed)
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class Device(object):
+    """
+    a device of the inventory and its session
+    """
+
+    def __init__(self, ip, port=4370, name=None, **options):
+        """
+        :param ip: machine's IP address
+        :param port: machine's port
+        :param name: name in the results (default ip:port)
+        :param options: ZK options (timeout, password, force_udp, ommit_ping, ...)
+        """
+        self.ip = ip
+        self.port = int(port)
+        self.name = name or '{}:{}'.format(ip, self.port)
+        self.options = options
+        self.conn = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def from_inventory(device, defaults=None):
+        """
+        :param device: Device, dict (ip, port, name and ZK options) or 'ip[:port]'
+        """
+        if isinstance(device, Device):
+            return device
+        options = dict(defaults or {})
+        if isinstance(device, dict):
+            options.update(device)
+        else:
+            ip, _sep, port = str(device).partition(':')
+            options['ip'] = ip
+            if port:
+                options['port'] = port
+        return Device(**options)
+
+    def connect(self):
+        if self.conn is None or not self.conn.is_connect:
+            self.conn = ZK(self.ip, port=self.port, **self.options).connect()
+        return self.conn
+
+    def close(self, error=None):
+        """
+        disconnect (quietly, the device may be gone), after a network error
+        only the socket is closed: CMD_EXIT would wait for another timeout
+        """
+        conn, self.conn = self.conn, None
+        if conn is None:
+            return
+        if isinstance(error, FAILURES):
+            conn.close()
+        elif conn.is_connect:
+            try:
+                conn.disconnect()
+            except Exception:
+                conn.close()
+
+    def __str__(self):
+        return '<Device>: {}'.format(self.name)
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class Fleet(object):
+    """
+    run operations on many devices at once
+    """
+
+    def __init__(self, devices, workers=16, health=None, **defaults):
+        """
+        :param devices: inventory, list of Device, dict or 'ip[:port]'
+        :param workers: max devices polled at the same time
+        :param health: HealthTracker (zk.health), devices with an open
+            circuit are skipped at once (error ZKErrorCircuitOpen)
+        :param defaults: ZK options for every device (timeout, password, ...)
+        """
+        self.devices = [Device.from_inventory(device, defaults) for device in devices]
+        self.workers = workers
+        self.health = health
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """ disconnect every session """
+        for device in self.devices:
+            with device.lock:
+                device.close()
+
+    def __run_one(self, device, operation, args, kwargs):
+        inicio = time.time()
+        with device.lock:
+            try:
+                if self.health is not None:
+                    self.health.check(device.ip, device.port)
+            except ZKErrorCircuitOpen as e: # skipped, the device isn't touched
+                return FleetResult(device.name, error=e, elapsed=time.time() - inicio)
+            try:
+                conn = device.connect()
+                if callable(operation):
+                    value = operation(conn, *args, **kwargs)
+                else:
+                    value = getattr(conn, operation)(*args, **kwargs)
+            except Exception as e:
+                device.close(e) # next run starts a new session
+                self.__record(device, e)
+                return FleetResult(device.name, error=e, elapsed=time.time() - inicio)
+            self.__record(device)
+            return FleetResult(device.name, value, elapsed=time.time() - inicio)
+
+    def __record(self, device, error=None):
+        if self.health is not None:
+            self.health.record(device.ip, device.port, error)
+
+    def run(self, operation, *args, **kwargs):
+        """
+        run operation on every device
+
+        :param operation: ZK method name, or function(conn, *args, **kwargs)
+        :return: generator of FleetResult, in completion order
+        """
+        executor = ThreadPoolExecutor(max_workers=max(1, min(self.workers, len(self.devices))))
+        try:
+            futures = [executor.submit(self.__run_one, device, operation, args, kwargs) for device in self.devices]
+            for future in as_completed(futures):
+                yield future.result()
+        finally:
+            executor.shutdown(wait=True)
+
+    def read_sizes(self):
+        """ :return: generator of FleetResult, value: dict of counters """
+        def sizes(conn):
+            conn.read_sizes()
+            return dict((name, getattr(conn, name)) for name in SIZES)
+        return self.run(sizes)
+
+    def get_attendance(self, raw_time=False):
+        """ :return: generator of FleetResult, value: list of Attendance """
+        return self.run('get_attendance', raw_time)
+
+    def get_users(self):
+        """ :return: generator of FleetResult, value: list of User """
+        return self.run('get_users')
+
+    def set_time(self, timestamp):
+        """ :return: generator of FleetResult, value: True """
+        return self.run('set_time', timestamp)
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+health of the devices of a fleet, with a circuit breaker per device
+
+a powered-off terminal costs a ping, a connect timeout and the socket
+timeout on every poll; its workers are starved from the healthy devices.
+HealthTracker counts the consecutive failures of every device (ip, port)
+and, after threshold of them, opens its circuit: the device is skipped
+(ZKErrorCircuitOpen, at once) for a backoff window, doubled every time it
+opens again. Once the window is over a cheap TCP connect probes it
+(half-open): when the port answers one call goes through, its outcome
+closes or opens the circuit again::
+
+    def on_event(event):
+        print (event) # {'event': 'state', 'device': ('10.0.0.7', 4370), 'from': 'closed', 'to': 'open', ...}
+
+    health = HealthTracker(threshold=3, backoff=30, on_event=on_event)
+    fleet = Fleet(inventory, health=health, ommit_ping=True)
+    pool = ZKPool(health=health)
+"""
+from __future__ import absolute_import
+import socket
+import threading
+import time
+
+from .exception import ZKErrorCircuitOpen, ZKErrorConnection, ZKNetworkError
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+# errors of an unreachable device (other errors come from a device that answered)
+FAILURES = (ZKNetworkError, ZKErrorConnection, socket.error)
+
+
+class DeviceHealth(object):
+    """
+    state of the circuit of a device
+    """
+
+    def __init__(self, address):
+        self.address = address
+        self.state = CLOSED
+        self.failures = 0 # consecutive
+        self.opens = 0 # consecutive, sets the backoff window
+        self.retry_at = 0 # end of the backoff window (open)
+        self.last_error = None
+        self.last_success = 0
+        self.last_failure = 0
+
+    def json_pack(self): #packs for json
+        return {
+            "address": "{}:{}".format(*self.address),
+            "state": self.state,
+            "failures": self.failures,
+            "opens": self.opens,
+            "retry_at": self.retry_at,
+            "last_error": None if self.last_error is None else str(self.last_error),
+            "last_success": self.last_success,
+            "last_failure": self.last_failure
+        }
+
+    def __str__(self):
+        return '<DeviceHealth>: {}:{} {} ({} failures)'.format(self.address[0], self.address[1], self.state, self.failures)
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class HealthTracker(object):
+    """
+    circuit breakers of many devices, thread safe (one tracker can be
+    shared by a Fleet and a ZKPool)
+    """
+
+    def __init__(self, threshold=3, backoff=30, max_backoff=600, probe=True, probe_timeout=1, on_event=None):
+        """
+        :param threshold: consecutive failures that open the circuit
+        :param backoff: seconds a device is skipped once open, doubled
+            every time it opens again (up to max_backoff)
+        :param max_backoff: longest window
+        :param probe: TCP connect to the device before the half-open call
+            (disable it for devices only reachable over UDP)
+        :param probe_timeout: seconds allowed to the probe
+        :param on_event: function(event dict) called on every state
+            transition
+        """
+        self.threshold = threshold
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.probe = probe
+        self.probe_timeout = probe_timeout
+        self.on_event = on_event
+        self.__devices = {}
+        self.__lock = threading.Lock()
+
+    def get(self, ip, port=4370):
+        """ :return: DeviceHealth of the device """
+        address = (ip, int(port))
+        with self.__lock:
+            health = self.__devices.get(address)
+            if health is None:
+                health = self.__devices[address] = DeviceHealth(address)
+            return health
+
+    def states(self):
+        """ :return: dict of (ip, port): state """
+        with self.__lock:
+            return dict((address, health.state) for address, health in self.__devices.items())
+
+    def allow(self, ip, port=4370):
+        """
+        can a call be made to the device now? An open circuit whose window
+        is over is probed (half-open), then only that call goes through
+        until success() or failure() is reported
+
+        :return: bool
+        """
+        health = self.get(ip, port)
+        with self.__lock:
+            if health.state == CLOSED:
+                return True
+            now = time.time()
+            if now < health.retry_at:
+                return False
+            health.retry_at = now + self.backoff # one half-open call per window
+            event = None
+            if health.state == OPEN:
+                event = self.__transition(health, HALF_OPEN)
+        self.__emit(event)
+        if self.probe and not self.__probe(health.address):
+            self.failure(ip, port, ZKNetworkError("probe failed"))
+            return False
+        return True
+
+    def check(self, ip, port=4370):
+        """ like allow, but raises ZKErrorCircuitOpen when it can't """
+        if not self.allow(ip, port):
+            health = self.get(ip, port)
+            raise ZKErrorCircuitOpen("{}:{} circuit {}, retry in {:.1f}s (last error: {})".format(
+                ip, port, health.state, max(0, health.retry_at - time.time()), health.last_error))
+
+    def success(self, ip, port=4370):
+        """ report a call that reached the device """
+        health = self.get(ip, port)
+        with self.__lock:
+            health.failures = 0
+            health.last_success = time.time()
+            if health.state == CLOSED:
+                return
+            health.opens = 0
+            event = self.__transition(health, CLOSED)
+        self.__emit(event)
+
+    def failure(self, ip, port=4370, error=None):
+        """ report a call that couldn't reach the device """
+        health = self.get(ip, port)
+        with self.__lock:
+            health.failures += 1
+            health.last_error = error
+            health.last_failure = time.time()
+            if health.state == OPEN or (health.state == CLOSED and health.failures < self.threshold):
+                return
+            health.opens += 1
+            health.retry_at = time.time() + min(self.max_backoff, self.backoff * 2 ** (health.opens - 1))
+            event = self.__transition(health, OPEN)
+        self.__emit(event)
+
+    def record(self, ip, port=4370, error=None):
+        """
+        report the outcome of a call: success, or failure when error is a
+        network one (other errors come from a device that answered)
+        """
+        if isinstance(error, FAILURES):
+            self.failure(ip, port, error)
+        else:
+            self.success(ip, port)
+
+    def __probe(self, address):
+        """ cheap TCP connect, no ZK session """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(self.probe_timeout)
+        try:
+            return sock.connect_ex(address) == 0
+        except socket.error:
+            return False
+        finally:
+            sock.close()
+
+    def __transition(self, health, state):
+        event = {
+            'event': 'state',
+            'device': health.address,
+            'from': health.state,
+            'to': state,
+            'failures': health.failures,
+            'error': None if health.last_error is None else str(health.last_error),
+        }
+        if state == OPEN:
+            event['retry_at'] = health.retry_at
+        health.state = state
+        return event
+
+    def __emit(self, event):
+        if event is not None and self.on_event is not None:
+            self.on_event(event)
+
+    def __str__(self):
+        states = self.states()
+        return '<HealthTracker>: {} devices, {} open'.format(len(states), sum(1 for state in states.values() if state != CLOSED))
+
+    def __repr__(self):
+        return self.__str__()
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+timeouts, retries and deadlines of a connection
+
+a dead or overloaded device shouldn't block a worker for minutes: every
+command can have its own timeout, retried steps (1504 chunks, uploads,
+single templates, resumed reads) wait with exponential backoff and
+jitter, and a high-level call (get_attendance, get_templates, set_users,
+...) can have an overall deadline that grows with the size the device
+announces for the transfer::
+
+    def metrics(event):
+        print (event) # {'event': 'retry', 'operation': 'read chunk', 'attempt': 2, ...}
+
+    policy = RetryPolicy(timeouts={const.CMD_CONNECT: 5, 1504: 10}, backoff=0.2,
+                         deadline=30, rate=256 * 1024, metrics=metrics)
+    conn = ZK(ip, policy=policy).connect()
+"""
+import random
+import time
+
+from .exception import ZKErrorDeadline
+
+
+class Deadline(object):
+    """
+    time left for a high-level call
+    """
+
+    def __init__(self, name, seconds, rate=0):
+        """
+        :param name: call name (for errors and metrics)
+        :param seconds: time allowed before any transfer
+        :param rate: bytes per second expected, every transfer announced
+            with extend() adds size / rate seconds (0: fixed deadline)
+        """
+        self.name = name
+        self.rate = rate
+        self.expires = time.time() + seconds
+
+    def extend(self, size):
+        """ account a transfer of size bytes """
+        if self.rate:
+            self.expires += float(size) / self.rate
+
+    def remaining(self):
+        return self.expires - time.time()
+
+    def __str__(self):
+        return '<Deadline>: {} {:.3f}[s] left'.format(self.name, self.remaining())
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class RetryPolicy(object):
+    """
+    per-command timeouts, retries with exponential backoff and jitter, and
+    the deadline of high-level calls. One policy can be shared by many
+    connections (ie: a Fleet), the deadlines are per call.
+    """
+
+    def __init__(self, timeout=None, timeouts=None, retries=3, backoff=0, max_backoff=5, jitter=0.5,
+                 deadline=None, rate=64 * 1024, metrics=None):
+        """
+        :param timeout: seconds to wait for an answer (None: the timeout
+            of the connection)
+        :param timeouts: dict of command: seconds, overriding timeout
+        :param retries: attempts of a retried step
+        :param backoff: seconds to wait before the first retry, doubled on
+            every retry (0: retry at once)
+        :param max_backoff: longest wait between attempts
+        :param jitter: random fraction (+/-) applied to every wait
+        :param deadline: seconds allowed for a high-level call (None: no
+            deadline), plus size / rate for every transfer announced
+        :param rate: bytes per second expected from the device
+        :param metrics: function(event dict) called on every retry and
+            exceeded deadline
+        """
+        self.timeout = timeout
+        self.timeouts = timeouts or {}
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.deadline = deadline
+        self.rate = rate
+        self.metrics = metrics
+
+    def timeout_for(self, command, default=60):
+        """ :return: seconds to wait for the answer of command """
+        timeout = self.timeouts.get(command)
+        if timeout is None:
+            timeout = default if self.timeout is None else self.timeout
+        return timeout
+
+    def start(self, name):
+        """ :return: Deadline of a high-level call, None without deadline """
+        if self.deadline is None:
+            return None
+        return Deadline(name, self.deadline, self.rate)
+
+    def delay(self, retry):
+        """ :return: seconds to wait before the retry-th retry (1: first) """
+        if not self.backoff:
+            return 0
+        delay = min(self.max_backoff, self.backoff * (2 ** (retry - 1)))
+        if self.jitter:
+            delay *= 1 + self.jitter * (2 * random.random() - 1)
+        return max(0, delay)
+
+    def report(self, event, **details):
+        """ send an event to the metrics hook """
+        if self.metrics is not None:
+            details['event'] = event
+            self.metrics(details)
+
+    def retry(self, operation, attempt, deadline=None, **details):
+        """
+        account a retry: report it and pick the wait before it
+
+        :param attempt: attempt about to be made (2: first retry)
+        :return: seconds to wait, None when the deadline doesn't leave
+            time for it (no more attempts)
+        """
+        delay = self.delay(attempt - 1)
+        if deadline is not None and deadline.remaining() <= delay:
+            return None
+        self.report('retry', operation=operation, attempt=attempt, delay=delay, **details)
+        return delay
+
+    def wait(self, operation, attempt, deadline=None, **details):
+        """
+        account a retry and wait (blocking) before it, raises
+        ZKErrorDeadline when the deadline doesn't leave time for it
+        """
+        delay = self.retry(operation, attempt, deadline, **details)
+        if delay is None:
+            self.report('deadline', operation=deadline.name, retry=operation)
+            raise ZKErrorDeadline("%s: deadline exceeded" % deadline.name)
+        if delay:
+            time.sleep(delay)
+
+    def attempts(self, operation, deadline=None, **details):
+        """
+        attempts of a retried step, waiting (blocking) before each retry::
+
+            for _attempt in policy.attempts('read chunk'):
+                if step():
+                    break
+            else:
+                raise ...
+
+        :return: generator of attempt numbers (from 1)
+        """
+        for attempt in range(1, self.retries + 1):
+            if attempt > 1:
+                self.wait(operation, attempt, deadline, **details)
+            yield attempt
+
+    def __str__(self):
+        return '<RetryPolicy>: timeout {} retries {} backoff {} deadline {}'.format(
+            self.timeout, self.retries, self.backoff, self.deadline)
+
+    def __repr__(self):
+        return self.__str__()
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""
+pool of persistent (authenticated) device sessions
+
+connect() costs a ping, a tcp probe, a new socket, CMD_CONNECT and maybe
+CMD_AUTH; the pool pays it once per device. Idle sessions get a cheap
+keepalive (CMD_GET_TIME), and dead ones are re-established (new session
+id, reply id and auth) before they are handed out again.
+"""
+from __future__ import absolute_import
+import time
+import threading
+from contextlib import contextmanager
+from socket import error as socket_error
+
+from .base import ZK
+from .exception import ZKError, ZKErrorCircuitOpen, ZKErrorDeadline, ZKErrorResponse, ZKNetworkError
+
+
+class PoolMetrics(object):
+    """
+    counters of the pool
+    """
+
+    def __init__(self):
+        self.hits = 0 # live session reused
+        self.misses = 0 # first session of a device
+        self.reconnects = 0 # dead session re-established
+        self.keepalives = 0
+        self.keepalive_failures = 0
+        self.handshakes = 0
+        self.handshake_time = 0.0 # seconds, all handshakes
+        self.last_handshake = 0.0
+
+    @property
+    def handshake_latency(self):
+        """ average handshake (connect / reconnect) seconds """
+        if not self.handshakes:
+            return 0.0
+        return self.handshake_time / self.handshakes
+
+    def json_pack(self): #packs for json
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "reconnects": self.reconnects,
+            "keepalives": self.keepalives,
+            "keepalive_failures": self.keepalive_failures,
+            "handshakes": self.handshakes,
+            "handshake_latency": self.handshake_latency,
+            "last_handshake": self.last_handshake
+        }
+
+    def __str__(self):
+        return '<PoolMetrics>: hits {} misses {} reconnects {} keepalives {}/{} handshake {:.3f}s'.format(
+            self.hits, self.misses, self.reconnects, self.keepalives - self.keepalive_failures,
+            self.keepalives, self.handshake_latency)
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class _PoolEntry(object):
+
+    def __init__(self, ip, port, options):
+        self.ip = ip
+        self.port = port
+        self.options = options
+        self.conn = None
+        self.dead = False
+        self.last_used = 0
+        self.lock = threading.Lock()
+
+
+class ZKPool(object):
+    """
+    persistent sessions, one per device (ip, port)
+    """
+
+    # methods call() runs again on a fresh session (reads, safe to repeat)
+    READS = frozenset([
+        'get_firmware_version', 'get_serialnumber', 'get_platform', 'get_mac', 'get_device_name',
+        'get_face_version', 'get_fp_version', 'get_extend_fmt', 'get_user_extend_fmt', 'get_face_fun_on',
+        'get_compat_old_firmware', 'get_network_params', 'get_pin_width', 'read_sizes', 'get_time',
+        'get_user_template', 'get_templates', 'get_users', 'get_attendance', 'get_attendance_since',
+        'get_attendance_columns'])
+
+    def __init__(self, keepalive=30, health=None, **defaults):
+        """
+        :param keepalive: seconds idle before a session is checked
+            (keepalive thread and before handing it out)
+        :param health: HealthTracker (zk.health) fed with every acquire
+            and keepalive, acquire raises ZKErrorCircuitOpen at once while
+            the circuit of the device is open
+        :param defaults: ZK options for every device (timeout, password, ...)
+        """
+        self.keepalive = keepalive
+        self.health = health
+        self.defaults = defaults
+        self.metrics = PoolMetrics()
+        self.__entries = {}
+        self.__lock = threading.Lock()
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def start(self):
+        """
+        start the keepalive thread (idle sessions are checked every
+        keepalive seconds)
+
+        :return: self
+        """
+        if self.__thread is None:
+            self.__stop.clear()
+            self.__thread = threading.Thread(target=self.__keepalive_loop)
+            self.__thread.daemon = True
+            self.__thread.start()
+        return self
+
+    def close(self):
+        """ stop the keepalive thread and disconnect every session """
+        if self.__thread is not None:
+            self.__stop.set()
+            self.__thread.join()
+            self.__thread = None
+        with self.__lock:
+            entries, self.__entries = list(self.__entries.values()), {}
+        for entry in entries:
+            with entry.lock:
+                self.__close(entry)
+
+    def __entry(self, ip, port, options):
+        with self.__lock:
+            entry = self.__entries.get((ip, port))
+            if entry is None:
+                settings = dict(self.defaults)
+                settings.update(options)
+                entry = self.__entries[(ip, port)] = _PoolEntry(ip, port, settings)
+            return entry
+
+    def __handshake(self, entry):
+        inicio = time.time()
+        if entry.conn is None:
+            entry.conn = ZK(entry.ip, port=entry.port, **entry.options).connect()
+            miss = True
+        else:
+            entry.conn.reconnect()
+            miss = False
+        elapsed = time.time() - inicio
+        with self.__lock:
+            if miss:
+                self.metrics.misses += 1
+            else:
+                self.metrics.reconnects += 1
+            self.metrics.handshakes += 1
+            self.metrics.handshake_time += elapsed
+            self.metrics.last_handshake = elapsed
+        entry.dead = False
+
+    def __probe(self, entry):
+        """ keepalive, mark the session dead when it doesn't answer """
+        with self.__lock:
+            self.metrics.keepalives += 1
+        try:
+            entry.conn.get_time()
+            entry.last_used = time.time()
+            self.__record(entry)
+            return True
+        except ZKError as e:
+            with self.__lock:
+                self.metrics.keepalive_failures += 1
+            entry.dead = True
+            self.__record(entry, e)
+            return False
+
+    def __record(self, entry, error=None):
+        if self.health is not None:
+            self.health.record(entry.ip, entry.port, error)
+
+    def __ready(self, entry):
+        """ live session for entry, re-established when needed """
+        if entry.conn is None or entry.dead or not entry.conn.is_connect:
+            self.__handshake(entry)
+        elif time.time() - entry.last_used >= self.keepalive and not self.__probe(entry):
+            self.__handshake(entry)
+        else:
+            with self.__lock:
+                self.metrics.hits += 1
+        return entry.conn
+
+    def __close(self, entry):
+        conn, entry.conn = entry.conn, None
+        if conn is not None and conn.is_connect and not entry.dead:
+            try:
+                conn.disconnect()
+            except ZKError:
+                pass
+
+    @contextmanager
+    def acquire(self, ip, port=4370, **options):
+        """
+        borrow the session of a device (one user at a time), connecting
+        or re-establishing it first when needed. Any error but
+        ZKErrorResponse (the device answered) kills the session: a timeout
+        or an interrupted read leaves its stream out of sync
+
+            with pool.acquire('192.168.1.201') as conn:
+                conn.get_attendance()
+
+        :param options: ZK options for this device (first acquire only)
+        """
+        entry = self.__entry(ip, port, options)
+        if self.health is not None:
+            self.health.check(ip, port)
+        with entry.lock:
+            try:
+                conn = self.__ready(entry)
+            except Exception as e:
+                self.__record(entry, e)
+                raise
+            error = None
+            try:
+                yield conn
+            except ZKErrorResponse:
+                raise
+            except BaseException as e:
+                error = e
+                entry.dead = True # re-established on the next acquire
+                raise
+            finally:
+                entry.last_used = time.time()
+                self.__record(entry, error)
+
+    def call(self, ip, port, method, *args, **kwargs):
+        """
+        run a ZK method on the pooled session of a device, retrying once
+        on a fresh session when the session can't be established, or when
+        the socket turns out to be dead during a read (READS). Writes are
+        not repeated (the device may have applied them), deadline and
+        circuit errors are not retried
+
+        :param method: ZK method name
+        """
+        for retry in [False, True]:
+            started = False
+            try:
+                with self.acquire(ip, port) as conn:
+                    started = True
+                    return getattr(conn, method)(*args, **kwargs)
+            except (ZKErrorDeadline, ZKErrorCircuitOpen):
+                raise
+            except (ZKNetworkError, socket_error): # socket_error: ie a raw socket timeout
+                if retry or (started and method not in self.READS):
+                    raise
+
+    def __keepalive_loop(self):
+        while not self.__stop.wait(self.keepalive):
+            with self.__lock:
+                entries = list(self.__entries.values())
+            for entry in entries:
+                if entry.conn is None or entry.dead or time.time() - entry.last_used < self.keepalive:
+                    continue
+                if entry.lock.acquire(False): # busy sessions are alive
+                    try:
+                        self.__probe(entry)
+                    finally:
+                        entry.lock.release()
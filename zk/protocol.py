@@ -0,0 +1,498 @@
+# -*- coding: utf-8 -*-
+"""
+transport independent parts of the ZK protocol (packets, time encoding,
+record decoders), shared by the blocking ZK and the asyncio AsyncZK
+"""
+import sys
+from array import array
+from datetime import datetime
+from struct import pack, unpack
+
+from . import const
+from .attendance import Attendance
+from .codec import (
+    HEADER, TCP_TOP, TIME, TIMEHEX, TOTAL_SIZE, RECORD_SIZE, USER, USER_WRITE,
+    TEMPLATE, ATTENDANCE, EVENT
+)
+from .exception import ZKErrorResponse
+from .finger import Finger
+from .user import User
+
+
+def make_commkey(key, session_id, ticks=50):
+    """
+    take a password and session_id and scramble them to send to the machine.
+    copied from commpro.c - MakeKey
+    """
+    key = int(key)
+    session_id = int(session_id)
+    k = 0
+    for i in range(32):
+        if (key & (1 << i)):
+            k = (k << 1 | 1)
+        else:
+            k = k << 1
+    k += session_id
+
+    k = pack(b'I', k)
+    k = unpack(b'BBBB', k)
+    k = pack(
+        b'BBBB',
+        k[0] ^ ord('Z'),
+        k[1] ^ ord('K'),
+        k[2] ^ ord('S'),
+        k[3] ^ ord('O'))
+    k = unpack(b'HH', k)
+    k = pack(b'HH', k[1], k[0])
+
+    B = 0xff & ticks
+    k = unpack(b'BBBB', k)
+    k = pack(
+        b'BBBB',
+        k[0] ^ B,
+        k[1] ^ B,
+        B,
+        k[3] ^ B)
+    return k
+
+
+def create_checksum(buf):
+    """
+    Calculates the checksum of a packet, in linear time and without copies
+    same result as zkemsdk.c
+
+    :param buf: bytes-like packet (bytes, bytearray or memoryview)
+    :return: int
+    """
+    view = memoryview(buf)
+    size = len(view)
+    checksum = sum(_words(view[:size & ~1]))
+    if size & 1:
+        checksum += ord(view[size - 1:].tobytes())
+    return (-1 - checksum) % const.USHRT_MAX
+
+
+def _words(view):
+    """ native 16 bits words of an even sized memoryview """
+    if hasattr(view, 'cast'):
+        return view.cast('H')
+    return array('H', view.tobytes()) # python 2: no memoryview.cast
+
+
+def create_packet(buf, command, command_string, session_id, reply_id, tcp=False):
+    """
+    Puts a the parts that make up a packet together (with the tcp top
+    header when needed) into buf
+
+    :param buf: reusable bytearray, reallocated when too small
+    :return: buf, memoryview of the packet to send
+    """
+    size = len(command_string)
+    offset = 8 if tcp else 0
+    total = offset + 8 + size
+    if len(buf) < total:
+        buf = bytearray(max(total, 2 * len(buf)))
+    HEADER.pack_into(buf, offset, command, 0, session_id, reply_id)
+    buf[offset + 8:total] = command_string
+    view = memoryview(buf)
+    checksum = create_checksum(view[offset:total])
+    reply_id += 1
+    if reply_id >= const.USHRT_MAX:
+        reply_id -= const.USHRT_MAX
+    if tcp:
+        TCP_TOP.pack_into(buf, 0, const.MACHINE_PREPARE_DATA_1, const.MACHINE_PREPARE_DATA_2, 8 + size)
+    HEADER.pack_into(buf, offset, command, checksum, session_id, reply_id)
+    return buf, view[:total]
+
+
+def test_tcp_top(packet):
+    """
+    return size!
+    """
+    if len(packet)<=8:
+        return 0
+    tcp_header = TCP_TOP.unpack_from(packet)
+    if tcp_header[0] == const.MACHINE_PREPARE_DATA_1 and tcp_header[1] == const.MACHINE_PREPARE_DATA_2:
+        return tcp_header[2]
+    return 0
+
+
+def decode_time(t):
+    """
+    Decode a timestamp retrieved from the timeclock
+
+    copied from zkemsdk.c - DecodeTime
+    """
+    return decode_device_time(TIME.unpack_from(t)[0])
+
+
+def decode_device_time(t):
+    """
+    DecodeTime of the already unpacked (int) device time
+
+    :return: datetime
+    """
+    second = t % 60
+    t = t // 60
+
+    minute = t % 60
+    t = t // 60
+
+    hour = t % 24
+    t = t // 24
+
+    day = t % 31 + 1
+    t = t // 31
+
+    month = t % 12 + 1
+    t = t // 12
+
+    year = t + 2000
+
+    d = datetime(year, month, day, hour, minute, second)
+
+    return d
+
+
+def decode_timehex(timehex):
+    """
+    timehex string of six bytes
+    """
+    year, month, day, hour, minute, second = TIMEHEX.unpack_from(timehex)
+    year += 2000
+    d = datetime(year, month, day, hour, minute, second)
+    return d
+
+
+def timehex_to_device(timehex):
+    """
+    timehex string of six bytes to the device encoded time (EncodeTime)
+    """
+    year, month, day, hour, minute, second = TIMEHEX.unpack_from(timehex)
+    return ((year % 100) * 12 * 31 + (month - 1) * 31 + day - 1) * (24 * 60 * 60) + (hour * 60 + minute) * 60 + second
+
+
+def encode_time(t):
+    """
+    Encode a timestamp so that it can be read on the timeclock
+    """
+    # formula taken from zkemsdk.c - EncodeTime
+    # can also be found in the technical manual
+    d = (
+        ((t.year % 100) * 12 * 31 + ((t.month - 1) * 31) + t.day - 1) *
+        (24 * 60 * 60) + (t.hour * 60 + t.minute) * 60 + t.second
+    )
+    return d
+
+
+def unpack_sizes(data):
+    """
+    decode the CMD_GET_FREE_SIZES answer
+
+    :return: dict of counters (users, fingers, records, ...), empty when
+        the answer is too short
+    """
+    sizes = {}
+    if len(data) >= 80:
+        fields = unpack('20i', data[:80])
+        sizes['users'] = fields[4]
+        sizes['fingers'] = fields[6]
+        sizes['records'] = fields[8]
+        sizes['dummy'] = fields[10] #???
+        sizes['cards'] = fields[12]
+        sizes['fingers_cap'] = fields[14]
+        sizes['users_cap'] = fields[15]
+        sizes['rec_cap'] = fields[16]
+        sizes['fingers_av'] = fields[17]
+        sizes['users_av'] = fields[18]
+        sizes['rec_av'] = fields[19]
+        data = data[80:]
+    if len(data) >= 12: #face info
+        fields = unpack('3i', data[:12]) #dirty hack! we need more information
+        sizes['faces'] = fields[0]
+        sizes['faces_cap'] = fields[2]
+    return sizes
+
+
+def pack_user(uid, name, privilege, password, group_id, user_id, card, user_packet_size, encoding='UTF-8'):
+    """
+    CMD_USER_WRQ payload for a ZK6 (28) or ZK8 (72) user
+    """
+    if user_packet_size == 28: #self.firmware == 6:
+        if not group_id:
+            group_id = 0
+        try:
+            return USER_WRITE[28].pack(uid, privilege, password.encode(encoding, errors='ignore'), name.encode(encoding, errors='ignore'), card, int(group_id), 0, int(user_id))
+        except Exception:
+            raise ZKErrorResponse("Can't pack user")
+    name_pad = name.encode(encoding, errors='ignore').ljust(24, b'\x00')[:24]
+    card_str = pack('<I', int(card))[:4]
+    return USER_WRITE[72].pack(uid, privilege, password.encode(encoding, errors='ignore'), name_pad, card_str, group_id.encode(), user_id.encode())
+
+
+def decode_user(data, offset, size, encoding='UTF-8'):
+    """
+    decode the ZK6 (28) or ZK8 (72) user record at offset
+
+    :return: User object
+    """
+    if size == 28:
+        uid, privilege, password, name, card, group_id, timezone, user_id = USER[28].unpack_from(data, offset)
+        password = (password.split(b'\x00')[0]).decode(encoding, errors='ignore')
+        name = (name.split(b'\x00')[0]).decode(encoding, errors='ignore').strip()
+        group_id = str(group_id)
+        user_id = str(user_id)
+        #TODO: check card value and find in ver8
+    else:
+        uid, privilege, password, name, card, group_id, user_id = USER[72].unpack_from(data, offset)
+        password = (password.split(b'\x00')[0]).decode(encoding, errors='ignore')
+        name = (name.split(b'\x00')[0]).decode(encoding, errors='ignore').strip()
+        group_id = (group_id.split(b'\x00')[0]).decode(encoding, errors='ignore').strip()
+        user_id = (user_id.split(b'\x00')[0]).decode(encoding, errors='ignore')
+    if not name:
+        name = "NN-%s" % user_id
+    return User.fast(uid, name, privilege, password, group_id, user_id, card)
+
+
+def next_user_ids(max_uid, user_ids):
+    """
+    first free uid and user_id after max_uid
+
+    :return: next_uid, next_user_id
+    """
+    max_uid += 1
+    next_uid = max_uid
+    next_user_id = str(max_uid)
+    while next_user_id in user_ids:
+        max_uid += 1
+        next_user_id = str(max_uid)
+    return next_uid, next_user_id
+
+
+def decode_template(data, offset):
+    """
+    decode the template record at offset (size, uid, fid, valid, template)
+
+    :param data: buffer, the template is a slice of it (no copy) when it
+        is a memoryview, bytes otherwise (always on python 2, where a
+        memoryview doesn't behave like bytes)
+    :return: Finger object
+    """
+    size, uid, fid, valid = TEMPLATE.unpack_from(data, offset)
+    template = data[offset + 6:offset + size]
+    if not isinstance(template, memoryview):
+        template = bytes(template)
+    elif sys.version_info[0] < 3:
+        template = template.tobytes()
+    return Finger(uid, fid, valid, template)
+
+
+def attendance_record_size(total_size, records):
+    """ attendance record size (8, 16 or 40) from the buffer total size """
+    return {8: 8, 16: 16}.get(total_size / records, 40)
+
+
+def decode_attendance(data, offset, record_size, users, raw_time=False):
+    """
+    decode the attendance record at offset (8, 16 or 40 bytes)
+
+    :param users: UserDirectory, to join uid and user_id
+    :param raw_time: keep only the device time, the timestamp datetime
+        is built on first access
+    :return: Attendance object
+    """
+    return attendance_from(record_size, ATTENDANCE[record_size].unpack_from(data, offset), users, raw_time)
+
+
+def decode_attendances(data, record_size, users, raw_time=False):
+    """
+    decode every complete attendance record of data at once (iter_unpack)
+
+    :param data: records only (without the 4 bytes total size)
+    :return: list of Attendance object
+    """
+    return [attendance_from(record_size, values, users, raw_time)
+            for values in ATTENDANCE[record_size].iter_unpack(data)]
+
+
+def attendance_from(record_size, values, users, raw_time=False):
+    """
+    Attendance object from the unpacked fields of an attendance record
+    (see codec.ATTENDANCE)
+    """
+    if record_size == 8:
+        uid, status, timestamp, punch = values
+        tuser = users.get_by_uid(uid)
+        if not tuser:
+            user_id = str(uid)
+        else:
+            user_id = tuser.user_id
+    elif record_size == 16:
+        user_id, timestamp, status, punch, reserved, workcode = values
+        user_id = str(user_id)
+        tuser = users.get_by_user_id(user_id)
+        if not tuser:
+            uid = str(user_id)
+        else:
+            uid = tuser.uid
+    else:
+        uid, user_id, status, timestamp, punch, space = values
+        user_id = (user_id.split(b'\x00')[0]).decode(errors='ignore')
+    if raw_time:
+        return Attendance.fast(user_id, None, status, punch, uid, timestamp)
+    return Attendance.fast(user_id, decode_device_time(timestamp), status, punch, uid, timestamp)
+
+
+def decode_events(data, users, raw_time=False):
+    """
+    decode the attendance events of a CMD_REG_EVENT packet
+
+    :param users: UserDirectory, to join uid and user_id
+    :param raw_time: keep only the device time (see decode_attendance)
+    :return: generator of Attendance object
+    """
+    offset = 0
+    while len(data) - offset >= 12:
+        size = len(data) - offset
+        if size in (12, 32, 36):
+            layout = EVENT[size]
+        elif size >= 52:
+            layout = EVENT[52]
+        else:
+            break
+        user_id, status, punch, timehex = layout.unpack_from(data, offset)[:4]
+        offset += layout.size
+        if isinstance(user_id, int):
+            user_id = str(user_id)
+        else:
+            user_id = (user_id.split(b'\x00')[0]).decode(errors='ignore')
+        tuser = users.get_by_user_id(user_id)
+        if not tuser:
+            uid = int(user_id)
+        else:
+            uid = tuser.uid
+        if raw_time:
+            yield Attendance.fast(user_id, None, status, punch, uid, timehex_to_device(timehex))
+        else:
+            yield Attendance.fast(user_id, decode_timehex(timehex), status, punch, uid, timehex_to_device(timehex))
+
+
+def split_buffer(data, record_size=None):
+    """
+    split a whole buffered read (4 bytes total size + records) in place,
+    with the same rules as RecordSplitter
+
+    :param record_size: function(total_size) returning the fixed size
+        of the records, None when every record starts with its size (H)
+    :return: generator of (offset, size) for each complete record
+    """
+    if len(data) < 4:
+        return
+    total_size = TOTAL_SIZE.unpack_from(data)[0]
+    end = min(len(data), 4 + total_size)
+    offset = 4
+    if record_size:
+        size = record_size(total_size)
+        while end - offset >= size:
+            yield offset, size
+            offset += size
+        return
+    while end - offset >= 6:
+        size = RECORD_SIZE.unpack_from(data, offset)[0]
+        if size < 6 or offset + size > end:
+            break # broken record, skip the rest
+        yield offset, size
+        offset += size
+
+
+class ReadCheckpoint(object):
+    """
+    progress of a buffered read (1503 + 1504 chunks): the buffer being
+    filled and the chunks already received, to continue the read after a
+    reconnect instead of starting over
+    """
+
+    def __init__(self, command, fct, ext, size, data=None):
+        """
+        :param size: size of the prepared buffer (1503 answer)
+        :param data: bytearray of size being filled, None when the chunks
+            are consumed as they arrive
+        """
+        self.key = (command, fct, ext)
+        self.size = size
+        self.data = data
+        self.chunks = [] # (start, size) received
+
+    def matches(self, command, fct, ext, size):
+        """ same buffer, and the device prepared it with the same size """
+        return self.key == (command, fct, ext) and self.size == size
+
+    def done(self, start, size):
+        self.chunks.append((start, size))
+
+    @property
+    def offset(self):
+        """ first missing offset (chunks after a gap are read again) """
+        offset = 0
+        for start, size in sorted(self.chunks):
+            if start > offset:
+                break
+            offset = max(offset, start + size)
+        return min(offset, self.size)
+
+    def __str__(self):
+        return '<ReadCheckpoint>: command {} {}/{} bytes'.format(self.key[0], self.offset, self.size)
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class RecordSplitter(object):
+    """
+    split a buffered read (4 bytes total size + records) into records as
+    its chunks arrive, only the incomplete record at the end of a chunk
+    is kept between chunks
+    """
+
+    def __init__(self, record_size=None):
+        """
+        :param record_size: function(total_size) returning the fixed size
+            of the records, None when every record starts with its size (H)
+        """
+        self.record_size = record_size
+        self.pending = bytearray()
+        self.total_size = None
+        self.end = None
+        self.size = 0
+
+    def feed(self, chunk):
+        """
+        :return: generator of (buffer, offset, size) for each complete
+            record, decode it before the next iteration (the buffer is reused)
+        """
+        pending = self.pending
+        pending += chunk
+        offset = 0
+        if self.end is None:
+            if len(pending) < 4:
+                return
+            self.total_size = self.end = TOTAL_SIZE.unpack_from(pending)[0]
+            if self.record_size:
+                self.size = self.record_size(self.total_size)
+            offset = 4
+        size = self.size
+        while True:
+            if self.record_size is None:
+                if self.end < 6 or len(pending) - offset < 2:
+                    break
+                size = RECORD_SIZE.unpack_from(pending, offset)[0]
+                if size < 6 or size > self.end:
+                    self.end = 0 # broken record, skip the rest
+                    break
+            if len(pending) - offset < size:
+                break
+            yield pending, offset, size
+            offset += size
+            if self.record_size is None:
+                self.end -= size
+        del pending[:offset]
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+differential provisioning: bring a device to a desired set of users and
+templates without erasing it
+
+users are matched by uid and templates by (uid, fid), and compared by a
+content hash (packed user fields, valid flag + template). Only the
+differences are sent: delete_user / delete_user_template for what is gone,
+one save_users_templates for what is new or changed. Desired users that
+can't be packed for the device (ie: a non numeric user_id on a 28 bytes
+user record) are left out and reported in the plan (invalid_users)::
+
+    changes = plan(conn, users, templates)
+    print (changes) # review before applying
+    changes.apply(conn)
+"""
+from hashlib import sha1
+from struct import error as StructError
+
+from .exception import ZKErrorResponse
+from .protocol import decode_user
+
+
+def user_hash(user, user_packet_size=72):
+    """
+    hash of the user fields as the device stores them (packed, decoded
+    and packed again, so defaults like an empty name compare equal),
+    raises ValueError when the user can't be packed for the device
+    """
+    try:
+        if user_packet_size == 28:
+            record = user.repack29()
+        else:
+            record = user.repack73()
+    except (ValueError, StructError) as e:
+        raise ValueError("can't pack user {}: {}".format(user.uid, e))
+    stored = decode_user(record, 1, len(record) - 1)
+    if user_packet_size == 28:
+        return sha1(stored.repack29()).digest()
+    return sha1(stored.repack73()).digest()
+
+
+def template_hash(finger):
+    """ hash of the valid flag and the template bytes """
+    return sha1(bytes(bytearray([finger.valid & 0xFF])) + bytes(finger.template)).digest()
+
+
+class ProvisionPlan(object):
+    """
+    differences between the device and the desired state
+    """
+
+    def __init__(self):
+        self.delete_users = [] # User on the device only
+        self.delete_templates = [] # Finger on the device only (of kept users)
+        self.upsert_users = [] # User new, changed or with new/changed templates
+        self.upsert_templates = [] # Finger new or changed
+        self.invalid_users = [] # (User, error message) desired but can't be sent
+        self.unchanged_users = 0
+        self.unchanged_templates = 0
+
+    def apply(self, conn):
+        """
+        send the differences: the deletes, then every new or changed user
+        with its new or changed templates in bulk (save_users_templates).
+        Raises ZKErrorResponse when the device rejects a change
+
+        :return: number of uploads
+        """
+        for user in self.delete_users:
+            conn.delete_user(uid=user.uid)
+        for index, finger in enumerate(self.delete_templates):
+            if not conn.delete_user_template(uid=finger.uid, temp_id=finger.fid):
+                if index:
+                    conn.refresh_data()
+                raise ZKErrorResponse("Can't delete template {}:{}".format(finger.uid, finger.fid))
+        if not self.upsert_users:
+            if self.delete_templates:
+                conn.refresh_data()
+            return 0
+        return conn.save_users_templates(self.upsert_users, self.upsert_templates)
+
+    @property
+    def empty(self):
+        return not (self.delete_users or self.delete_templates or self.upsert_users or self.upsert_templates)
+
+    def json_pack(self): #packs for json
+        return {
+            "delete_users": [user.uid for user in self.delete_users],
+            "delete_templates": [[finger.uid, finger.fid] for finger in self.delete_templates],
+            "upsert_users": [user.uid for user in self.upsert_users],
+            "upsert_templates": [[finger.uid, finger.fid] for finger in self.upsert_templates],
+            "invalid_users": [[user.uid, error] for user, error in self.invalid_users],
+            "unchanged_users": self.unchanged_users,
+            "unchanged_templates": self.unchanged_templates
+        }
+
+    def __str__(self):
+        text = '<ProvisionPlan>: users -{} ~{} ={}, templates -{} ~{} ={}'.format(
+            len(self.delete_users), len(self.upsert_users), self.unchanged_users,
+            len(self.delete_templates), len(self.upsert_templates), self.unchanged_templates)
+        if self.invalid_users:
+            text += ', {} invalid users'.format(len(self.invalid_users))
+        return text
+
+    def __repr__(self):
+        return self.__str__()
+
+
+def diff(current_users, current_templates, users, templates, user_packet_size=72):
+    """
+    compare the device content with the desired one, in one pass
+
+    :param current_users: list of User on the device
+    :param current_templates: list of Finger on the device
+    :param users: desired list of User (by uid)
+    :param templates: desired list of Finger (by uid and fid)
+    :return: ProvisionPlan
+    """
+    changes = ProvisionPlan()
+    current = dict((user.uid, user_hash(user, user_packet_size)) for user in current_users)
+    current_fingers = dict(((finger.uid, finger.fid), template_hash(finger)) for finger in current_templates)
+    desired = dict((user.uid, user) for user in users)
+    hashes = {}
+    for uid, user in list(desired.items()):
+        try:
+            hashes[uid] = user_hash(user, user_packet_size)
+        except ValueError as e:
+            changes.invalid_users.append((user, str(e)))
+            del desired[uid] # left as it is on the device
+    desired_fingers = dict(((finger.uid, finger.fid), finger) for finger in templates)
+    upsert = set()
+    wanted = set(user.uid for user in users)
+    for user in current_users:
+        if user.uid not in wanted:
+            changes.delete_users.append(user)
+    for key, finger in desired_fingers.items():
+        if current_fingers.get(key) == template_hash(finger):
+            changes.unchanged_templates += 1
+        elif finger.uid in desired:
+            changes.upsert_templates.append(finger)
+            upsert.add(finger.uid)
+    for finger in current_templates:
+        key = (finger.uid, finger.fid)
+        if finger.uid in desired and key not in desired_fingers:
+            changes.delete_templates.append(finger)
+    for uid, user in desired.items():
+        if uid in upsert or current.get(uid) != hashes[uid]:
+            changes.upsert_users.append(user)
+        else:
+            changes.unchanged_users += 1
+    changes.upsert_users.sort(key=lambda user: user.uid)
+    changes.upsert_templates.sort(key=lambda finger: (finger.uid, finger.fid))
+    return changes
+
+
+def plan(conn, users, templates=[]):
+    """
+    fetch the users and templates of a connected device and compare them
+    with the desired ones (nothing is changed on the device)
+
+    :return: ProvisionPlan
+    """
+    return diff(conn.get_users(), conn.get_templates(), users, templates, conn.user_packet_size)
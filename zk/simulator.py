@@ -0,0 +1,801 @@
+# -*- coding: utf-8 -*-
+"""
+pure python ZK terminal simulator (TCP + UDP)
+
+it talks the same protocol as zk.base.ZK, so it can be used to test and
+benchmark bulk operations without real hardware::
+
+    sim = ZKSimulator(port=0).seed(users=50000, templates=10000, records=500000).start()
+    conn = ZK('127.0.0.1', port=sim.port, ommit_ping=True).connect()
+"""
+from __future__ import absolute_import
+import random
+import threading
+import time
+from select import select
+from datetime import datetime, timedelta
+from socket import AF_INET, IPPROTO_TCP, SOCK_DGRAM, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR, TCP_NODELAY, socket, timeout, error as socket_error
+from struct import pack, unpack
+
+from . import const
+from .protocol import create_checksum, make_commkey
+
+try:
+    import queue
+except ImportError: # python 2
+    import Queue as queue
+
+
+def _encode_time(t):
+    """
+    same as zkemsdk.c - EncodeTime
+    """
+    return (
+        ((t.year % 100) * 12 * 31 + ((t.month - 1) * 31) + t.day - 1) *
+        (24 * 60 * 60) + (t.hour * 60 + t.minute) * 60 + t.second
+    )
+
+
+def _decode_time(t):
+    """
+    same as zkemsdk.c - DecodeTime
+    """
+    second = t % 60
+    t = t // 60
+    minute = t % 60
+    t = t // 60
+    hour = t % 24
+    t = t // 24
+    day = t % 31 + 1
+    t = t // 31
+    month = t % 12 + 1
+    t = t // 12
+    return datetime(t + 2000, month, day, hour, minute, second)
+
+
+class _DelayedSend(object):
+    """
+    deliver every packet `latency` seconds after it was sent (in order,
+    without blocking the session), to simulate a slow link
+    """
+
+    def __init__(self, send, latency):
+        self.send = send
+        self.latency = latency
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.__deliver)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __call__(self, packet):
+        self.queue.put((time.time() + self.latency, packet))
+
+    def close(self):
+        """ stop once the queued packets are delivered """
+        self.queue.put((0, None))
+        self.thread.join()
+
+    def __deliver(self):
+        while True:
+            due, packet = self.queue.get()
+            if packet is None:
+                break
+            wait = due - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                self.send(packet)
+            except socket_error:
+                pass
+
+
+class _Session(object):
+    """
+    state of one client session (one TCP connection or one UDP peer)
+    """
+
+    def __init__(self, session_id, send, tcp, pending=None):
+        self.session_id = session_id
+        self.send = send
+        self.tcp = tcp
+        self.pending = pending # function, True when more requests are queued
+        self.authenticated = False
+        self.buffer = None
+        self.upload = None
+        self.upload_size = 0
+        self.read = 0 # bytes of 1504 chunks sent
+        self.sending = threading.RLock() # packets of an answer aren't mixed with others
+        self.event_flags = 0
+        self.events = []
+        self.waiting_ack = False
+        self.lock = threading.Lock()
+
+
+class ZKSimulator(object):
+    """
+    ZK terminal simulator
+    """
+    DIRECT_DATA_MAX = 1016 # bigger answers for 1503 use the 1504 buffer
+    UDP_CHUNK = 1024
+
+    def __init__(self, ip='127.0.0.1', port=4370, password=0, user_packet_size=72, record_size=40, verbose=False, latency=0, pipeline=True, error_rate=0, bandwidth=0, upload_chunk=0, upload_stall=False, upload_size=0, drop_after=0, delays=None):
+        """
+        Construct a new 'ZKSimulator' object.
+
+        :param ip: address to listen on
+        :param port: TCP and UDP port (0: pick a free one)
+        :param password: device password (0: no authentication)
+        :param user_packet_size: user record format (28 or 72 bytes)
+        :param record_size: attendance record format (8, 16 or 40 bytes)
+        :param verbose: showing log of the received commands
+        :param latency: seconds added to every answer (simulated round trip)
+        :param pipeline: accept 1504 requests sent before the previous answer
+            (False: answer them with ACK_ERROR, like older firmwares)
+        :param error_rate: probability of losing each KB of a 1504 answer
+            (the chunk arrives incomplete and has to be read again)
+        :param bandwidth: bytes per second of the simulated link (0: unlimited)
+        :param upload_chunk: biggest CMD_DATA chunk accepted (0: any)
+        :param upload_stall: don't answer the bigger chunks (like firmwares
+            that drop them) instead of rejecting them
+        :param upload_size: biggest CMD_PREPARE_DATA upload accepted (0: any)
+        :param drop_after: drop the session (a broken link) once it has read
+            that many bytes of 1504 chunks (0: never)
+        :param delays: dict of n: seconds, the answer to the n-th 1504
+            request (counted over all the sessions) is sent that late,
+            without holding the answers to the next ones (a stalled or
+            reordered answer)
+        """
+        if user_packet_size not in [28, 72]:
+            raise ValueError("user_packet_size must be 28 or 72")
+        if record_size not in [8, 16, 40]:
+            raise ValueError("record_size must be 8, 16 or 40")
+        self.ip = ip
+        self.port = port
+        self.password = password
+        self.user_packet_size = user_packet_size
+        self.record_size = record_size
+        self.verbose = verbose
+        self.latency = latency
+        self.pipeline = pipeline
+        self.error_rate = error_rate
+        self.bandwidth = bandwidth
+        self.upload_chunk = upload_chunk
+        self.upload_stall = upload_stall
+        self.upload_size = upload_size
+        self.drop_after = drop_after
+        self.delays = delays or {}
+        self.chunks = 0 # 1504 requests answered
+        self.users = {} # uid: [uid, privilege, password, name, card, group_id, user_id]
+        self.templates = {} # (uid, fid): [valid, template]
+        self.attendance = bytearray()
+        self.records = 0
+        self.users_cap = 100000
+        self.fingers_cap = 100000
+        self.rec_cap = 1000000
+        self.enabled = True
+        self.time_offset = timedelta(0)
+        self.options = {
+            b'~SerialNumber': b'SIM0000000001',
+            b'~Platform': b'ZMM220_TFT',
+            b'~DeviceName': b'pyzk simulator',
+            b'MAC': b'00:17:61:00:00:01',
+            b'~ZKFPVersion': b'10',
+            b'ZKFaceVersion': b'0',
+            b'~ExtendFmt': b'1',
+            b'~UserExtFmt': b'1',
+            b'FaceFunOn': b'0',
+            b'CompatOldFirmware': b'0',
+            b'IPAddress': ip.encode(),
+            b'NetMask': b'255.255.255.0',
+            b'GATEIPAddress': b'0.0.0.0',
+        }
+        self.firmware_version = b'Ver 6.60 Apr 28 2017'
+        self.lock = threading.RLock()
+        self.running = False
+        self.__sessions = []
+        self.__udp_sessions = {}
+        self.__next_session = 1
+        self.__threads = []
+        self.__tcp_sock = None
+        self.__udp_sock = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def __str__(self):
+        return "ZKSimulator %s:%s users[%i]:%i fingers:%i records[%i]:%i" % (
+            self.ip, self.port, self.user_packet_size, len(self.users),
+            len(self.templates), self.record_size, self.records
+        )
+
+    # dataset
+
+    def seed(self, users=0, templates=0, records=0, template_size=512, start=None):
+        """
+        fill the device with a generated dataset
+
+        :param users: number of users
+        :param templates: number of fingerprint templates (spread over the users)
+        :param records: number of attendance records (spread over the users)
+        :param template_size: size in bytes of every template
+        :param start: datetime of the first attendance record
+        :return: self
+        """
+        with self.lock:
+            first_uid = max(self.users) + 1 if self.users else 1
+            for uid in range(first_uid, first_uid + users):
+                self.set_user(uid, 'User %i' % uid, const.USER_DEFAULT, '', '', str(100000 + uid), 0)
+            uids = sorted(self.users)
+            if templates and not uids:
+                raise ValueError("can't seed templates without users")
+            for i in range(templates):
+                uid = uids[i % len(uids)]
+                fid = (i // len(uids)) % 10
+                template = (pack('<HH', uid, fid) * (template_size // 4 + 1))[:template_size]
+                self.templates[(uid, fid)] = [1, template]
+            if records and not uids:
+                raise ValueError("can't seed records without users")
+            timestamp = start or datetime(2018, 1, 1, 8, 0, 0)
+            step = timedelta(minutes=1)
+            for i in range(records):
+                self.add_attendance(uids[i % len(uids)], timestamp, 1, i % 2)
+                timestamp += step
+        return self
+
+    def set_user(self, uid, name='', privilege=0, password='', group_id='', user_id='', card=0):
+        """
+        create or update user by uid
+        """
+        with self.lock:
+            self.users[uid] = [uid, privilege, password, name, card, group_id, user_id or str(uid)]
+
+    def add_attendance(self, uid, timestamp, status=1, punch=0):
+        """
+        append an attendance record, in the device format
+        """
+        with self.lock:
+            user = self.users.get(uid)
+            user_id = user[6] if user else str(uid)
+            encoded = pack('<I', _encode_time(timestamp))
+            if self.record_size == 8:
+                self.attendance += pack('<HB4sB', uid, status, encoded, punch)
+            elif self.record_size == 16:
+                self.attendance += pack('<I4sBB2sI', int(user_id), encoded, status, punch, b'', 0)
+            else:
+                self.attendance += pack('<H24sB4sB8s', uid, user_id.encode(), status, encoded, punch, b'')
+            self.records += 1
+
+    def push_event(self, uid, status=1, punch=0, timestamp=None):
+        """
+        simulate a punch: record it and send a live event to every
+        session registered for EF_ATTLOG
+        """
+        timestamp = timestamp or datetime.now().replace(microsecond=0)
+        with self.lock:
+            self.add_attendance(uid, timestamp, status, punch)
+            user = self.users.get(uid)
+            user_id = user[6] if user else str(uid)
+            sessions = [s for s in self.__sessions + list(self.__udp_sessions.values()) if s.event_flags & const.EF_ATTLOG]
+        timehex = pack('6B', timestamp.year - 2000, timestamp.month, timestamp.day, timestamp.hour, timestamp.minute, timestamp.second)
+        if self.user_packet_size == 28:
+            event = pack('<IBB6s', int(user_id), status, punch, timehex)
+        else:
+            event = pack('<24sBB6s4s', user_id.encode(), status, punch, timehex, b'')
+        for session in sessions:
+            with session.lock:
+                session.events.append(event)
+            self.__flush_events(session)
+
+    # device buffers
+
+    def pack_users(self):
+        """
+        :return: users table as sent by the device (without total size)
+        """
+        data = []
+        with self.lock:
+            for uid in sorted(self.users):
+                uid, privilege, password, name, card, group_id, user_id = self.users[uid]
+                if self.user_packet_size == 28:
+                    data.append(pack('<HB5s8sIxBhI', uid, privilege, password.encode(), name.encode(), card,
+                                     int(group_id) if group_id else 0, 0, int(user_id)))
+                else:
+                    data.append(pack('<HB8s24sIx7sx24s', uid, privilege, password.encode(), name.encode(), card,
+                                     group_id.encode(), user_id.encode()))
+        return b''.join(data)
+
+    def pack_templates(self):
+        """
+        :return: templates table as sent by the device (without total size)
+        """
+        data = []
+        with self.lock:
+            for key in sorted(self.templates):
+                valid, template = self.templates[key]
+                data.append(pack('<HHbb', len(template) + 6, key[0], key[1], valid))
+                data.append(template)
+        return b''.join(data)
+
+    def __read_sizes(self):
+        fields = [0] * 20
+        fields[4] = len(self.users)
+        fields[6] = len(self.templates)
+        fields[8] = self.records
+        fields[14] = self.fingers_cap
+        fields[15] = self.users_cap
+        fields[16] = self.rec_cap
+        fields[17] = self.fingers_cap - len(self.templates)
+        fields[18] = self.users_cap - len(self.users)
+        fields[19] = self.rec_cap - self.records
+        return pack('<20i', *fields) + pack('<3i', 0, 0, 0)
+
+    def __save_user(self, data):
+        if len(data) >= 72:
+            uid, privilege, password, name, card, group_id, user_id = unpack('<HB8s24sIx7sx24s', data[:72])
+            group_id = group_id.split(b'\x00')[0].decode(errors='ignore')
+            user_id = user_id.split(b'\x00')[0].decode(errors='ignore')
+        elif len(data) >= 28:
+            uid, privilege, password, name, card, group_id, _timezone, user_id = unpack('<HB5s8sIxBhI', data[:28])
+            group_id = str(group_id)
+            user_id = str(user_id)
+        else:
+            return False
+        password = password.split(b'\x00')[0].decode(errors='ignore')
+        name = name.split(b'\x00')[0].decode(errors='ignore')
+        self.set_user(uid, name, privilege, password, group_id, user_id, card)
+        return True
+
+    def __save_user_templates(self, data):
+        """
+        process a command 110 upload: head + users + table + templates
+        """
+        data = bytes(data)
+        if len(data) < 12:
+            return False
+        usize, tsize, fsize = unpack('<III', data[:12])
+        upack = data[12:12 + usize]
+        table = data[12 + usize:12 + usize + tsize]
+        fpack = data[12 + usize + tsize:12 + usize + tsize + fsize]
+        record = self.user_packet_size + 1
+        if usize % record:
+            record = 29 if record == 73 else 73
+            if usize % record:
+                return False
+        with self.lock:
+            uids = set(unpack('<H', upack[i + 1:i + 3])[0] for i in range(0, usize, record))
+            if len(uids - set(self.users)) > self.users_cap - len(self.users):
+                return False # user table full
+            for i in range(0, usize, record):
+                self.__save_user(upack[i + 1:i + record])
+            for i in range(0, len(table) - 7, 8):
+                _kind, uid, fnum, tstart = unpack('<bHbI', table[i:i + 8])
+                size = unpack('<H', fpack[tstart:tstart + 2])[0]
+                self.templates[(uid, fnum - 0x10)] = [1, fpack[tstart + 2:tstart + 2 + size]]
+        return True
+
+    # protocol
+
+    def __packet(self, command, session_id, reply_id, data=b''):
+        buf = pack('<4H', command, 0, session_id, reply_id) + data
+        return pack('<4H', command, create_checksum(buf), session_id, reply_id) + data
+
+    def __reply(self, session, command, reply_id, data=b''):
+        packet = self.__packet(command, session.session_id, reply_id, data)
+        if session.tcp:
+            packet = pack('<HHI', const.MACHINE_PREPARE_DATA_1, const.MACHINE_PREPARE_DATA_2, len(packet)) + packet
+        with session.sending:
+            session.send(packet)
+
+    def __lost_kb(self, size):
+        """ index of the KB lost on the simulated link, None if none """
+        if self.error_rate:
+            for kb in range((size + 1023) // 1024):
+                if random.random() < self.error_rate:
+                    return kb
+        return None
+
+    def __send_data(self, session, reply_id, data, lost=None):
+        """
+        answer with PREPARE_DATA + DATA packet(s) + ACK_OK
+
+        :param lost: index of a KB that never arrives
+        """
+        with session.sending:
+            self.__reply(session, const.CMD_PREPARE_DATA, reply_id, pack('<II', len(data), 0))
+            if self.bandwidth:
+                time.sleep(len(data) / float(self.bandwidth))
+            if session.tcp:
+                if lost is not None:
+                    data = data[:lost * 1024] + data[(lost + 1) * 1024:]
+                self.__reply(session, const.CMD_DATA, reply_id, data)
+            else:
+                for start in range(0, len(data), self.UDP_CHUNK):
+                    if lost is not None and start // 1024 == lost:
+                        continue
+                    self.__reply(session, const.CMD_DATA, reply_id, data[start:start + self.UDP_CHUNK])
+            self.__reply(session, const.CMD_ACK_OK, reply_id)
+
+    def __send_late(self, session, reply_id, data, lost):
+        try:
+            self.__send_data(session, reply_id, data, lost)
+        except (socket_error, ValueError): # the session is gone
+            pass
+
+    def __flush_events(self, session):
+        with session.lock:
+            if session.waiting_ack or not session.events:
+                return
+            event = session.events.pop(0)
+            session.waiting_ack = True
+        try:
+            self.__reply(session, const.CMD_REG_EVENT, 0, event)
+        except socket_error:
+            pass
+
+    def __buffer(self, command, fct):
+        if command == const.CMD_ATTLOG_RRQ:
+            with self.lock:
+                data = bytes(self.attendance)
+        elif command == const.CMD_USERTEMP_RRQ and fct == const.FCT_USER:
+            data = self.pack_users()
+        elif command == const.CMD_DB_RRQ and fct == const.FCT_FINGERTMP:
+            data = self.pack_templates()
+        else:
+            return None
+        return pack('<I', len(data)) + data
+
+    def handle(self, session, command, reply_id, data):
+        """
+        process one command and send the answer(s)
+
+        :return: False if the session must be closed
+        """
+        if self.verbose: print("sim: session %i command %i (%i bytes)" % (session.session_id, command, len(data)))
+        if command == const.CMD_ACK_OK:
+            with session.lock:
+                session.waiting_ack = False
+            self.__flush_events(session)
+            return True
+        if command == const.CMD_CONNECT:
+            with self.lock:
+                session.session_id = self.__next_session
+                self.__next_session = (self.__next_session + 1) % const.USHRT_MAX or 1
+            session.authenticated = not self.password
+            self.__reply(session, const.CMD_ACK_OK if session.authenticated else const.CMD_ACK_UNAUTH, reply_id)
+            return True
+        if command == const.CMD_AUTH:
+            session.authenticated = bytes(data[:4]) == make_commkey(self.password, session.session_id)
+            self.__reply(session, const.CMD_ACK_OK if session.authenticated else const.CMD_ACK_UNAUTH, reply_id)
+            return True
+        if not session.authenticated:
+            self.__reply(session, const.CMD_ACK_UNAUTH, reply_id)
+            return True
+        if command == const.CMD_EXIT:
+            self.__reply(session, const.CMD_ACK_OK, reply_id)
+            return False
+        if command in [const.CMD_ENABLEDEVICE, const.CMD_DISABLEDEVICE]:
+            self.enabled = command == const.CMD_ENABLEDEVICE
+            self.__reply(session, const.CMD_ACK_OK, reply_id)
+        elif command in [const.CMD_REFRESHDATA, const.CMD_REFRESHOPTION, const.CMD_CANCELCAPTURE,
+                         const.CMD_STARTVERIFY, const.CMD_OPTIONS_WRQ, const.CMD_TESTVOICE, const.CMD_UNLOCK,
+                         const.CMD_ACK_ERROR, const.CMD_ACK_UNKNOWN]:
+            self.__reply(session, const.CMD_ACK_OK, reply_id)
+        elif command == const.CMD_FREE_DATA:
+            session.buffer = None
+            self.__reply(session, const.CMD_ACK_OK, reply_id)
+        elif command == const.CMD_GET_VERSION:
+            self.__reply(session, const.CMD_ACK_OK, reply_id, self.firmware_version + b'\x00')
+        elif command == const.CMD_OPTIONS_RRQ:
+            key = bytes(data).split(b'\x00')[0]
+            if key in self.options:
+                self.__reply(session, const.CMD_ACK_OK, reply_id, key + b'=' + self.options[key] + b'\x00')
+            else:
+                self.__reply(session, const.CMD_ACK_ERROR, reply_id)
+        elif command == const.CMD_GET_PINWIDTH:
+            self.__reply(session, const.CMD_ACK_OK, reply_id, b'\x09')
+        elif command == const.CMD_GET_FREE_SIZES:
+            with self.lock:
+                sizes = self.__read_sizes()
+            self.__reply(session, const.CMD_ACK_OK, reply_id, sizes)
+        elif command == const.CMD_GET_TIME:
+            now = datetime.now().replace(microsecond=0) + self.time_offset
+            self.__reply(session, const.CMD_ACK_OK, reply_id, pack('<I', _encode_time(now)))
+        elif command == const.CMD_SET_TIME:
+            self.time_offset = _decode_time(unpack('<I', data[:4])[0]) - datetime.now().replace(microsecond=0)
+            self.__reply(session, const.CMD_ACK_OK, reply_id)
+        elif command == const.CMD_USER_WRQ:
+            with self.lock:
+                ok = self.__save_user(bytes(data))
+            self.__reply(session, const.CMD_ACK_OK if ok else const.CMD_ACK_ERROR, reply_id)
+        elif command == const.CMD_DELETE_USER:
+            uid = unpack('<h', data[:2])[0]
+            with self.lock:
+                self.users.pop(uid, None)
+                for key in [k for k in self.templates if k[0] == uid]:
+                    del self.templates[key]
+            self.__reply(session, const.CMD_ACK_OK, reply_id)
+        elif command in [const.CMD_DELETE_USERTEMP, 134]:
+            if command == 134:
+                user_id, fid = unpack('<24sB', data[:25])
+                user_id = user_id.split(b'\x00')[0].decode(errors='ignore')
+                with self.lock:
+                    uids = [u[0] for u in self.users.values() if u[6] == user_id]
+                uid = uids[0] if uids else None
+            else:
+                uid, fid = unpack('<hb', data[:3])
+            with self.lock:
+                found = self.templates.pop((uid, fid), None)
+            self.__reply(session, const.CMD_ACK_OK if found else const.CMD_ACK_ERROR, reply_id)
+        elif command == const.CMD_CLEAR_DATA:
+            with self.lock:
+                self.users.clear()
+                self.templates.clear()
+                self.attendance = bytearray()
+                self.records = 0
+            self.__reply(session, const.CMD_ACK_OK, reply_id)
+        elif command == const.CMD_CLEAR_ATTLOG:
+            with self.lock:
+                self.attendance = bytearray()
+                self.records = 0
+            self.__reply(session, const.CMD_ACK_OK, reply_id)
+        elif command == const.CMD_REG_EVENT:
+            session.event_flags = unpack('<I', data[:4])[0]
+            with session.lock:
+                session.waiting_ack = False
+                if not session.event_flags:
+                    session.events = []
+            self.__reply(session, const.CMD_ACK_OK, reply_id)
+        elif command == 1503: # prepare buffered data
+            _one, rcommand, fct, _ext = unpack('<bhii', data[:11])
+            buf = self.__buffer(rcommand, fct)
+            if buf is None:
+                self.__reply(session, const.CMD_ACK_ERROR, reply_id)
+            elif len(buf) <= self.DIRECT_DATA_MAX:
+                self.__reply(session, const.CMD_DATA, reply_id, buf)
+            else:
+                session.buffer = buf
+                self.__reply(session, const.CMD_ACK_OK, reply_id, pack('<BI', 0, len(buf)))
+        elif command == 1504: # read buffer chunk
+            start, size = unpack('<ii', data[:8])
+            if session.buffer is None or start < 0 or size <= 0 or start >= len(session.buffer):
+                self.__reply(session, const.CMD_ACK_ERROR, reply_id)
+            elif not self.pipeline and session.pending and session.pending():
+                self.__reply(session, const.CMD_ACK_ERROR, reply_id) # busy
+            else:
+                chunk = session.buffer[start:start + size]
+                session.read += len(chunk)
+                with self.lock:
+                    self.chunks += 1
+                    delay = self.delays.get(self.chunks)
+                if self.drop_after and session.read > self.drop_after:
+                    return False # link broken, no answer
+                if delay:
+                    timer = threading.Timer(delay, self.__send_late, (session, reply_id, chunk, self.__lost_kb(len(chunk))))
+                    timer.daemon = True
+                    timer.start()
+                else:
+                    self.__send_data(session, reply_id, chunk, self.__lost_kb(len(chunk)))
+                if not self.pipeline:
+                    time.sleep(0.01) # so pipelined requests are seen as queued
+        elif command == 88: # read a single template
+            uid, fid = unpack('<hb', data[:3])
+            with self.lock:
+                template = self.templates.get((uid, fid))
+            if template is None:
+                self.__reply(session, const.CMD_ACK_ERROR, reply_id)
+            else:
+                self.__send_data(session, reply_id, template[1] + b'\x00')
+        elif command == const.CMD_PREPARE_DATA:
+            session.upload_size = unpack('<I', data[:4])[0]
+            if self.upload_size and session.upload_size > self.upload_size:
+                session.upload = None
+                self.__reply(session, const.CMD_ACK_ERROR, reply_id) # too big
+            else:
+                session.upload = bytearray()
+                self.__reply(session, const.CMD_ACK_OK, reply_id)
+        elif command == const.CMD_DATA:
+            if session.upload is None or len(session.upload) + len(data) > session.upload_size:
+                self.__reply(session, const.CMD_ACK_ERROR, reply_id)
+            elif self.upload_chunk and len(data) > self.upload_chunk:
+                if not self.upload_stall:
+                    self.__reply(session, const.CMD_ACK_ERROR, reply_id) # too big
+            elif not self.pipeline and session.pending and session.pending():
+                self.__reply(session, const.CMD_ACK_ERROR, reply_id) # busy
+            else:
+                session.upload += data
+                self.__reply(session, const.CMD_ACK_OK, reply_id)
+        elif command == 110: # save users and templates from upload buffer
+            ok = session.upload is not None and len(session.upload) == session.upload_size and self.__save_user_templates(session.upload)
+            session.upload = None
+            self.__reply(session, const.CMD_ACK_OK if ok else const.CMD_ACK_ERROR, reply_id)
+        else:
+            self.__reply(session, const.CMD_ACK_UNKNOWN, reply_id)
+        return True
+
+    # transports
+
+    def start(self):
+        """
+        start listening (TCP and UDP on the same port), in background threads
+
+        :return: self
+        """
+        for _retries in range(10):
+            tcp_sock = socket(AF_INET, SOCK_STREAM)
+            tcp_sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+            tcp_sock.bind((self.ip, self.port))
+            port = tcp_sock.getsockname()[1]
+            udp_sock = socket(AF_INET, SOCK_DGRAM)
+            try:
+                udp_sock.bind((self.ip, port))
+            except socket_error:
+                tcp_sock.close()
+                udp_sock.close()
+                if self.port:
+                    raise
+                continue
+            break
+        else:
+            raise socket_error("can't bind simulator port")
+        self.port = port
+        tcp_sock.listen(16)
+        tcp_sock.settimeout(0.2)
+        udp_sock.settimeout(0.2)
+        self.__tcp_sock = tcp_sock
+        self.__udp_sock = udp_sock
+        self.__udp_lock = threading.Lock()
+        self.running = True
+        for target in [self.__serve_tcp, self.__serve_udp]:
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            self.__threads.append(thread)
+        return self
+
+    def stop(self):
+        """
+        stop listening and close every session
+        """
+        self.running = False
+        for thread in self.__threads:
+            thread.join()
+        self.__threads = []
+        for sock in [self.__tcp_sock, self.__udp_sock]:
+            if sock:
+                sock.close()
+
+    def __serve_tcp(self):
+        while self.running:
+            try:
+                conn, _addr = self.__tcp_sock.accept()
+            except timeout:
+                continue
+            except socket_error:
+                break
+            thread = threading.Thread(target=self.__serve_tcp_client, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def __recv_exact(self, conn, size):
+        data = bytearray()
+        while len(data) < size:
+            try:
+                chunk = conn.recv(size - len(data))
+            except timeout:
+                if not self.running:
+                    return None
+                continue
+            if not chunk:
+                return None
+            data += chunk
+        return bytes(data)
+
+    def __serve_tcp_client(self, conn):
+        conn.settimeout(0.2)
+        conn.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        send_lock = threading.Lock()
+
+        def send(packet):
+            with send_lock:
+                conn.sendall(packet)
+
+        def pending():
+            return bool(select([conn], [], [], 0)[0])
+
+        if self.latency:
+            send = _DelayedSend(send, self.latency)
+        session = _Session(0, send, True, pending)
+        with self.lock:
+            self.__sessions.append(session)
+        try:
+            while self.running:
+                top = self.__recv_exact(conn, 8)
+                if top is None:
+                    break
+                magic1, magic2, length = unpack('<HHI', top)
+                if magic1 != const.MACHINE_PREPARE_DATA_1 or magic2 != const.MACHINE_PREPARE_DATA_2 or length < 8:
+                    break
+                packet = self.__recv_exact(conn, length)
+                if packet is None:
+                    break
+                command, _checksum, _session_id, reply_id = unpack('<4H', packet[:8])
+                if not self.handle(session, command, reply_id, packet[8:]):
+                    break
+        except socket_error:
+            pass
+        finally:
+            with self.lock:
+                self.__sessions.remove(session)
+            if self.latency:
+                send.close() # pending answers first
+            conn.close()
+
+    def __serve_udp(self):
+        while self.running:
+            try:
+                packet, addr = self.__udp_sock.recvfrom(65535)
+            except timeout:
+                continue
+            except socket_error:
+                break
+            if len(packet) < 8:
+                continue
+            session = self.__udp_sessions.get(addr)
+            if session is None:
+                def send(data, addr=addr):
+                    with self.__udp_lock:
+                        self.__udp_sock.sendto(data, addr)
+                def pending():
+                    return bool(select([self.__udp_sock], [], [], 0)[0])
+                if self.latency:
+                    send = _DelayedSend(send, self.latency)
+                session = _Session(0, send, False, pending)
+                with self.lock:
+                    self.__udp_sessions[addr] = session
+            command, _checksum, _session_id, reply_id = unpack('<4H', packet[:8])
+            try:
+                alive = self.handle(session, command, reply_id, packet[8:])
+            except socket_error:
+                alive = False
+            if not alive:
+                with self.lock:
+                    self.__udp_sessions.pop(addr, None)
+                if self.latency:
+                    session.send.close()
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='ZK device simulator')
+    parser.add_argument('-a', '--address', help='listen address [127.0.0.1]', default='127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, help='TCP/UDP port [4370]', default=4370)
+    parser.add_argument('-P', '--password', type=int, help='Device code/password', default=0)
+    parser.add_argument('-U', '--users', type=int, help='number of users', default=0)
+    parser.add_argument('-F', '--templates', type=int, help='number of templates', default=0)
+    parser.add_argument('-R', '--records', type=int, help='number of attendance records', default=0)
+    parser.add_argument('-s', '--user-size', type=int, choices=[28, 72], help='user record size [72]', default=72)
+    parser.add_argument('-r', '--record-size', type=int, choices=[8, 16, 40], help='attendance record size [40]', default=40)
+    parser.add_argument('-L', '--latency', type=float, help='seconds added to every answer [0]', default=0)
+    parser.add_argument('-E', '--error-rate', type=float, help='probability of losing each KB of a chunk [0]', default=0)
+    parser.add_argument('-B', '--bandwidth', type=int, help='link bytes per second (0: unlimited) [0]', default=0)
+    parser.add_argument('-D', '--drop-after', type=int, help='drop a session after reading that many chunk bytes (0: never) [0]', default=0)
+    parser.add_argument('-v', '--verbose', action="store_true", help='Print received commands')
+    args = parser.parse_args()
+    sim = ZKSimulator(args.address, args.port, args.password, args.user_size, args.record_size, args.verbose, args.latency,
+                      error_rate=args.error_rate, bandwidth=args.bandwidth, drop_after=args.drop_after)
+    sim.seed(args.users, args.templates, args.records)
+    sim.start()
+    print(sim)
+    try:
+        while True:
+            time.sleep(1)
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    sim.stop()
+
+
+if __name__ == '__main__':
+    main()
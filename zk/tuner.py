@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+adaptive 1504 chunk size, from the measured throughput and broken chunks
+
+on lossy links a broken chunk is read again whole, so smaller chunks waste
+less; on clean links the biggest chunk the firmware accepts wins.
+"""
+
+
+class ChunkTuner(object):
+    """
+    halves the chunk size on a broken chunk, doubles it after grow_after
+    clean chunks (unless the bigger size measured worse), and keeps the
+    throughput of every size. The best size is remembered per device.
+    """
+    devices = {} # (ip, port, tcp): best chunk size
+
+    def __init__(self, minimum=1024, maximum=0xFFc0, size=None, grow_after=4, device=None):
+        """
+        :param minimum: smallest chunk size
+        :param maximum: biggest chunk size accepted by the firmware
+        :param size: initial chunk size (default: remembered best or maximum)
+        :param grow_after: clean chunks before trying a bigger size
+        :param device: key to remember the best size, ie: (ip, port, tcp)
+        """
+        self.minimum = minimum
+        self.maximum = maximum
+        self.grow_after = grow_after
+        self.device = device
+        if size is None:
+            size = ChunkTuner.devices.get(device, maximum)
+        self.size = max(minimum, min(maximum, size))
+        self.stats = {} # size: [bytes read, seconds, chunks, broken]
+        self.clean = 0
+
+    def throughput(self, size):
+        """ bytes per second read with size (broken chunks count as time) """
+        stats = self.stats.get(size)
+        if not stats or not stats[1]:
+            return None
+        return stats[0] / stats[1]
+
+    @property
+    def best(self):
+        """
+        size with the best throughput, among the ones measured at least
+        grow_after times (current size if none)
+        """
+        measured = [(self.throughput(size), size) for size, stats in self.stats.items()
+                    if stats[2] >= self.grow_after and self.throughput(size) is not None]
+        if not measured:
+            return self.size
+        return max(measured)[1]
+
+    def record(self, size, elapsed, ok):
+        """
+        account a chunk read (or attempt) and adapt the size
+
+        :param size: bytes requested
+        :param elapsed: seconds spent
+        :param ok: False when the chunk was broken (and will be read again)
+        """
+        if size >= self.size: # the last (short) chunk of a read isn't comparable
+            stats = self.stats.setdefault(size, [0, 0.0, 0, 0])
+            stats[0] += size if ok else 0
+            stats[1] += elapsed
+            stats[2] += 1
+            stats[3] += 0 if ok else 1
+        if not ok:
+            self.clean = 0
+            self.size = max(self.minimum, self.size // 2)
+        elif size >= self.size:
+            self.clean += 1
+            if self.clean >= self.grow_after and self.size < self.maximum:
+                self.clean = 0
+                bigger = min(self.maximum, self.size * 2)
+                tries = self.stats.get(bigger, [0, 0.0, 0, 0])[2]
+                current, measured = self.throughput(self.size), self.throughput(bigger)
+                if tries < self.grow_after or current is None or measured >= current:
+                    self.size = bigger
+        if self.device is not None:
+            ChunkTuner.devices[self.device] = self.best
+
+    def __str__(self):
+        return '<ChunkTuner>: size {} best {} ({})'.format(self.size, self.best, ', '.join(
+            '{}: {:.0f}KB/s {}/{} broken'.format(size, (self.throughput(size) or 0) / 1024, stats[3], stats[2])
+            for size, stats in sorted(self.stats.items())))
+
+    def __repr__(self):
+        return self.__str__()
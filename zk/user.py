@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
-from struct import pack #, unpack
+from .codec import USER_UPLOAD
 class User(object):
+    __slots__ = ('uid', 'name', 'privilege', 'password', 'group_id', 'user_id', 'card')
     encoding = 'UTF-8'
 
     def __init__(self, uid, name, privilege, password='', group_id='', user_id='', card=0):
@@ -12,6 +13,23 @@ class User(object):
         self.user_id = user_id
         self.card = int(card) # 64 int to 40 bit int
 
+    @staticmethod
+    def fast(uid, name, privilege, password, group_id, user_id, card, new=object.__new__):
+        """
+        constructor without coercions, for the bulk decoders (the fields
+        already have their types: name, password, group_id and user_id str,
+        card int)
+        """
+        user = new(User)
+        user.uid = uid
+        user.name = name
+        user.privilege = privilege
+        user.password = password
+        user.group_id = group_id
+        user.user_id = user_id
+        user.card = card
+        return user
+
     @staticmethod
     def json_unpack(json):
         #validate?
@@ -25,16 +43,76 @@ class User(object):
             card=json['card']
         )
 
+    def json_pack(self): #packs for json
+        return {
+            "uid": self.uid,
+            "name": self.name,
+            "privilege": self.privilege,
+            "password": self.password,
+            "group_id": self.group_id,
+            "user_id": self.user_id,
+            "card": self.card
+        }
+
     def repack29(self): # with 02 for zk6 (size 29)
-        return pack("<BHB5s8sIxBhI", 2, self.uid, self.privilege, self.password.encode(User.encoding, errors='ignore'), self.name.encode(User.encoding, errors='ignore'), self.card, int(self.group_id) if self.group_id else 0, 0, int(self.user_id))
+        return USER_UPLOAD[29].pack(2, self.uid, self.privilege, self.password.encode(User.encoding, errors='ignore'), self.name.encode(User.encoding, errors='ignore'), self.card, int(self.group_id) if self.group_id else 0, 0, int(self.user_id))
 
     def repack73(self): #with 02 for zk8 (size73)
         #password 6s + 0x00 + 0x77
         # 0,0 => 7sx group id, timezone?
-        return pack("<BHB8s24sIB7sx24s", 2, self.uid, self.privilege,self.password.encode(User.encoding, errors='ignore'), self.name.encode(User.encoding, errors='ignore'), self.card, 1, str(self.group_id).encode(User.encoding, errors='ignore'), str(self.user_id).encode(User.encoding, errors='ignore'))
+        return USER_UPLOAD[73].pack(2, self.uid, self.privilege,self.password.encode(User.encoding, errors='ignore'), self.name.encode(User.encoding, errors='ignore'), self.card, 1, str(self.group_id).encode(User.encoding, errors='ignore'), str(self.user_id).encode(User.encoding, errors='ignore'))
 
     def __str__(self):
         return u'<User>: [uid:{}, name:{} user_id:{}]'.format(self.uid, self.name, self.user_id)
 
     def __repr__(self):
         return u'<User>: [uid:{}, name:{} user_id:{}]'.format(self.uid, self.name, self.user_id)
+
+
+class UserDirectory(object):
+    """
+    users indexed by uid and by user_id (first user wins on duplicates)
+    """
+
+    def __init__(self, users=None):
+        self.users = []
+        self.by_uid = {}
+        self.by_user_id = {}
+        for user in users or []:
+            self.add(user)
+
+    def add(self, user):
+        self.users.append(user)
+        self.by_uid.setdefault(user.uid, user)
+        self.by_user_id.setdefault(user.user_id, user)
+
+    def put(self, user):
+        """ add user, replacing the one with the same uid """
+        self.remove(user.uid)
+        self.add(user)
+
+    def remove(self, uid):
+        """ remove the user with uid (if any) """
+        user = self.by_uid.pop(uid, None)
+        if user is None:
+            return
+        self.users.remove(user)
+        if self.by_user_id.get(user.user_id) is user:
+            del self.by_user_id[user.user_id]
+        for other in self.users: # next duplicate, if any
+            if other.uid == uid:
+                self.by_uid.setdefault(uid, other)
+            if other.user_id == user.user_id:
+                self.by_user_id.setdefault(user.user_id, other)
+
+    def get_by_uid(self, uid):
+        return self.by_uid.get(uid)
+
+    def get_by_user_id(self, user_id):
+        return self.by_user_id.get(str(user_id))
+
+    def __len__(self):
+        return len(self.users)
+
+    def __iter__(self):
+        return iter(self.users)